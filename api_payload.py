@@ -0,0 +1,150 @@
+import json
+from datetime import datetime
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def compact_json(payload):
+    # no whitespace between the tokens, datetimes as iso strings
+    return json.dumps(payload, separators=(',', ':'), default=json_default)
+
+
+def batch_items(payload, max_size):
+    # the rows of a batch call, a json array of objects
+    # returns (items, error message)
+    if not isinstance(payload, list) or not all(isinstance(item, dict) for item in payload):
+        return None, 'Expected a JSON array of objects'
+    if not payload:
+        return None, 'The batch is empty'
+    if len(payload) > max_size:
+        return None, f'At most {max_size} rows per call'
+    return payload, None
+
+
+def is_integer(value, minimum=None):
+    # json numbers without a fraction, true and false are not numbers here
+    if isinstance(value, bool) or not isinstance(value, int):
+        return False
+    return minimum is None or value >= minimum
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_text(value, max_length):
+    return isinstance(value, str) and value.strip() != '' and len(value.strip()) <= max_length
+
+
+def clean_product(item):
+    # {code, name, quantity, price?} of a new product, the json types of clean_product_update
+    # returns (values for the product table, list of errors) like product_import.clean_row
+    error_list = []
+    if not is_text(item.get('code'), 30):
+        error_list.append('Invalid Product code')
+    if not is_text(item.get('name'), 50):
+        error_list.append('Invalid Product Name')
+    if not is_integer(item.get('quantity'), 0):
+        error_list.append('Invalid Product Quantity')
+    if item.get('price') is not None and not is_number(item['price']):
+        error_list.append('Invalid Product Price')
+    if error_list:
+        return None, error_list
+    return {'code': item['code'].strip(), 'name': item['name'].strip(), 'quantity': item['quantity'],
+        'price': item.get('price')}, []
+
+
+def clean_product_update(item):
+    # {id, version_id?, code?, name?, quantity?, price?} of a product update
+    # returns (values, list of errors) like product_import.clean_row
+    error_list = []
+    values = {}
+    if not is_integer(item.get('id'), 1):
+        error_list.append('Invalid Product id')
+    if 'version_id' in item and not is_integer(item['version_id'], 1):
+        error_list.append('Invalid version_id')
+    if 'code' in item:
+        if is_text(item['code'], 30):
+            values['code'] = item['code'].strip()
+        else:
+            error_list.append('Invalid Product code')
+    if 'name' in item:
+        if is_text(item['name'], 50):
+            values['name'] = item['name'].strip()
+        else:
+            error_list.append('Invalid Product Name')
+    if 'quantity' in item:
+        if is_integer(item['quantity'], 0):
+            values['quantity'] = item['quantity']
+        else:
+            error_list.append('Invalid Product Quantity')
+    if 'price' in item:
+        if item['price'] is None or is_number(item['price']):
+            values['price'] = item['price']
+        else:
+            error_list.append('Invalid Product Price')
+    if not values and not error_list:
+        error_list.append('Nothing to update')
+    return values, error_list
+
+
+def clean_customer(item, update=False):
+    # {fullname, balance?, remarks?} of a new customer, or {id, version_id?, ...} of an update
+    # returns (values, list of errors)
+    error_list = []
+    values = {}
+    if update:
+        if not is_integer(item.get('id'), 1):
+            error_list.append('Invalid Customer id')
+        if 'version_id' in item and not is_integer(item['version_id'], 1):
+            error_list.append('Invalid version_id')
+    if 'fullname' in item or not update:
+        if is_text(item.get('fullname'), 50):
+            values['fullname'] = item['fullname'].strip()
+        else:
+            error_list.append('Invalid Full Name')
+    if 'balance' in item:
+        if is_number(item['balance']):
+            values['balance'] = item['balance']
+        else:
+            error_list.append('Invalid Balance')
+    elif not update:
+        values['balance'] = 0
+    if 'remarks' in item or not update:
+        remarks = item.get('remarks')
+        if remarks is None or (isinstance(remarks, str) and len(remarks) <= 50):
+            values['remarks'] = remarks
+        else:
+            error_list.append('Invalid Remarks')
+    if update and not values and not error_list:
+        error_list.append('Nothing to update')
+    return values, error_list
+
+
+def clean_line(item, quantity_fields, update=False):
+    # a worksheet line, {product_id, <quantity fields>?} when added to the document
+    # or {id, version_id?, <quantity fields>} when updated. Returns (values, list of errors)
+    error_list = []
+    values = {}
+    if update:
+        if not is_integer(item.get('id'), 1):
+            error_list.append('Invalid line id')
+        if 'version_id' in item and not is_integer(item['version_id'], 1):
+            error_list.append('Invalid version_id')
+    elif not is_integer(item.get('product_id'), 1):
+        error_list.append('Invalid product_id')
+    for field in quantity_fields:
+        if field in item:
+            if is_integer(item[field], 0):
+                values[field] = item[field]
+            else:
+                error_list.append(f'Invalid {field}')
+        elif update:
+            error_list.append(f'Missing {field}')
+        else:
+            values[field] = 0
+    return values, error_list
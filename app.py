@@ -1,19 +1,129 @@
-from flask import Flask, render_template, request, redirect, url_for
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Blueprint, Markup, Response, render_template, request, redirect, url_for, jsonify, abort
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import ast 
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import bindparam, literal, select, tuple_, or_, exists, func
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.orm.exc import StaleDataError
+from worksheet_form import PurchaseLine, parse_adjustment_form, parse_purchase_form, parse_line_versions
+from cache import TTLCache, Counters, SharedCounters, CounterCache, TableVersions, FragmentCache
+from storage import TunedSQLAlchemy, ReadSession, SQLITE_PRAGMAS, database_uri, engine_options, bulk_insert
+from product_import import import_products, read_rows, error_file_writer
+from export import stream_rows, csv_stream, xlsx_stream
+from migrations import migrate
+from reports import LOW_STOCK_QUANTITY, stock_valuation, low_stock, purchase_variance, balance_brackets
+from passwords import PasswordHasher, PasswordCheckBusy
+from instrumentation import Instrumentation
+from api_payload import compact_json, batch_items, clean_product, clean_product_update, clean_customer, clean_line
+from jobs import JobQueue, JobFailed
+from change_feed import ChangeFeed
+from assets import Assets, build_assets
+import click
+import functools
+import hashlib
+import itertools
+import json
+import os
+import time
+import uuid
 
 app = Flask(__name__) # '__main__ or app'
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
+# database from the environment, DATABASE_URL falls back to the bundled sqlite file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(os.environ.get('DATABASE_URL', 'sqlite:///db.sqlite'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'etoaysekretolamang'
-
-db = SQLAlchemy(app)
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+# extra sqlalchemy create_engine() arguments as json, e.g. {"echo": true}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+    app.config['DATABASE_POOL_SIZE'], app.config['DATABASE_MAX_OVERFLOW'],
+    **json.loads(os.environ.get('DATABASE_ENGINE_OPTIONS', '{}')))
+# optional read replica for the read only routes
+app.config['DATABASE_READ_URL'] = os.environ.get('DATABASE_READ_URL')
+app.config['DATABASE_READ_POOL_SIZE'] = int(os.environ.get('DATABASE_READ_POOL_SIZE', 5))
+# storage profile applied on every sqlite connection, see storage.py
+app.config['SQLITE_PRAGMAS'] = SQLITE_PRAGMAS
+
+# max number of ids per IN (...), older sqlite builds only allow 999 bound parameters
+IN_CLAUSE_SIZE = 900
+# rows per page of the product and customer listings
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# rows per insert of the product import and max rejected rows returned by the import job
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_REPORTED_ERRORS = 1000
+# product ids per INSERT ... SELECT of a load products job, the progress is committed after each
+LOAD_CHUNK_SIZE = 10000
+# dashboard counters and the table change counters, in memory per process. COUNTER_CACHE_SHARED=1
+# keeps them in the cache_counter table so every gunicorn worker and job process sees the writes
+# of the others, the counts read from it are kept COUNTER_CACHE_LOCAL_TTL seconds in the process
+app.config['COUNTER_CACHE_TTL'] = 300
+app.config['COUNTER_CACHE_SHARED'] = os.environ.get('COUNTER_CACHE_SHARED', '') == '1'
+app.config['COUNTER_CACHE_LOCAL_TTL'] = int(os.environ.get('COUNTER_CACHE_LOCAL_TTL', 5))
+# rendered product, adjustment and purchase tables kept in memory per worker process, max
+# characters of html. A fragment is rendered again once its tables changed, in any process
+# with COUNTER_CACHE_SHARED
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 64 * 1024 * 1024))
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+# signed in users kept in memory by load_user, per worker process
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+# password hash cost, existing hashes are upgraded on the next sign in when these change
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+app.config['PASSWORD_HASH_ITERATIONS'] = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 150000))
+# threads checking passwords and how many checks may wait for them
+app.config['PASSWORD_CHECK_WORKERS'] = int(os.environ.get('PASSWORD_CHECK_WORKERS', 2))
+app.config['PASSWORD_CHECK_MAX_PENDING'] = int(os.environ.get('PASSWORD_CHECK_MAX_PENDING', 32))
+# json api, seconds a token of /api/v1/token stays valid and max rows of a batch call
+app.config['API_TOKEN_MAX_AGE'] = int(os.environ.get('API_TOKEN_MAX_AGE', 24 * 3600))
+app.config['API_MAX_BATCH_SIZE'] = int(os.environ.get('API_MAX_BATCH_SIZE', 10000))
+# statements slower than this are logged without their parameters, SERVER_TIMING=1 adds the
+# Server-Timing header with the database and template time of every response
+app.config['SLOW_QUERY_SECONDS'] = float(os.environ.get('SLOW_QUERY_SECONDS', 0.1))
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '') == '1'
+# bearer token of the prometheus scraper, /metrics is not served without it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# load products, apply and import run as background jobs, see jobs.py. Every web worker process
+# runs JOB_WORKER_THREADS threads, set it to 0 when `flask run-jobs` processes do the work.
+# A job not finished or renewed within JOB_LEASE_SECONDS is given to another worker
+app.config['JOB_WORKER_THREADS'] = int(os.environ.get('JOB_WORKER_THREADS', 1))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+app.config['JOB_LEASE_SECONDS'] = int(os.environ.get('JOB_LEASE_SECONDS', 600))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# uploaded import files wait here for their job, on a disk every worker can read
+app.config['JOB_FILES_PATH'] = os.environ.get('JOB_FILES_PATH', os.path.join(app.root_path, 'job_files'))
+# JOBS_EAGER=1 runs the jobs inside the request that submits them, for scripts and debugging
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '') == '1'
+# the open pages get the new quantities over /stream/products, every worker process reads the
+# stock ledger once per CHANGE_FEED_INTERVAL seconds while it has a stream open. A stream sends a
+# comment every STREAM_HEARTBEAT_SECONDS and ends after STREAM_MAX_SECONDS, the browser reconnects
+app.config['CHANGE_FEED_INTERVAL'] = float(os.environ.get('CHANGE_FEED_INTERVAL', 0.5))
+app.config['STREAM_HEARTBEAT_SECONDS'] = int(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+app.config['STREAM_MAX_SECONDS'] = int(os.environ.get('STREAM_MAX_SECONDS', 600))
+# open streams per worker process, each holds a gunicorn thread. Keep it below GUNICORN_THREADS
+# so the pages are still served, the browsers past it try again later
+app.config['STREAM_MAX_OPEN'] = int(os.environ.get('STREAM_MAX_OPEN', 8))
+# the pages load the bundles built by `flask build-assets`, ASSETS_DEBUG=1 loads the source files
+app.config['ASSETS_DEBUG'] = os.environ.get('ASSETS_DEBUG', '') == '1'
+
+db = TunedSQLAlchemy(app)
+# read only routes query through read_session
+read_session = ReadSession(db)
 login_manager = LoginManager()
 login_manager.init_app(app)
+# per route timing and sql counts, served at /metrics to the holder of METRICS_TOKEN
+instrumentation = Instrumentation(app)
+# minified, hashed and compressed static files, see assets.py
+assets = Assets(app)
+
+user_cache = TTLCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    iterations=app.config['PASSWORD_HASH_ITERATIONS'],
+    workers=app.config['PASSWORD_CHECK_WORKERS'],
+    max_pending=app.config['PASSWORD_CHECK_MAX_PENDING']
+)
 
 
 class User(db.Model, UserMixin):
@@ -23,10 +133,20 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(200))
 
     def hash_password(self, password):
-        self.password = generate_password_hash(password)
+        # runs on the password pool too, raises PasswordCheckBusy when it is full
+        self.password = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        # runs on the password check pool, raises PasswordCheckBusy when it is full
+        return password_hasher.check(self.password, password)
+
+class SessionUser(UserMixin):
+    # what the requests need of the signed in user, cached between requests by load_user
+    # token_key changes with the password so a password change revokes the api tokens
+    def __init__(self, id, username, token_key):
+        self.id = id
+        self.username = username
+        self.token_key = token_key
 
 class Product(db.Model):
     __tablename__ = 'product'
@@ -39,6 +159,16 @@ class Product(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     adjustment_line = db.relationship('AdjustmentDetail',backref='adjustment_detail')
     purchase_line = db.relationship('PurchaseDetail',backref='purchase_detail')
+    # optimistic locking, bumped on every update and checked by the UPDATE's WHERE clause
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    # the product listing pages through (updated_at, id), the reports read the
+    # quantities and values from the other two
+    __table_args__ = (
+        db.Index('ix_product_updated_at_id', 'updated_at', 'id'),
+        db.Index('ix_product_quantity_price', 'quantity', 'price'),
+        db.Index('ix_product_value', quantity * price),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
 
     def check_fields(self, mode):
         error_list = []
@@ -65,6 +195,7 @@ class AdjustmentHeader(db.Model):
     __tablename__ = 'adjustment_header'
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(30))
+    status = db.Column(db.String(30))
     adjustment_details = db.relationship('AdjustmentDetail', backref='adjustment_reference')
 
 class AdjustmentDetail(db.Model):
@@ -73,6 +204,15 @@ class AdjustmentDetail(db.Model):
     quantity_adjust = db.Column(db.Integer)
     adjustment_header_id = db.Column(db.Integer, db.ForeignKey('adjustment_header.id'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    # optimistic locking, bumped on every update and checked by the UPDATE's WHERE clause
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    # lines of a document and the product already loaded check of load_products(),
+    # the lines of a product when it is deleted
+    __table_args__ = (
+        db.Index('ix_adjustment_detail_header_id_product_id', 'adjustment_header_id', 'product_id'),
+        db.Index('ix_adjustment_detail_product_id', 'product_id'),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
 
 class PurchaseHeader(db.Model):
     __tablename__ = 'purchase_header'
@@ -88,6 +228,16 @@ class PurchaseDetail(db.Model):
     quantity_receive = db.Column(db.Integer)
     purchase_header_id = db.Column(db.Integer, db.ForeignKey('purchase_header.id'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    # optimistic locking, bumped on every update and checked by the UPDATE's WHERE clause
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    # lines of a document and the product already loaded check of load_products(),
+    # the quantities per document of the variance report and the lines of a product when it is deleted
+    __table_args__ = (
+        db.Index('ix_purchase_detail_header_id_product_id', 'purchase_header_id', 'product_id'),
+        db.Index('ix_purchase_detail_header_id_quantities', 'purchase_header_id', 'quantity_purchase', 'quantity_receive'),
+        db.Index('ix_purchase_detail_product_id', 'product_id'),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
 
 class Customer(db.Model):
     __tablename__ = 'customer'
@@ -95,10 +245,617 @@ class Customer(db.Model):
     fullname = db.Column(db.String(50))
     balance = db.Column(db.Float)
     remarks = db.Column(db.String(50))
+    # optimistic locking, bumped on every update and checked by the UPDATE's WHERE clause
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+    # balance brackets of the reports
+    __table_args__ = (db.Index('ix_customer_balance', 'balance'),)
+    __mapper_args__ = {'version_id_col': version_id}
+
+class StockMovement(db.Model):
+    # append only history of every change to Product.quantity
+    # the sum of the movements of a product is its quantity on hand
+    __tablename__ = 'stock_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer)
+    # opening, adjustment, purchase or edit
+    movement_type = db.Column(db.String(20))
+    # the adjustment or purchase line that made the movement
+    reference_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # product history newest first
+    __table_args__ = (db.Index('ix_stock_movement_product_id_id', 'product_id', 'id'),)
+
+class CacheCounter(db.Model):
+    # row counts of the dashboard and change counters of the tables, see cache.py
+    __tablename__ = 'cache_counter'
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+    # time.time() of the last set, row counts older than COUNTER_CACHE_TTL are counted again
+    set_at = db.Column(db.Float)
+
+class Job(db.Model):
+    # load products, apply and import jobs, run by the workers of jobs.py
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30))
+    # keyword arguments of the handler as json
+    params = db.Column(db.Text)
+    # queued, running, done, failed or cancelled
+    status = db.Column(db.String(20))
+    # set while the job is queued or running, the same operation can't be queued twice
+    active_key = db.Column(db.String(100), unique=True)
+    attempts = db.Column(db.Integer)
+    progress_done = db.Column(db.Integer)
+    progress_total = db.Column(db.Integer)
+    message = db.Column(db.String(200))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean)
+    # the worker running the job and until when it holds it
+    worker = db.Column(db.String(100))
+    lease_until = db.Column(db.DateTime)
+    run_after = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # next queued job to claim and the running jobs with an expired lease
+    __table_args__ = (db.Index('ix_job_status_run_after_id', 'status', 'run_after', 'id'),)
+
+# the row counts and the table change counters, the shared ones read on the connection of read_session
+if app.config['COUNTER_CACHE_SHARED']:
+    counters = SharedCounters(CacheCounter.__table__, lambda: db.engine, lambda: read_session().connection())
+else:
+    counters = Counters()
+counter_cache = CounterCache(counters, ttl=app.config['COUNTER_CACHE_TTL'],
+    local_ttl=app.config['COUNTER_CACHE_LOCAL_TTL'])
+# every transaction that writes through the engines bumps the counters of its tables, but for
+# the job queue which is written on every progress update and never cached
+table_versions = TableVersions(counters, untracked=(Job.__tablename__,))
+table_versions.track()
+fragment_cache = FragmentCache(table_versions,
+    max_size=app.config['FRAGMENT_CACHE_SIZE'], ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+job_queue = JobQueue(db.session, Job.__table__,
+    lease_seconds=app.config['JOB_LEASE_SECONDS'], max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+
+def product_changes(after=None):
+    # the quantity of the products moved after the stock movement id `after`, with the last id
+    # every write to Product.quantity adds a movement so the ledger is the feed of changes
+    movement = StockMovement.__table__
+    product = Product.__table__
+    with read_session.get_engine().connect() as connection:
+        last_id = connection.execute(select([func.max(movement.c.id)])).scalar() or 0
+        if after is None or last_id <= after:
+            return last_id, {}
+        moved = select([movement.c.product_id]).where(movement.c.id > after).where(movement.c.id <= last_id)
+        # a product deleted since is sent without a quantity
+        changes = {product_id: None for (product_id,) in connection.execute(moved.distinct())}
+        changes.update({product_id: quantity for product_id, quantity in
+            connection.execute(select([product.c.id, product.c.quantity]).where(product.c.id.in_(moved)))})
+    return last_id, changes
+
+change_feed = ChangeFeed(product_changes, interval=app.config['CHANGE_FEED_INTERVAL'],
+    max_streams=app.config['STREAM_MAX_OPEN'])
+
+def load_products(detail_model, header_column, header_id, chunk_size=None, on_chunk=None, **defaults):
+    # add a line to the document for every product that is not loaded in it yet
+    # one INSERT ... SELECT with an anti-join, committed once
+    # NOT IN lets sqlite build the loaded product ids into a temporary index once
+    # with a chunk_size the products are loaded chunk_size ids at a time, each chunk committed on
+    # its own. on_chunk(done, total) is called with the chunk still open and commits it, along
+    # with what it writes in the session. Running it again only adds what is still missing
+    start = time.perf_counter()
+    detail_table = detail_model.__table__
+    columns = list(defaults) + [header_column, 'product_id']
+    loaded_products = select([detail_table.c.product_id]).where(detail_table.c[header_column] == header_id) \
+        .where(detail_table.c.product_id != None)
+    missing_products = select(
+            [literal(value) for value in defaults.values()] + [literal(header_id), Product.id])
+    if chunk_size is None:
+        ranges = [None]
+    else:
+        first_id, last_id = db.session.query(func.min(Product.id), func.max(Product.id)).one()
+        ranges = [(low, min(low + chunk_size - 1, last_id)) for low in range(first_id, last_id + 1, chunk_size)] \
+            if first_id is not None else []
+    line_count = 0
+    for done, id_range in enumerate(ranges, start=1):
+        chunk = missing_products.where(Product.id.notin_(loaded_products))
+        if id_range is not None:
+            chunk = missing_products.where(Product.id.between(*id_range)).where(Product.id.notin_(
+                loaded_products.where(detail_table.c.product_id.between(*id_range))))
+        result = db.session.execute(detail_table.insert().from_select(columns, chunk))
+        if on_chunk:
+            on_chunk(done, len(ranges))
+        else:
+            db.session.commit()
+        line_count += result.rowcount
+        counter_cache.incr(detail_table.name, result.rowcount)
+    elapsed = time.perf_counter() - start
+    app.logger.info('%s: loaded %s lines in %.3fs', detail_table.name, line_count, elapsed)
+    return line_count, elapsed
+
+def chunks(items, size=IN_CLAUSE_SIZE):
+    # split a list so an IN (...) stays below sqlite's bound parameter limit
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+def existing_ids(column, ids, *criteria):
+    # return the ids that exist in the table of the given id column, criteria narrow the rows down
+    # the ids are passed as an expanding bindparam, building one clause per id is slow
+    found = set()
+    for id_chunk in chunks(ids):
+        found.update(row[0] for row in db.session.query(column).filter(*criteria)
+            .filter(column.in_(bindparam('ids', expanding=True))).params(ids=id_chunk))
+    return found
+
+def row_versions(model, ids, *criteria):
+    # { id: version id } of the rows that exist, criteria narrow the rows down
+    versions = {}
+    for id_chunk in chunks(ids):
+        versions.update(db.session.query(model.id, model.version_id).filter(*criteria)
+            .filter(model.id.in_(bindparam('ids', expanding=True))).params(ids=id_chunk))
+    return versions
+
+def update_versioned(table, rows, **values):
+    # batched UPDATE of the rows {line_id, version, ...} that still have the version they were read with,
+    # the version is bumped. A row changed by someone else in between matches nothing and
+    # StaleDataError is raised, the caller rolls the whole transaction back
+    if not rows:
+        return
+    result = db.session.execute(
+        table.update()
+            .where(table.c.id == bindparam('line_id'))
+            .where(table.c.version_id == bindparam('version'))
+            .values(version_id=table.c.version_id + 1, **values),
+        rows
+    )
+    if result.supports_sane_multi_rowcount() and result.rowcount != len(rows):
+        raise StaleDataError(f'{table.name}: {len(rows) - result.rowcount} of {len(rows)} rows were changed by another user')
+
+def save_adjustment(adjustment_header_id, adj_quantities, line_versions=None):
+    # write the new quantity of every adjustment line with one batched UPDATE
+    # line_versions are the versions the worksheet was rendered with, stale lines raise StaleDataError
+    line_versions = line_versions or {}
+    adj_table = AdjustmentDetail.__table__
+    adj_versions = row_versions(AdjustmentDetail, adj_quantities,
+        AdjustmentDetail.adjustment_header_id == adjustment_header_id)
+    update_versioned(adj_table,
+        [{'line_id': adj_id, 'version': line_versions.get(adj_id, version), 'quantity': adj_quantities[adj_id]}
+            for adj_id, version in adj_versions.items()],
+        quantity_adjust=bindparam('quantity'))
+    db.session.commit()
+
+def record_opening_balances(product_ids=None):
+    # the first movement of a product is the quantity it had before the ledger knew about it,
+    # added the first time the product is changed so the ledger always sums up to the quantity
+    # this is also the first write of every stock transaction, sqlite takes the write lock here
+    # so the quantities read after it can't change before the transaction commits
+    movement_table = StockMovement.__table__
+    openings = select([
+            Product.id,
+            func.coalesce(Product.quantity, 0),
+            literal('opening'),
+            literal(datetime.utcnow(), db.DateTime)
+        ]).where(~exists().where(movement_table.c.product_id == Product.id))
+    columns = ['product_id', 'quantity', 'movement_type', 'created_at']
+    if product_ids is None:
+        db.session.execute(movement_table.insert().from_select(columns, openings))
+        return
+    openings = openings.where(Product.id.in_(bindparam('ids', expanding=True)))
+    for id_chunk in chunks(product_ids):
+        db.session.execute(movement_table.insert().from_select(columns, openings), {'ids': id_chunk})
+
+def record_stock_movements(movements, movement_type):
+    # append movements {product_id, change, reference_id} to the ledger, caller commits
+    if movements:
+        db.session.execute(StockMovement.__table__.insert(), [{
+                'product_id': movement['product_id'],
+                'quantity': movement['change'],
+                'movement_type': movement_type,
+                'reference_id': movement['reference_id'],
+                'created_at': datetime.utcnow()
+            } for movement in movements])
+
+def apply_stock_movements(movements, movement_type):
+    # record the movements and add them to the products with UPDATE ... SET quantity = quantity + ?
+    # no read-modify-write in python so concurrent workers can't lose an update, caller commits
+    # the version is bumped so a product form opened before can't overwrite the new quantity
+    prod_table = Product.__table__
+    record_stock_movements(movements, movement_type)
+    if movements:
+        db.session.execute(
+            prod_table.update()
+                .where(prod_table.c.id == bindparam('product_id'))
+                .values(quantity=func.coalesce(prod_table.c.quantity, 0) + bindparam('change'),
+                    version_id=prod_table.c.version_id + 1),
+            movements
+        )
+
+def on_hand_quantities(product_ids):
+    # current quantity of the products, locked until commit where the database supports it
+    quantities = {}
+    for id_chunk in chunks(product_ids):
+        quantities.update(db.session.query(Product.id, Product.quantity)
+            .filter(Product.id.in_(bindparam('ids', expanding=True))).params(ids=id_chunk)
+            .with_for_update())
+    return quantities
+
+def apply_adjustment(adjustment_header_id, adj_quantities, line_versions=None):
+    # set the product quantity to the adjusted quantity and reset the applied lines
+    # every line of the document is applied, adj_quantities are the quantities changed on screen
+    # and the other lines keep their saved quantity
+    # everything is applied in a single transaction or not at all, stale lines raise StaleDataError
+    # caller commits
+    line_versions = line_versions or {}
+    adj_table = AdjustmentDetail.__table__
+    adj_products = {}
+    for adj_id, prod_id, quantity_adjust, version in db.session.query(
+                AdjustmentDetail.id, AdjustmentDetail.product_id, AdjustmentDetail.quantity_adjust, AdjustmentDetail.version_id) \
+            .filter(AdjustmentDetail.adjustment_header_id == adjustment_header_id):
+        adj_products[adj_id] = (prod_id, adj_quantities.get(adj_id, quantity_adjust or 0), version)
+    prod_ids = existing_ids(Product.id, {prod_id for prod_id, quantity, version in adj_products.values()})
+
+    applied_lines = [{'line_id': adj_id, 'product_id': prod_id, 'quantity': quantity,
+            'version': line_versions.get(adj_id, version)}
+        for adj_id, (prod_id, quantity, version) in sorted(adj_products.items()) if prod_id in prod_ids]
+    # lines without a product keeps the quantity entered on screen
+    unapplied_lines = [{'line_id': adj_id, 'quantity': quantity,
+            'version': line_versions.get(adj_id, version)}
+        for adj_id, (prod_id, quantity, version) in adj_products.items() if prod_id not in prod_ids]
+
+    # the lines are written first so a stale worksheet fails before any product is touched
+    update_versioned(adj_table, applied_lines, quantity_adjust=0)
+    update_versioned(adj_table, unapplied_lines, quantity_adjust=bindparam('quantity'))
+    if applied_lines:
+        record_opening_balances(prod_ids)
+        # the counted quantity replaces the quantity on hand, the ledger gets the difference
+        on_hand = on_hand_quantities(prod_ids)
+        movements = []
+        for line in applied_lines:
+            change = line['quantity'] - (on_hand[line['product_id']] or 0)
+            on_hand[line['product_id']] = line['quantity']
+            if change:
+                movements.append({'product_id': line['product_id'], 'change': change, 'reference_id': line['line_id']})
+        apply_stock_movements(movements, 'adjustment')
+
+def purchase_line_products(purchase_header_id, line_ids=None):
+    # { purchase line id: (product id, stored receive quantity, version) } of the lines that still have their product
+    # every line of the document when line_ids is None
+    query = db.session.query(PurchaseDetail.id, PurchaseDetail.product_id, PurchaseDetail.quantity_receive,
+            PurchaseDetail.version_id) \
+        .join(Product, PurchaseDetail.product_id == Product.id) \
+        .filter(PurchaseDetail.purchase_header_id == purchase_header_id)
+    if line_ids is None:
+        return {line_id: (prod_id, quantity_receive, version) for line_id, prod_id, quantity_receive, version in query}
+    line_products = {}
+    for line_chunk in chunks(line_ids):
+        line_products.update((line_id, (prod_id, quantity_receive, version)) for line_id, prod_id, quantity_receive, version in
+            query.filter(PurchaseDetail.id.in_(bindparam('ids', expanding=True))).params(ids=line_chunk))
+    return line_products
+
+def save_purchase(purchase_header_id, purch_lines, line_versions=None):
+    # write the posted purchase and receive quantities with one batched UPDATE, caller commits
+    # line_versions are the versions the worksheet was rendered with, stale lines raise StaleDataError
+    line_versions = line_versions or {}
+    purch_table = PurchaseDetail.__table__
+    update_versioned(purch_table,
+        [{'line_id': line_id, 'version': line_versions.get(line_id, version),
+                'purchase': purch_lines[line_id].purch_qty, 'receive': purch_lines[line_id].receive_qty}
+            for line_id, (prod_id, quantity_receive, version)
+            in purchase_line_products(purchase_header_id, purch_lines).items()],
+        quantity_purchase=bindparam('purchase'), quantity_receive=bindparam('receive'))
+
+def apply_purchase(purchase_header_id):
+    # add the saved receive quantities of every line to the products and reset the purchase lines, caller commits
+    purch_table = PurchaseDetail.__table__
+    line_products = purchase_line_products(purchase_header_id)
+    if not line_products:
+        return
+    update_versioned(purch_table,
+        [{'line_id': line_id, 'version': version} for line_id, (prod_id, quantity_receive, version) in line_products.items()],
+        quantity_purchase=0, quantity_receive=0)
+    record_opening_balances({prod_id for prod_id, quantity_receive, version in line_products.values()})
+    apply_stock_movements([{'product_id': prod_id, 'change': quantity_receive, 'reference_id': line_id}
+        for line_id, (prod_id, quantity_receive, version) in sorted(line_products.items()) if quantity_receive], 'purchase')
+
+def rebuild_on_hand():
+    # recompute every Product.quantity from the ledger in a single UPDATE
+    movement_table = StockMovement.__table__
+    prod_table = Product.__table__
+    record_opening_balances()
+    ledger_quantity = select([func.coalesce(func.sum(movement_table.c.quantity), 0)]) \
+        .where(movement_table.c.product_id == prod_table.c.id).as_scalar()
+    result = db.session.execute(prod_table.update().values(quantity=ledger_quantity,
+        version_id=prod_table.c.version_id + 1))
+    db.session.commit()
+    return result.rowcount
+
+# documents a load products job fills: detail model, header column and the quantities of a new line
+LOAD_DOCUMENTS = {
+    'adjustment': (AdjustmentDetail, 'adjustment_header_id', {'quantity_adjust': 0}),
+    'purchase': (PurchaseDetail, 'purchase_header_id', {'quantity_purchase': 0, 'quantity_receive': 0}),
+}
+
+@job_queue.handler('load_products')
+def load_products_job(job, document, header_id):
+    detail_model, header_column, defaults = LOAD_DOCUMENTS[document]
+    line_count, elapsed = load_products(detail_model, header_column, header_id,
+        chunk_size=LOAD_CHUNK_SIZE, on_chunk=job.progress, **defaults)
+    return {'message': f'All the products has been loaded! ({line_count} lines added in {elapsed:.2f}s)',
+        'lines': line_count}
+
+@job_queue.handler('apply_adjustment')
+def apply_adjustment_job(job, header_id, quantities, versions):
+    # quantities and versions are [line id, value] pairs, json objects only have string keys
+    # the status is set by an UPDATE that skips an applied header, the first write of the
+    # transaction, so a second apply or a retry of an applied adjustment stops here
+    header_table = AdjustmentHeader.__table__
+    if AdjustmentHeader.query.get(header_id) is None:
+        raise JobFailed('Stock adjustment not found!')
+    result = db.session.execute(header_table.update()
+        .where(header_table.c.id == header_id)
+        .where(or_(header_table.c.status.is_(None), header_table.c.status != 'Applied'))
+        .values(status='Applied'))
+    if result.rowcount != 1:
+        raise JobFailed('Adjustment has already been Applied!')
+    try:
+        apply_adjustment(header_id, dict(quantities), dict(versions))
+    except StaleDataError:
+        raise JobFailed('Lines were changed by another user, nothing has been saved. Please enter your changes again.')
+    return {'message': 'Adjustment has been Applied!'}
+
+@job_queue.handler('apply_purchase')
+def apply_purchase_job(job, header_id):
+    # the status goes back to New in the same transaction by an UPDATE of a Received header only,
+    # a second apply or a retry of an applied purchase stops here
+    header_table = PurchaseHeader.__table__
+    result = db.session.execute(header_table.update()
+        .where(header_table.c.id == header_id)
+        .where(header_table.c.status == 'Received')
+        .values(status='New'))
+    if result.rowcount != 1:
+        raise JobFailed('Unable to apply purchase, please contact administrator!')
+    try:
+        apply_purchase(header_id)
+    except StaleDataError:
+        raise JobFailed('Lines were changed by another user, nothing has been saved. Please enter your changes again.')
+    return {'message': 'Purchase complete!'}
+
+@job_queue.handler('import_products')
+def import_products_job(job, path, file_format):
+    # a retry skips the rows read by the chunks committed before, the progress of a chunk is written
+    # on the import's connection and committed with it. The file is removed once imported,
+    # only the first IMPORT_MAX_REPORTED_ERRORS rejected rows are kept in the result
+    skipped = job.done
+    error_rows = []
+    def report_error(row_error):
+        if len(error_rows) < IMPORT_MAX_REPORTED_ERRORS:
+            error_rows.append(row_error._asdict())
+
+    def report_progress(progress):
+        job.progress(skipped + progress.read,
+            message=f'{skipped + progress.read} rows read, {progress.inserted} imported, {progress.errors} rejected',
+            connection=connection)
+
+    with open(path, newline='', encoding='utf-8-sig') as stream, db.engine.connect() as connection:
+        rows = itertools.islice(read_rows(stream, file_format), skipped, None)
+        result = import_products(connection, Product.__table__, rows,
+            chunk_size=IMPORT_CHUNK_SIZE, on_error=report_error, on_progress=report_progress)
+    counter_cache.incr('product', result.inserted)
+    os.remove(path)
+    return {
+        'message': f'{result.inserted} products imported, {result.errors} rows rejected',
+        'read': skipped + result.read,
+        'inserted': result.inserted,
+        'errors': result.errors,
+        'elapsed': round(result.elapsed, 3),
+        'error_rows': error_rows
+    }
+
+def submit_job(kind, params, key, queued_message):
+    # queue a job for the page that posted, run right away with JOBS_EAGER
+    # returns (job id while it runs, message, css class)
+    job_id = job_queue.submit(kind, params, key=key)
+    if app.config['JOBS_EAGER']:
+        job_queue.run_now(job_id)
+    job = job_queue.get(job_id)
+    if job['status'] == 'done':
+        return None, job['result']['message'], 'alert-success'
+    if job['finished']:
+        return None, job['error'] or job['message'], 'alert-danger'
+    return job_id, queued_message, 'alert-info'
+
+def stock_history(product_id, after=None, limit=PAGE_SIZE):
+    # movements of a product newest first, keyset paged on the movement id
+    query = read_session.query(
+            StockMovement.id,
+            StockMovement.quantity,
+            StockMovement.movement_type,
+            StockMovement.reference_id,
+            StockMovement.created_at
+        ).filter(StockMovement.product_id == product_id)
+    if after is not None:
+        query = query.filter(StockMovement.id < after)
+    rows = query.order_by(StockMovement.id.desc()).limit(limit + 1).all()
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_page = str(rows[-1].id)
+    return rows, next_page
+
+def adjustment_documents():
+    # every adjustment document with its number of lines, newest first
+    return read_session.query(
+            AdjustmentHeader.id,
+            AdjustmentHeader.description,
+            AdjustmentHeader.status,
+            func.count(AdjustmentDetail.id).label('line_count')
+        ).outerjoin(AdjustmentDetail, AdjustmentDetail.adjustment_header_id == AdjustmentHeader.id) \
+        .group_by(AdjustmentHeader.id, AdjustmentHeader.description, AdjustmentHeader.status) \
+        .order_by(AdjustmentHeader.id.desc()).all()
+
+def purchase_documents():
+    # every purchase document with its number of lines, newest first
+    return read_session.query(
+            PurchaseHeader.id,
+            PurchaseHeader.description,
+            PurchaseHeader.status,
+            func.count(PurchaseDetail.id).label('line_count')
+        ).outerjoin(PurchaseDetail, PurchaseDetail.purchase_header_id == PurchaseHeader.id) \
+        .group_by(PurchaseHeader.id, PurchaseHeader.description, PurchaseHeader.status) \
+        .order_by(PurchaseHeader.id.desc()).all()
+
+def adjustment_lines(adjustment_header_id):
+    # the adjustment worksheet rows with their product in a single query
+    # read on its own connection so a cached page never shows uncommitted quantities
+    return read_session.query(
+            AdjustmentDetail.id,
+            AdjustmentDetail.quantity_adjust,
+            AdjustmentDetail.version_id,
+            AdjustmentDetail.product_id,
+            Product.code,
+            Product.name,
+            Product.quantity
+        ).outerjoin(Product, AdjustmentDetail.product_id == Product.id) \
+        .filter(AdjustmentDetail.adjustment_header_id == adjustment_header_id) \
+        .order_by(AdjustmentDetail.id).all()
+
+def purchase_lines(purchase_header_id):
+    # the purchase worksheet rows with their product in a single query
+    # read on its own connection so a cached page never shows uncommitted quantities
+    return read_session.query(
+            PurchaseDetail.id,
+            PurchaseDetail.quantity_purchase,
+            PurchaseDetail.quantity_receive,
+            PurchaseDetail.version_id,
+            PurchaseDetail.product_id,
+            Product.code,
+            Product.name,
+            Product.quantity
+        ).outerjoin(Product, PurchaseDetail.product_id == Product.id) \
+        .filter(PurchaseDetail.purchase_header_id == purchase_header_id) \
+        .order_by(PurchaseDetail.id).all()
+
+def adjustment_rows(adjustment_header_id):
+    # the rendered rows of the adjustment worksheet, rendered again after a write to its lines or the products
+    return fragment_cache.get('adjustment_rows', ('adjustment_detail', 'product'), adjustment_header_id,
+        lambda: Markup(render_template('includes/adjustment_rows.html',
+            adjustment_lines=adjustment_lines(adjustment_header_id))))
+
+def purchase_rows(purchase_header_id, receive_field_state, purchase_field_state):
+    # the rendered rows of the purchase worksheet, the field states follow the document status
+    return fragment_cache.get('purchase_rows', ('purchase_detail', 'product'),
+        (purchase_header_id, receive_field_state, purchase_field_state),
+        lambda: Markup(render_template('includes/purchase_rows.html',
+            purchase_lines=purchase_lines(purchase_header_id),
+            receive_field_state=receive_field_state,
+            purchase_field_state=purchase_field_state)))
+
+def page_size():
+    # number of rows asked for by the listing, bounded to MAX_PAGE_SIZE
+    limit = request.args.get('limit', '')
+    if not limit.isdigit() or int(limit) == 0:
+        return PAGE_SIZE
+    return min(int(limit), MAX_PAGE_SIZE)
+
+def like_pattern(search, prefix_only=False):
+    # escape the LIKE wildcards typed by the user
+    search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{search}%' if prefix_only else f'%{search}%'
+
+def product_page(search='', after=None, limit=PAGE_SIZE):
+    # one page of products, newest first, starting after the (updated_at, id) cursor
+    # a core select, the rows are plain tuples that never go through the ORM
+    query = select([
+            Product.id,
+            Product.code,
+            Product.name,
+            Product.quantity,
+            Product.price,
+            Product.created_at,
+            Product.updated_at,
+            Product.version_id
+        ])
+    if search:
+        query = query.where(or_(
+            Product.code.ilike(like_pattern(search, prefix_only=True), escape='\\'),
+            Product.name.ilike(like_pattern(search), escape='\\')
+        ))
+    if after:
+        try:
+            updated_at, product_id = after.rsplit('_', 1)
+            cursor = (datetime.fromisoformat(updated_at), int(product_id))
+        except ValueError:
+            abort(400)
+        query = query.where(tuple_(Product.updated_at, Product.id) <
+            tuple_(literal(cursor[0], db.DateTime), literal(cursor[1], db.Integer)))
+    rows = read_session().execute(
+        query.order_by(Product.updated_at.desc(), Product.id.desc()).limit(limit + 1)).fetchall()
+
+    # the extra row tells if there is a next page
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_page = f'{rows[-1].updated_at.isoformat()}_{rows[-1].id}'
+    return rows, next_page
+
+def customer_page(search='', after=None, limit=PAGE_SIZE):
+    # one page of customers in id order, starting after the id cursor
+    query = select([
+            Customer.id,
+            Customer.fullname,
+            Customer.balance,
+            Customer.remarks,
+            Customer.version_id
+        ])
+    if search:
+        query = query.where(Customer.fullname.ilike(like_pattern(search), escape='\\'))
+    if after:
+        if not after.isdigit():
+            abort(400)
+        query = query.where(Customer.id > int(after))
+    rows = read_session().execute(query.order_by(Customer.id).limit(limit + 1)).fetchall()
+
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_page = str(rows[-1].id)
+    return rows, next_page
+
+def product_table(search='', after=None, limit=PAGE_SIZE):
+    # the rendered product listing with its Load More button
+    def render():
+        all_products, next_page = product_page(search, after, limit)
+        return Markup(render_template('includes/product_table.html',
+            all_products=all_products, next_page=next_page, search=search))
+    return fragment_cache.get('product_table', ('product',), (search, after, limit), render)
+
+@app.teardown_appcontext
+def remove_read_session(exception=None):
+    read_session.remove()
+
+def password_token_key(pwhash):
+    # short digest of the password hash put in the api tokens
+    return hashlib.sha256(pwhash.encode()).hexdigest()[:16]
+
+def upgrade_password_hash(user, password):
+    # hashes made with older parameters are upgraded while the password is at hand,
+    # the hash runs on the password pool and raises PasswordCheckBusy when it is full
+    if password_hasher.needs_rehash(user.password):
+        user.hash_password(password=password)
+        db.session.commit()
+        user_cache.invalidate(user.id)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    def find_user():
+        user = read_session.query(User.id, User.username, User.password).filter(User.id == int(user_id)).first()
+        if user is None:
+            return None
+        return SessionUser(user.id, user.username, password_token_key(user.password))
+    return user_cache.get(int(user_id), find_user)
 
 @app.route('/')
 def index():
@@ -114,7 +871,14 @@ def signin():
         # query if the user is existing on db
         user = User.query.filter_by(username=username).first()
 
-        if user and user.check_password(password=password):
+        try:
+            valid_login = user and user.check_password(password=password)
+            if valid_login:
+                upgrade_password_hash(user, password)
+        except PasswordCheckBusy:
+            return render_template('index.html', message='Too many sign ins, please try again!'), 503
+
+        if valid_login:
             login_user(user)
             return redirect(url_for('home'))
         else:
@@ -124,17 +888,45 @@ def signin():
 @app.route('/home')
 @login_required
 def home():
-    prod_count = Product.query.count()
-    adj_count = AdjustmentDetail.query.count()
-    purch_count =  Customer.query.count()
-    cust_count = Customer.query.count()
-    return render_template('home.html', **locals())  
+    counts = counter_cache.get_many({
+        'product': read_session.query(Product).count,
+        'adjustment_detail': read_session.query(AdjustmentDetail).count,
+        'purchase_detail': read_session.query(PurchaseDetail).count,
+        'customer': read_session.query(Customer).count
+    })
+    return render_template('home.html', prod_count=counts['product'], adj_count=counts['adjustment_detail'],
+        purch_count=counts['purchase_detail'], cust_count=counts['customer'])
+
+@app.route('/home/stats')
+@login_required
+def home_stats():
+    return jsonify(dict(counter_cache.stats(), user_cache=user_cache.stats(), fragment_cache=fragment_cache.stats(),
+        job_queue=job_queue.stats(), change_feed=change_feed.stats()))
 
 @app.route('/customers')
 @login_required
 def customers():
-    all_customers = Customer.query.all()
-    return render_template('customers.html', all_customers=all_customers)  
+    search = request.args.get('q', '')
+    all_customers, next_page = customer_page(search, request.args.get('after'), page_size())
+    return render_template('customers.html', 
+            all_customers=all_customers,
+            next_page=next_page,
+            search=search
+        )  
+
+@app.route('/customers/page')
+@login_required
+def customers_page():
+    page, next_page = customer_page(request.args.get('q', ''), request.args.get('after'), page_size())
+    return jsonify(
+        items=[{
+            'id': customer.id,
+            'fullname': customer.fullname,
+            'balance': customer.balance,
+            'remarks': customer.remarks
+        } for customer in page],
+        next=next_page
+    )
 
 @app.route('/add_customer', methods=['POST', 'GET'])
 @login_required
@@ -153,6 +945,7 @@ def add_customer():
         new_customer = Customer(fullname=fullname, balance=balance, remarks=remarks)
         db.session.add(new_customer)
         db.session.commit()
+        counter_cache.incr('customer')
         message = f'Customer : {new_customer.fullname} added'
         css_class = 'alert-success'
         return render_template('add_customer.html', **locals())  
@@ -169,17 +962,30 @@ def edit_customer(id):
 
         if request.method == 'GET':
             fullname, balance, remarks = edit_customer.fullname, edit_customer.balance, edit_customer.remarks
+            version_id = edit_customer.version_id
             return render_template('edit_customer.html', **locals())  
         
         if request.method == 'POST':
             fullname = request.form['fullname']
             balance = request.form['balance']
             remarks = request.form['remarks']
+            # version of the customer when the form was loaded
+            version_id = request.form.get('version_id', edit_customer.version_id, type=int)
 
-            edit_customer.fullname, edit_customer.balance, edit_customer.remarks = fullname, balance, remarks
-            db.session.commit()
-            message = f'Customer : {edit_customer.fullname} updated'
-            css_class = 'alert-success'
+            try:
+                if version_id != edit_customer.version_id:
+                    raise StaleDataError(f'customer {edit_customer.id} changed since version {version_id}')
+                edit_customer.fullname, edit_customer.balance, edit_customer.remarks = fullname, balance, remarks
+                db.session.commit()
+                message = f'Customer : {edit_customer.fullname} updated'
+                css_class = 'alert-success'
+            except StaleDataError:
+                # show what the other user saved instead of overwriting it
+                db.session.rollback()
+                message = 'Customer was changed by another user, the latest values are shown. Please enter your changes again.'
+                css_class = 'alert-danger'
+                fullname, balance, remarks = edit_customer.fullname, edit_customer.balance, edit_customer.remarks
+            version_id = edit_customer.version_id
             return render_template('edit_customer.html', **locals())  
 
 @app.route('/delete_customer/<string:id>', methods=['POST'])
@@ -190,13 +996,49 @@ def delete_customer(id):
         if delete_customer:
             db.session.delete(delete_customer)
             db.session.commit()
+            counter_cache.incr('customer', -1)
             return redirect(url_for('customers'))
 
 @app.route('/products')
 @login_required
 def products():
-    all_products = Product.query.order_by(Product.updated_at.desc()).all()
-    return render_template('products.html', all_products=all_products)    
+    search = request.args.get('q', '')
+    return render_template('products.html', 
+            product_table=product_table(search, request.args.get('after'), page_size()),
+            search=search
+        )    
+
+@app.route('/products/page')
+@login_required
+def products_page():
+    page, next_page = product_page(request.args.get('q', ''), request.args.get('after'), page_size())
+    return jsonify(
+        items=[{
+            'id': product.id,
+            'code': product.code,
+            'name': product.name,
+            'quantity': product.quantity,
+            'price': product.price,
+            'created_at': product.created_at.strftime('%Y-%m-%d')
+        } for product in page],
+        next=next_page
+    )
+
+@app.route('/products/<int:id>/history')
+@login_required
+def product_history(id):
+    after = request.args.get('after', '')
+    movements, next_page = stock_history(id, int(after) if after.isdigit() else None, page_size())
+    return jsonify(
+        items=[{
+            'id': movement.id,
+            'quantity': movement.quantity,
+            'movement_type': movement.movement_type,
+            'reference_id': movement.reference_id,
+            'created_at': movement.created_at.isoformat()
+        } for movement in movements],
+        next=next_page
+    )
 
 @app.route('/add_product', methods=['POST', 'GET'])
 @login_required
@@ -223,6 +1065,7 @@ def add_product():
         else:
             db.session.add(new_product)
             db.session.commit()
+            counter_cache.incr('product')
             message = f'Product code: {new_product.code} added'
             css_class = 'alert-success'
             code, name, quantity, price = ('', '', '', '')
@@ -244,6 +1087,7 @@ def edit_product(id):
             name = edit_product.name
             quantity = edit_product.quantity
             price = edit_product.price
+            version_id = edit_product.version_id
             return render_template('edit_product.html', **locals()) 
 
         if request.method == 'POST':
@@ -252,6 +1096,8 @@ def edit_product(id):
             name = request.form['name']
             quantity = request.form['quantity']
             price = request.form['price']
+            # version of the product when the form was loaded
+            version_id = request.form.get('version_id', edit_product.version_id, type=int)
 
             # query if the product code is already existing 
             existing_product = Product.query.filter(Product.code==code, Product.id!=edit_product.id).count()
@@ -260,6 +1106,7 @@ def edit_product(id):
                 error_list = [f'Product code {edit_product.code} is already taken']
             else:
                 # save new values to the new product 
+                old_quantity = edit_product.quantity
                 edit_product.code = code
                 edit_product.name = name
                 edit_product.quantity = quantity
@@ -272,10 +1119,27 @@ def edit_product(id):
                 css_class = 'alert-danger'
                 return render_template('edit_product.html', **locals())  
             else:
-                # save to database 
-                db.session.commit()
-                message = f'Product code: {edit_product.code} updated'
-                css_class = 'alert-success'
+                try:
+                    # the product changed since the form was loaded
+                    if version_id != edit_product.version_id:
+                        raise StaleDataError(f'product {edit_product.id} changed since version {version_id}')
+                    # a changed quantity goes to the stock ledger
+                    if edit_product.quantity != old_quantity:
+                        record_opening_balances([edit_product.id])
+                        record_stock_movements([{'product_id': edit_product.id,
+                            'change': edit_product.quantity - (old_quantity or 0),
+                            'reference_id': None}], 'edit')
+                    # save to database, the UPDATE only matches the version that was read
+                    db.session.commit()
+                    message = f'Product code: {edit_product.code} updated'
+                    css_class = 'alert-success'
+                except StaleDataError:
+                    # show what the other user saved instead of overwriting it
+                    db.session.rollback()
+                    message = 'Product was changed by another user, the latest values are shown. Please enter your changes again.'
+                    css_class = 'alert-danger'
+                    code, name, quantity, price = edit_product.code, edit_product.name, edit_product.quantity, edit_product.price
+                version_id = edit_product.version_id
                 return render_template('edit_product.html', **locals())   
     else:
         return 'Invalid Request'
@@ -289,33 +1153,256 @@ def delete_product(id):
         if delete_product:
             existing_adj = AdjustmentDetail.query.filter_by(product_id=delete_product.id).first()
             existing_purch = PurchaseDetail.query.filter_by(product_id=delete_product.id).first()
-            if existing_adj or existing_purch:
+            # the stock ledger is append only, a product with movements stays for its history
+            existing_movement = StockMovement.query.filter_by(product_id=delete_product.id).first()
+            if existing_adj or existing_purch or existing_movement:
                 if existing_adj:
                     message = 'This product exist in Stock Adjustment!'
-                else:
+                elif existing_purch:
                     message = 'This product exist in Stock Purchase!'
+                else:
+                    message = 'This product has stock history!'
                 css_class = 'alert-danger'
             else:   
                 db.session.delete(delete_product)
                 db.session.commit()
+                counter_cache.incr('product', -1)
                 message = 'Product has been removed!'
                 css_class = 'alert-success'
                 
-            all_products = Product.query.order_by(Product.updated_at.desc()).all()    
+            # only the first page is shown again
             return render_template('products.html', 
-                    all_products=all_products,
+                    product_table=product_table(),
                     message=message, 
                     css_class=css_class
                 )
 
-@app.route('/adjustment', methods=['POST','GET'])
+@app.route('/import_products', methods=['POST'])
+@login_required
+def import_products_upload():
+    # csv or jsonl upload with code, name, quantity and price columns
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify(message='Please upload a csv or jsonl file'), 400
+    file_format = 'jsonl' if upload.filename.lower().endswith(('.jsonl', '.json')) else 'csv'
+
+    # the upload is written to disk as it comes and imported by a job, poll status_url for the result
+    os.makedirs(app.config['JOB_FILES_PATH'], exist_ok=True)
+    path = os.path.join(app.config['JOB_FILES_PATH'], f'{uuid.uuid4().hex}.{file_format}')
+    upload.save(path)
+    job_id = job_queue.submit('import_products', {'path': path, 'file_format': file_format}, key=path)
+    if app.config['JOBS_EAGER']:
+        job_queue.run_now(job_id)
+    return jsonify(
+        message='The file is being imported',
+        job_id=job_id,
+        status_url=url_for('job_status', id=job_id)
+    ), 202
+
+@app.route('/jobs/<int:id>')
 @login_required
-def adjustment():
-    adjustment_header = AdjustmentHeader.query.filter_by(id=1).first_or_404()
+def job_status(id):
+    # status, progress and result of a background job
+    job = job_queue.get(id)
+    if job is None:
+        return jsonify(message='Job not found!'), 404
+    return jsonify(job)
+
+@app.route('/jobs/<int:id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(id):
+    # a running job stops at its next progress update, what it committed before stays
+    if job_queue.cancel(id) is None:
+        return jsonify(message='Job not found!'), 404
+    return jsonify(job_queue.get(id))
+
+@app.route('/stream/products')
+@login_required
+def product_stream():
+    # server-sent events with the new quantity of the products that changed, the browser sends
+    # back the id of the last event it got when it reconnects. Each open stream holds a gunicorn
+    # worker thread, up to STREAM_MAX_OPEN per process, see gunicorn.conf.py
+    after = request.headers.get('Last-Event-ID', request.args.get('after', ''))
+    change_feed.start(app)
+    events = change_feed.stream(int(after) if after.isdigit() else None,
+        heartbeat=app.config['STREAM_HEARTBEAT_SECONDS'], max_seconds=app.config['STREAM_MAX_SECONDS'])
+    return Response(events, mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.context_processor
+def stream_position():
+    # the pages start their stream after the last change this process has seen, no query
+    return {'stream_after': change_feed.last_id}
+
+@app.before_first_request
+def start_job_workers():
+    if not app.config['JOBS_EAGER']:
+        job_queue.start_workers(app, app.config['JOB_WORKER_THREADS'], app.config['JOB_POLL_INTERVAL'])
+
+@app.cli.command('run-jobs')
+@click.option('--threads', default=1, help='worker threads')
+@click.option('--burst', is_flag=True, help='run the queued jobs and exit')
+def run_jobs_command(threads, burst):
+    # flask run-jobs, a worker process for the background jobs, next to the web workers
+    if burst:
+        click.echo(f'Ran {job_queue.run_pending()} jobs')
+        return
+    job_queue.start_workers(app, threads, app.config['JOB_POLL_INTERVAL'])
+    for thread in job_queue.threads:
+        thread.join()
+
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), help='write the rejected rows to this csv file')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, help='rows per insert')
+def import_products_command(path, errors_path, chunk_size):
+    # flask import-products catalog.csv --errors rejected.csv
+    file_format = 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+
+    def show_progress(progress):
+        click.echo(f'\r{progress.read} rows read, {progress.inserted} imported, {progress.errors} rejected '
+            f'({progress.read / max(progress.elapsed, 1e-9):.0f} rows/s)', nl=False)
+
+    errors_file = open(errors_path, 'w', newline='') if errors_path else None
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as stream, db.engine.connect() as connection:
+            result = import_products(connection, Product.__table__, read_rows(stream, file_format),
+                chunk_size=chunk_size,
+                on_error=error_file_writer(errors_file) if errors_file else None,
+                on_progress=show_progress)
+    finally:
+        if errors_file:
+            errors_file.close()
+    counter_cache.invalidate('product')
+    click.echo(f'\nImported {result.inserted} of {result.read} rows in {result.elapsed:.2f}s')
+
+# content type and writer of each export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_stream),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', xlsx_stream),
+}
+
+def export_response(file_name, header, query):
+    # stream the query result as a csv or xlsx download, rows are written as they are fetched
+    file_format = request.args.get('format', 'csv')
+    if file_format not in EXPORT_FORMATS:
+        abort(400)
+    mimetype, writer = EXPORT_FORMATS[file_format]
+    batches = stream_rows(read_session.get_engine(), query)
+    return Response(writer(header, batches), mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={file_name}.{file_format}'})
+
+@app.route('/export/products')
+@login_required
+def export_products():
+    query = select([
+            Product.code,
+            Product.name,
+            Product.quantity,
+            Product.price,
+            Product.created_at,
+            Product.updated_at
+        ]).order_by(Product.code)
+    return export_response('products', ['Code', 'Name', 'Quantity', 'Price', 'Created at', 'Updated at'], query)
+
+@app.route('/export/purchase/<int:id>')
+@login_required
+def export_purchase(id):
+    purchase_header = PurchaseHeader.query.filter_by(id=id).first_or_404()
+    query = select([
+            Product.code,
+            Product.name,
+            Product.quantity,
+            PurchaseDetail.quantity_purchase,
+            PurchaseDetail.quantity_receive
+        ]).select_from(PurchaseDetail.__table__.outerjoin(Product.__table__)) \
+        .where(PurchaseDetail.purchase_header_id == purchase_header.id) \
+        .order_by(PurchaseDetail.id)
+    return export_response('purchase', ['Code', 'Name', 'Quantity', 'Purchase Quantity', 'Receive Quantity'], query)
+
+@app.route('/reports')
+@login_required
+def reports():
+    # stock valuation, low and zero stock, purchase variance and customer balances
+    threshold = request.args.get('low', '')
+    threshold = int(threshold) if threshold.isdigit() else LOW_STOCK_QUANTITY
+    return render_template('reports.html',
+            threshold=threshold,
+            report_tables=fragment_cache.get('report_tables',
+                ('product', 'purchase_header', 'purchase_detail', 'customer'), threshold,
+                lambda: Markup(report_tables(threshold)))
+        )
+
+def report_tables(threshold):
+    connection = read_session().connection()
+    valuation_totals, valuable_products = stock_valuation(connection, Product.__table__)
+    stock_counts, zero_products, low_products = low_stock(connection, Product.__table__, threshold)
+    variance_documents, variance_lines = purchase_variance(connection,
+        PurchaseHeader.__table__, PurchaseDetail.__table__, Product.__table__)
+    brackets, top_customers = balance_brackets(connection, Customer.__table__)
+    return render_template('includes/report_tables.html', **locals())
+
+@app.cli.command('migrate')
+def migrate_command():
+    # flask migrate, create the missing tables and apply the schema migrations not applied yet
+    with db.engine.connect() as connection:
+        applied = migrate(connection, db.metadata)
+    for version, name in applied:
+        click.echo(f'Applied migration {version}: {name}')
+    if not applied:
+        click.echo('The database is up to date')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    # flask build-assets, bundle, minify and hash the static files with their gzip and brotli variants
+    start = time.perf_counter()
+    for name, (filename, size, gzip_size, brotli_size) in build_assets(app.static_folder).items():
+        click.echo(f'{filename}: {size} bytes, {gzip_size} gzip, {brotli_size} brotli')
+    click.echo(f'Built in {time.perf_counter() - start:.2f}s')
+
+@app.cli.command('rebuild-stock')
+def rebuild_stock_command():
+    # flask rebuild-stock, recompute every product quantity from the stock ledger
+    start = time.perf_counter()
+    product_count = rebuild_on_hand()
+    click.echo(f'Rebuilt the quantity of {product_count} products in {time.perf_counter() - start:.2f}s')
+
+@app.route('/adjustments', methods=['POST','GET'])
+@login_required
+def adjustments():
+    message, css_class = ('', '')
+
+    if request.method == 'POST':
+        description = request.form['description'].strip()
+        if description == '':
+            message = 'Please enter a description'
+            css_class = 'alert-danger'
+        else:
+            adjustment_header = AdjustmentHeader(description=description, status='New')
+            db.session.add(adjustment_header)
+            db.session.commit()
+            return redirect(url_for('adjustment', id=adjustment_header.id))
+
+    return render_template('adjustments.html', 
+            all_adjustments=adjustment_documents(),
+            message=message, 
+            css_class=css_class
+        )
+
+@app.route('/adjustment')
+@login_required
+def adjustment_index():
+    return redirect(url_for('adjustments'))
+
+@app.route('/adjustment/<int:id>', methods=['POST','GET'])
+@login_required
+def adjustment(id):
+    adjustment_header = AdjustmentHeader.query.filter_by(id=id).first_or_404()
 
     if request.method == 'GET':
         return render_template('adjustment.html', 
             adjustment_header=adjustment_header,
+            adjustment_rows=adjustment_rows(adjustment_header.id),
             message='', 
             css_class=''
         )   
@@ -325,84 +1412,141 @@ def adjustment():
         submit_type = request.form['submit_type']
 
         # if load products 
-        if submit_type == '1':
-            # get all the products
-            all_products = Product.query.all()
-            for product in all_products:
-                existing_prod = AdjustmentDetail.query.filter_by(product_id=product.id).first()
-                if not existing_prod:
-                    adjustment_detail = AdjustmentDetail(quantity_adjust=0, 
-                        adjustment_reference=adjustment_header, 
-                        adjustment_detail=product)
-                    db.session.add(adjustment_detail)
-                    db.session.commit()
+        if submit_type == 'load_products':
+            # add all the products that are not yet in the adjustment, in the background
+            job_id, message, css_class = submit_job('load_products',
+                {'document': 'adjustment', 'header_id': adjustment_header.id},
+                f'load_products:adjustment:{adjustment_header.id}', 'Loading the products...')
             # return redirect('/adjustment')
             return render_template('adjustment.html', 
                     adjustment_header=adjustment_header,
-                    message='All the products has been loaded!', 
-                    css_class='alert-success')
+                    # while the job runs the rows come with the page loaded again when it is done
+                    adjustment_rows='' if job_id else adjustment_rows(adjustment_header.id),
+                    job_id=job_id,
+                    message=message, 
+                    css_class=css_class)
 
         if submit_type == 'save_adjustment' or submit_type == 'apply_adjustment':
-            # get the form data 
-            raw_datas = request.form 
-            # set the form data to dictionary
-            raw_datas = raw_datas.to_dict(flat=False)
-            # strip off unwated characters
-            raw_datas = str(raw_datas).replace("[", "")
-            raw_datas = str(raw_datas).replace("]", "")
-            # convert the raw data to a dictionary
-            adj_lines = ast.literal_eval(raw_datas) 
-
-            # save current adjustment 
-            if submit_type == 'save_adjustment':
-                # loop all lines
-                for adj_id in adj_lines:
-                    if adj_id == 'submit_type':
-                        continue
-                    # commit changes
-                    adj_detail = AdjustmentDetail.query.filter_by(id=int(adj_id)).first()
-                    if adj_detail:
-                        adj_detail.quantity_adjust = int(adj_lines[adj_id])
-                        db.session.commit()
-                message = 'Adjustment has been Saved!'
-            if submit_type == 'apply_adjustment':
-                # loop all lines
-                for adj_id in adj_lines:
-                    if adj_id == 'submit_type':
-                        continue
-                    # commit changes
-                    adj_detail = AdjustmentDetail.query.filter_by(id=int(adj_id)).first()
-                    if adj_detail:
-                        # save the current screen to adjustment datail table
-                        adj_detail.quantity_adjust = int(adj_lines[adj_id])
-                        # now save to the product able
-                        prod = Product.query.filter_by(id=adj_detail.product_id).first()
-                        if prod:
-                            prod.quantity = adj_detail.quantity_adjust
-                            adj_detail.quantity_adjust = 0
-                        db.session.commit()
-                message = 'Adjustment has been Applied!'
+            # adjustment line id: new quantity
+            adj_quantities, error_list = parse_adjustment_form(request.form)
+            line_versions, version_errors = parse_line_versions(request.form, adj_quantities)
+            error_list += version_errors
+            css_class = 'alert-success'
+            job_id = None
+
+            try:
+                if error_list:
+                    # the valid lines are saved, nothing is applied until the invalid ones are corrected
+                    save_adjustment(adjustment_header.id, adj_quantities, line_versions)
+                    message = 'Please check errors. [ ' + ','.join(error_list) + ' ]'
+                    css_class = 'alert-danger'
+                # save current adjustment 
+                elif submit_type == 'save_adjustment':
+                    save_adjustment(adjustment_header.id, adj_quantities, line_versions)
+                    message = 'Adjustment has been Saved!'
+                elif submit_type == 'apply_adjustment':
+                    # applied in the background with the quantities on screen
+                    job_id, message, css_class = submit_job('apply_adjustment', {
+                            'header_id': adjustment_header.id,
+                            'quantities': list(adj_quantities.items()),
+                            'versions': list(line_versions.items())
+                        }, f'apply_adjustment:{adjustment_header.id}', 'Applying the adjustment...')
+            except StaleDataError:
+                # someone else saved the worksheet since it was loaded, nothing is written
+                db.session.rollback()
+                message = 'Lines were changed by another user, nothing has been saved. Please enter your changes again.'
+                css_class = 'alert-danger'
 
             return render_template('adjustment.html', 
                     adjustment_header=adjustment_header,
+                    # while the job runs the rows come with the page loaded again when it is done
+                    adjustment_rows='' if job_id else adjustment_rows(adjustment_header.id),
+                    job_id=job_id,
                     message=message, 
-                    css_class='alert-success'
+                    css_class=css_class
                 ) 
         temp_char = submit_type.split('-')
         if temp_char[0] == "DEL":
-            adj_detail = AdjustmentDetail.query.filter_by(id=int(temp_char[1])).first()
+            adj_detail = AdjustmentDetail.query.filter_by(id=int(temp_char[1]),
+                adjustment_header_id=adjustment_header.id).first()
             if adj_detail:
                 db.session.delete(adj_detail)
                 db.session.commit()
+                counter_cache.incr('adjustment_detail', -1)
                 return render_template('adjustment.html', 
                         adjustment_header=adjustment_header,
+                        adjustment_rows=adjustment_rows(adjustment_header.id),
                         message='Stock adjustment line removed!', 
                         css_class='alert-success')
 
-@app.route('/purchase', methods=['POST','GET'])
+    return render_template('adjustment.html',
+            adjustment_header=adjustment_header,
+            adjustment_rows=adjustment_rows(adjustment_header.id),
+            message='Stock adjustment line not found!',
+            css_class='alert-danger')
+
+@app.route('/adjustment/<int:id>/lines', methods=['POST'])
+@login_required
+def adjustment_save_lines(id):
+    # save only the lines posted, in the worksheet form format, returns their new versions
+    adjustment_header = AdjustmentHeader.query.filter_by(id=id).first_or_404()
+    adj_quantities, error_list = parse_adjustment_form(request.form)
+    line_versions, version_errors = parse_line_versions(request.form, adj_quantities)
+    error_list += version_errors
+    if error_list:
+        # nothing is saved, the page keeps the versions it has for the next save
+        return jsonify(message='Please check errors. [ ' + ','.join(error_list) + ' ]'), 400
+    try:
+        save_adjustment(adjustment_header.id, adj_quantities, line_versions)
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify(message='Lines were changed by another user, nothing has been saved. Please reload the adjustment.'), 409
+    return jsonify(
+        message='Adjustment has been Saved!',
+        versions=row_versions(AdjustmentDetail, adj_quantities, AdjustmentDetail.adjustment_header_id == adjustment_header.id)
+    )
+
+@app.route('/adjustment/<int:id>/lines/<int:line_id>', methods=['DELETE'])
 @login_required
-def purchase():
-    purchase_header = PurchaseHeader.query.filter_by(id=1).first_or_404()
+def adjustment_delete_line(id, line_id):
+    deleted = AdjustmentDetail.query.filter_by(id=line_id, adjustment_header_id=id).delete()
+    db.session.commit()
+    if not deleted:
+        return jsonify(message='Stock adjustment line not found!'), 404
+    counter_cache.incr('adjustment_detail', -1)
+    return jsonify(message='Stock adjustment line removed!')
+
+@app.route('/purchases', methods=['POST','GET'])
+@login_required
+def purchases():
+    message, css_class = ('', '')
+
+    if request.method == 'POST':
+        description = request.form['description'].strip()
+        if description == '':
+            message = 'Please enter a description'
+            css_class = 'alert-danger'
+        else:
+            purchase_header = PurchaseHeader(description=description, status='New')
+            db.session.add(purchase_header)
+            db.session.commit()
+            return redirect(url_for('purchase', id=purchase_header.id))
+
+    return render_template('purchases.html', 
+            all_purchases=purchase_documents(),
+            message=message, 
+            css_class=css_class
+        )
+
+@app.route('/purchase')
+@login_required
+def purchase_index():
+    return redirect(url_for('purchases'))
+
+@app.route('/purchase/<int:id>', methods=['POST','GET'])
+@login_required
+def purchase(id):
+    purchase_header = PurchaseHeader.query.filter_by(id=id).first_or_404()
 
     receive_field_state = ''
     purchase_field_state = ''
@@ -419,6 +1563,7 @@ def purchase():
     if request.method == 'GET':
         return render_template('purchase.html', 
             purchase_header=purchase_header,
+            purchase_rows=purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
             message='', 
             css_class='',
             receive_field_state=receive_field_state,
@@ -431,91 +1576,68 @@ def purchase():
         css_class = 'alert-success' 
 
         # if load products 
-        if submit_type == '1':
-            # get all the products
-            all_products = Product.query.all()
-            for product in all_products:
-                existing_prod = PurchaseDetail.query.filter_by(product_id=product.id).first()
-                if not existing_prod:
-                    purchase_detail = PurchaseDetail(quantity_purchase=0, 
-                        quantity_receive=0,
-                        purchase_reference=purchase_header, 
-                        purchase_detail=product)
-                    db.session.add(purchase_detail)
-                    db.session.commit()
+        if submit_type == 'load_products':
+            # add all the products that are not yet in the purchase, in the background
+            job_id, message, css_class = submit_job('load_products',
+                {'document': 'purchase', 'header_id': purchase_header.id},
+                f'load_products:purchase:{purchase_header.id}', 'Loading the products...')
             return render_template('purchase.html', 
                 purchase_header=purchase_header,
-                message='Products has been loaded!', 
-                css_class='alert-success',
+                # while the job runs the rows come with the page loaded again when it is done
+                purchase_rows='' if job_id else purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
+                job_id=job_id,
+                message=message, 
+                css_class=css_class,
                 receive_field_state=receive_field_state,
                 purchase_field_state=purchase_field_state
             )   
 
         if (submit_type == 'save_purchase' or 
             submit_type == 'export_purchase' or
+            submit_type == 'export_purchase_xlsx' or
             submit_type == 'start_purchase' or
             submit_type == 'receive_purchase' or
             submit_type == 'apply_purchase'
             ):
-            # get the form data 
-            raw_datas = request.form 
-            # set the form data to dictionary
-            raw_datas = raw_datas.to_dict(flat=False)
-            # strip off unwated characters
-            raw_datas = str(raw_datas).replace("[", "")
-            raw_datas = str(raw_datas).replace("]", "")
-            # convert the raw data to a dictionary
-            purch_lines = ast.literal_eval(raw_datas) 
-            # return purch_lines
-            
-
-            ####### dodgy code START - never do this - im running out of time so okay for now  ######
-            purch_lines.pop('submit_type')
-            temp_purch_list = []
-            purch_lines_new = []
-
-            # Loop 1 - build the purchase qty 
-            for temp in purch_lines:
-                # split the individual form data 
-                temp_char = temp.split('-') 
-                temp_char.append(str(purch_lines[temp]))
-                # build the temporary list
-                if temp_char[0] == 'PURCHASE':
-                    temp_dict = { 'id':  temp_char[1],
-                                   'prod_code': temp_char[2],
-                                   'purch_qty': temp_char[3],
-                                   'receive_qty': '0'
-                                }
-                    temp_purch_list.append(temp_dict)
-
-            # Loop 2 - add the receive qty 
-            for temp in purch_lines:
-               # split the individual form data 
-                temp_char = temp.split('-') 
-                temp_char.append(str(purch_lines[temp]))
-                if temp_char[0] == 'RECEIVE':
-                    for item in temp_purch_list:
-                        if item['prod_code'] == temp_char[2]:
-                            item['receive_qty'] = str(purch_lines[temp])
-                            # return item 
-                            purch_lines_new.append(item)
-
-            ####### dodgy code END - never do this - im running out of time so okay for now  ######     
+            # purchase line id: PurchaseLine
+            purch_lines, error_list = parse_purchase_form(request.form)
+            line_versions, version_errors = parse_line_versions(request.form, purch_lines)
+            error_list += version_errors
 
             # save current purchase
             # if submit_type == 'save_purchase':
             # loop all lines
-            for purch_item in purch_lines_new:
-                # check purchase detail exist
-                purchase_detail = PurchaseDetail.query.filter_by(id=str(purch_item['id'])).first()
-                if purchase_detail:
-                    # check product exist
-                    prod = Product.query.filter_by(code=purch_item['prod_code']).first()
-                    if prod:
-                        purchase_detail.quantity_purchase = int(purch_item['purch_qty'])
-                        purchase_detail.quantity_receive = int(purch_item['receive_qty'])
+            try:
+                save_purchase(purchase_header.id, purch_lines, line_versions)
+            except StaleDataError:
+                # someone else saved the worksheet since it was loaded, nothing is written
+                db.session.rollback()
+                return render_template('purchase.html', 
+                    purchase_header=purchase_header,
+                    purchase_rows=purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
+                    message='Lines were changed by another user, nothing has been saved. Please enter your changes again.', 
+                    css_class='alert-danger',
+                    receive_field_state=receive_field_state,
+                    purchase_field_state=purchase_field_state
+                )
             # throw success message 
             message = 'Changes has been saved!'
+            job_id = None
+
+            if error_list:
+                # the valid lines are saved, the status does not change until the invalid ones are corrected
+                db.session.commit()
+                return render_template('purchase.html', 
+                    purchase_header=purchase_header,
+                    purchase_rows=purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
+                    message='Please check errors. [ ' + ','.join(error_list) + ' ]', 
+                    css_class='alert-danger',
+                    receive_field_state=receive_field_state,
+                    purchase_field_state=purchase_field_state
+                )
+
+            if submit_type == 'save_purchase':
+                db.session.commit()
 
             if submit_type == 'start_purchase':
                 purchase_header.status = 'In Transit'
@@ -531,36 +1653,31 @@ def purchase():
                 purchase_field_state = 'readonly="readonly"'
                 message = 'Purchase received, please match the purchase quantity against the receive quantity!'
 
-            if submit_type == 'export_purchase':
-                message = " Sorry this module is not yet available! "
-                css_class = 'alert-danger'
+            if submit_type == 'export_purchase' or submit_type == 'export_purchase_xlsx':
+                # keep the quantities on screen then download the worksheet
+                db.session.commit()
+                file_format = 'xlsx' if submit_type == 'export_purchase_xlsx' else 'csv'
+                return redirect(url_for('export_purchase', id=purchase_header.id, format=file_format))
 
             if submit_type == 'apply_purchase':
                 if purchase_header.status != 'Received':
                     message="Unable to apply purchase, please contact administrator!"
                     css_class='alert-danger'
                 else:
-                    purchase_header.status = 'New'
-                    # save the quantity to product atble 
-                    for purch_item in purch_lines_new:
-                        # check purchase detail exist
-                        purchase_detail = PurchaseDetail.query.filter_by(id=str(purch_item['id'])).first()
-                        if purchase_detail:
-                            # now save to the product able
-                            prod = Product.query.filter_by(id=purchase_detail.product_id).first()
-                            if prod:
-                                prod.quantity = prod.quantity + purchase_detail.quantity_receive
-                                purchase_detail.quantity_purchase = 0
-                                purchase_detail.quantity_receive = 0
                     db.session.commit()
-                    receive_field_state = ''
-                    receive_field_state = 'readonly="readonly"'
-                    message="Purchase complete!"
-                    css_class='alert-success'
+                    # add the received quantity to the product table, in the background
+                    job_id, message, css_class = submit_job('apply_purchase', {'header_id': purchase_header.id},
+                        f'apply_purchase:{purchase_header.id}', 'Applying the purchase...')
+                    if css_class == 'alert-success':
+                        receive_field_state = ''
+                        receive_field_state = 'readonly="readonly"'
 
 
             return render_template('purchase.html', 
                 purchase_header=purchase_header,
+                # while the job runs the rows come with the page loaded again when it is done
+                purchase_rows='' if job_id else purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
+                job_id=job_id,
                 message=message, 
                 css_class=css_class,
                 receive_field_state=receive_field_state,
@@ -570,10 +1687,12 @@ def purchase():
         temp_char = submit_type.split('-')
         if temp_char[0] == "DEL":
             if purchase_header.status == 'New':
-                purch_detail = PurchaseDetail.query.filter_by(id=int(temp_char[1])).first()
+                purch_detail = PurchaseDetail.query.filter_by(id=int(temp_char[1]),
+                    purchase_header_id=purchase_header.id).first()
                 if purch_detail:
                     db.session.delete(purch_detail)
                     db.session.commit()
+                    counter_cache.incr('purchase_detail', -1)
                     message = 'Line has been removed!'
                     css_class = 'alert-success'
             else:
@@ -584,12 +1703,48 @@ def purchase():
             receive_field_state = 'readonly="readonly"'
             return render_template('purchase.html', 
                     purchase_header=purchase_header,
+                    purchase_rows=purchase_rows(purchase_header.id, receive_field_state, purchase_field_state),
                     message=message, 
                     css_class=css_class,
                     receive_field_state=receive_field_state,
                     purchase_field_state=purchase_field_state)
     
 
+@app.route('/purchase/<int:id>/lines', methods=['POST'])
+@login_required
+def purchase_save_lines(id):
+    # save only the lines posted, in the worksheet form format, returns their new versions
+    purchase_header = PurchaseHeader.query.filter_by(id=id).first_or_404()
+    purch_lines, error_list = parse_purchase_form(request.form)
+    line_versions, version_errors = parse_line_versions(request.form, purch_lines)
+    error_list += version_errors
+    if error_list:
+        # nothing is saved, the page keeps the versions it has for the next save
+        return jsonify(message='Please check errors. [ ' + ','.join(error_list) + ' ]'), 400
+    try:
+        save_purchase(purchase_header.id, purch_lines, line_versions)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify(message='Lines were changed by another user, nothing has been saved. Please reload the purchase.'), 409
+    return jsonify(
+        message='Changes has been saved!',
+        versions=row_versions(PurchaseDetail, purch_lines, PurchaseDetail.purchase_header_id == purchase_header.id)
+    )
+
+@app.route('/purchase/<int:id>/lines/<int:line_id>', methods=['DELETE'])
+@login_required
+def purchase_delete_line(id, line_id):
+    purchase_header = PurchaseHeader.query.filter_by(id=id).first_or_404()
+    if purchase_header.status != 'New':
+        return jsonify(message='Remove not allowed!'), 409
+    deleted = PurchaseDetail.query.filter_by(id=line_id, purchase_header_id=id).delete()
+    db.session.commit()
+    if not deleted:
+        return jsonify(message='Line not found!'), 404
+    counter_cache.incr('purchase_detail', -1)
+    return jsonify(message='Line has been removed!')
+
 @app.route('/changepassword', methods=['POST', 'GET'])
 @login_required
 def changepassword():
@@ -605,9 +1760,16 @@ def changepassword():
         newpassword = request.form['newpassword']
 
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password=oldpassword) and newpassword != '':
-            user.hash_password(password=newpassword)
+        try:
+            valid_password = user and user.check_password(password=oldpassword)
+            if valid_password and newpassword != '':
+                user.hash_password(password=newpassword)
+        except PasswordCheckBusy:
+            return render_template('changepassword.html', message='Too many password changes, please try again!',
+                css_class='alert-danger'), 503
+        if valid_password and newpassword != '':
             db.session.commit()
+            user_cache.invalidate(user.id)
             save_status = 'Password change complete!'
             css_alert_class = 'alert-success'
         else:
@@ -632,4 +1794,391 @@ def resetdevpassword():
     if user:
         user.hash_password(password='dev')
         db.session.commit()
+        user_cache.invalidate(user.id)
     return redirect('/')
+
+
+# versioned json api for the integrations, every route is under /api/v1
+api_v1 = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+api_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='api-token')
+
+# fields of the rows returned by the list endpoints, in order
+PRODUCT_API_FIELDS = ['id', 'code', 'name', 'quantity', 'price', 'created_at', 'updated_at', 'version_id']
+CUSTOMER_API_FIELDS = ['id', 'fullname', 'balance', 'remarks', 'version_id']
+DOCUMENT_API_FIELDS = ['id', 'description', 'status', 'line_count']
+ADJUSTMENT_LINE_FIELDS = ['quantity_adjust']
+PURCHASE_LINE_FIELDS = ['quantity_purchase', 'quantity_receive']
+
+@login_manager.request_loader
+def load_api_user(request):
+    # api clients send the token of /api/v1/token as "Authorization: Bearer <token>"
+    authorization = request.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    try:
+        user_id, token_key = api_tokens.loads(authorization[len('Bearer '):],
+            max_age=app.config['API_TOKEN_MAX_AGE'])
+    except (BadSignature, ValueError):
+        return None
+    user = load_user(user_id)
+    if user is None or user.token_key != token_key:
+        return None
+    return user
+
+def api_response(payload, status=200, etag=None):
+    # compact json, a GET carries an ETag and a matching If-None-Match gets a 304 without the body
+    response = Response(compact_json(payload), status=status, mimetype='application/json')
+    if request.method == 'GET' and status == 200:
+        if etag:
+            response.set_etag(etag)
+        else:
+            response.add_etag()
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+    return response
+
+def api_error(status, message, **details):
+    return api_response(dict(error=message, **details), status)
+
+def api_login_required(view):
+    # a 401 in json instead of the redirect to the sign in page
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error(401, 'Authentication required')
+        return view(*args, **kwargs)
+    return wrapper
+
+def api_batch():
+    # the rows posted to a batch endpoint, (items, error response)
+    items, error = batch_items(request.get_json(silent=True), app.config['API_MAX_BATCH_SIZE'])
+    if error:
+        return None, api_error(400, error)
+    return items, None
+
+def clean_batch(items, clean, key=None):
+    # validate every row of a batch, returns ({key or index: (index, item, values)}, error rows)
+    cleaned = {}
+    error_rows = []
+    for index, item in enumerate(items):
+        values, error_list = clean(item)
+        row_key = item.get(key) if key else index
+        if not error_list and row_key in cleaned:
+            error_list = [f'Duplicate {key}']
+        if error_list:
+            error_rows.append({'index': index, 'error': ', '.join(error_list)})
+        else:
+            cleaned[row_key] = (index, item, values)
+    return cleaned, error_rows
+
+def check_batch_versions(cleaned, stored_versions):
+    # error rows for the ids that don't exist, and the ids whose posted version_id is not the current one
+    missing = [{'index': index, 'error': 'Not found'}
+        for row_id, (index, item, values) in cleaned.items() if row_id not in stored_versions]
+    stale = [row_id for row_id, (index, item, values) in cleaned.items()
+        if row_id in stored_versions and item.get('version_id', stored_versions[row_id]) != stored_versions[row_id]]
+    return missing, stale
+
+def update_batch(table, cleaned, stored_versions):
+    # one batched versioned UPDATE per set of changed fields, returns the new versions
+    by_fields = {}
+    new_versions = []
+    for row_id, (index, item, values) in cleaned.items():
+        version = item.get('version_id', stored_versions[row_id])
+        row = {'line_id': row_id, 'version': version}
+        row.update((f'new_{field}', value) for field, value in values.items())
+        by_fields.setdefault(tuple(sorted(values)), []).append(row)
+        new_versions.append({'id': row_id, 'version_id': version + 1})
+    for fields, rows in by_fields.items():
+        update_versioned(table, rows, **{field: bindparam(f'new_{field}') for field in fields})
+    return new_versions
+
+def stale_batch_response(stale_ids):
+    return api_error(409, 'Rows were changed by another user, nothing has been saved', stale_ids=stale_ids)
+
+def document_lines(detail_model, header_column, header_id, quantity_fields, after=None, limit=PAGE_SIZE):
+    # one page of the lines of a document with their product, in id order
+    detail_table = detail_model.__table__
+    query = select([detail_model.id, detail_model.product_id, Product.code, Product.name, Product.quantity]
+            + [getattr(detail_model, field) for field in quantity_fields] + [detail_model.version_id]) \
+        .select_from(detail_table.outerjoin(Product.__table__, detail_model.product_id == Product.id)) \
+        .where(detail_table.c[header_column] == header_id)
+    if after is not None:
+        query = query.where(detail_model.id > after)
+    rows = read_session().execute(query.order_by(detail_model.id).limit(limit + 1)).fetchall()
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_page = str(rows[-1].id)
+    return rows, next_page
+
+def lines_response(detail_model, header_column, header_id, quantity_fields):
+    after = request.args.get('after', '')
+    rows, next_page = document_lines(detail_model, header_column, header_id, quantity_fields,
+        int(after) if after.isdigit() else None, page_size())
+    return api_response({
+        'fields': ['id', 'product_id', 'code', 'name', 'quantity'] + quantity_fields + ['version_id'],
+        'rows': [list(row) for row in rows],
+        'next': next_page
+    })
+
+def add_lines(detail_model, header_column, header_id, quantity_fields):
+    # add lines for the posted products, products already on the document are rejected
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    cleaned, error_rows = clean_batch(items, lambda item: clean_line(item, quantity_fields), key='product_id')
+    detail_table = detail_model.__table__
+    product_ids = existing_ids(Product.id, cleaned)
+    loaded_ids = existing_ids(detail_model.product_id, cleaned, detail_table.c[header_column] == header_id)
+    new_lines = []
+    for product_id, (index, item, values) in cleaned.items():
+        if product_id not in product_ids:
+            error_rows.append({'index': index, 'error': 'Product not found'})
+        elif product_id in loaded_ids:
+            error_rows.append({'index': index, 'error': 'Product already loaded'})
+        else:
+            new_lines.append(dict(values, **{header_column: header_id, 'product_id': product_id}))
+    inserted = bulk_insert(db.session.connection(), detail_table, new_lines)
+    db.session.commit()
+    counter_cache.incr(detail_table.name, inserted)
+    return api_response({'inserted': inserted, 'errors': sorted(error_rows, key=lambda row: row['index'])})
+
+def update_lines(quantity_fields, stored_versions, save):
+    # stored_versions(ids) gives {id: version} of the lines of the document,
+    # save(values by id, posted versions) writes them. All the rows or none are saved
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    cleaned, error_rows = clean_batch(items, lambda item: clean_line(item, quantity_fields, update=True), key='id')
+    versions = stored_versions(cleaned)
+    missing, stale = check_batch_versions(cleaned, versions)
+    if error_rows or missing:
+        return api_error(422, 'Nothing has been saved', errors=sorted(error_rows + missing, key=lambda row: row['index']))
+    if stale:
+        return stale_batch_response(stale)
+    posted_versions = {line_id: item.get('version_id', versions[line_id])
+        for line_id, (index, item, values) in cleaned.items()}
+    try:
+        save({line_id: values for line_id, (index, item, values) in cleaned.items()}, posted_versions)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return stale_batch_response(sorted(cleaned))
+    return api_response({'updated': len(cleaned),
+        'versions': [{'id': line_id, 'version_id': version + 1} for line_id, version in posted_versions.items()]})
+
+@api_v1.route('/token', methods=['POST'])
+def api_token():
+    # a bearer token for http basic credentials or a json {username, password}
+    credentials = request.authorization or request.get_json(silent=True) or {}
+    username, password = credentials.get('username'), credentials.get('password')
+    user = User.query.filter_by(username=username).first() if username and password else None
+    try:
+        valid_login = user and user.check_password(password=password)
+        if valid_login:
+            upgrade_password_hash(user, password)
+    except PasswordCheckBusy:
+        return api_error(503, 'Too many sign ins, please try again')
+    if not valid_login:
+        return api_error(401, 'Invalid Login')
+    return api_response({
+        'token': api_tokens.dumps([user.id, password_token_key(user.password)]),
+        'expires_in': app.config['API_TOKEN_MAX_AGE']
+    })
+
+@api_v1.route('/products', methods=['GET'])
+@api_login_required
+def api_products():
+    page, next_page = product_page(request.args.get('q', ''), request.args.get('after'), page_size())
+    return api_response({
+        'fields': PRODUCT_API_FIELDS,
+        'rows': [[row[field] for field in PRODUCT_API_FIELDS] for row in page],
+        'next': next_page
+    })
+
+@api_v1.route('/products/<int:id>', methods=['GET'])
+@api_login_required
+def api_product(id):
+    product = read_session().execute(
+        select([getattr(Product, field) for field in PRODUCT_API_FIELDS]).where(Product.id == id)).first()
+    if product is None:
+        return api_error(404, 'Product not found')
+    # every write of a product bumps its version
+    return api_response(dict(product), etag=f'product-{product.id}-{product.version_id}')
+
+@api_v1.route('/products', methods=['POST'])
+@api_login_required
+def api_create_products():
+    # [{code, name, quantity, price?}] with json types, the chunked insert of the file import
+    # rejected rows are reported by index
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    error_rows = []
+    with db.engine.connect() as connection:
+        result = import_products(connection, Product.__table__,
+            ((index, item, None) for index, item in enumerate(items)),
+            chunk_size=IMPORT_CHUNK_SIZE, clean_row=clean_product,
+            on_error=lambda row_error: error_rows.append({'index': row_error.line, 'error': row_error.error}))
+    counter_cache.incr('product', result.inserted)
+    return api_response({'inserted': result.inserted, 'errors': sorted(error_rows, key=lambda row: row['index'])})
+
+@api_v1.route('/products', methods=['PATCH'])
+@api_login_required
+def api_update_products():
+    # [{id, version_id?, code?, name?, quantity?, price?}], all the rows or none are saved
+    # a changed quantity goes to the stock ledger like an edit of the product form
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    cleaned, error_rows = clean_batch(items, clean_product_update, key='id')
+    versions = row_versions(Product, cleaned)
+    missing, stale = check_batch_versions(cleaned, versions)
+    error_rows += missing
+
+    new_codes = {}
+    for product_id, (index, item, values) in cleaned.items():
+        if 'code' in values:
+            if values['code'] in new_codes:
+                error_rows.append({'index': index, 'error': f'Duplicate code {values["code"]}'})
+            new_codes[values['code']] = product_id
+    for code_chunk in chunks(new_codes):
+        for product_id, code in db.session.query(Product.id, Product.code) \
+                .filter(Product.code.in_(bindparam('codes', expanding=True))).params(codes=code_chunk):
+            if new_codes[code] != product_id:
+                error_rows.append({'index': cleaned[new_codes[code]][0], 'error': f'Product code: {code} already exist'})
+
+    if error_rows:
+        return api_error(422, 'Nothing has been saved', errors=sorted(error_rows, key=lambda row: row['index']))
+    if stale:
+        return stale_batch_response(stale)
+
+    try:
+        quantities = {product_id: values['quantity'] for product_id, (index, item, values) in cleaned.items()
+            if 'quantity' in values}
+        if quantities:
+            record_opening_balances(quantities)
+            on_hand = on_hand_quantities(quantities)
+            record_stock_movements([{'product_id': product_id, 'change': quantity - (on_hand[product_id] or 0),
+                    'reference_id': None}
+                for product_id, quantity in sorted(quantities.items()) if quantity != (on_hand[product_id] or 0)], 'edit')
+        new_versions = update_batch(Product.__table__, cleaned, versions)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return stale_batch_response(sorted(cleaned))
+    return api_response({'updated': len(new_versions), 'versions': new_versions})
+
+@api_v1.route('/customers', methods=['GET'])
+@api_login_required
+def api_customers():
+    page, next_page = customer_page(request.args.get('q', ''), request.args.get('after'), page_size())
+    return api_response({
+        'fields': CUSTOMER_API_FIELDS,
+        'rows': [[row[field] for field in CUSTOMER_API_FIELDS] for row in page],
+        'next': next_page
+    })
+
+@api_v1.route('/customers/<int:id>', methods=['GET'])
+@api_login_required
+def api_customer(id):
+    customer = read_session().execute(
+        select([getattr(Customer, field) for field in CUSTOMER_API_FIELDS]).where(Customer.id == id)).first()
+    if customer is None:
+        return api_error(404, 'Customer not found')
+    return api_response(dict(customer), etag=f'customer-{customer.id}-{customer.version_id}')
+
+@api_v1.route('/customers', methods=['POST'])
+@api_login_required
+def api_create_customers():
+    # [{fullname, balance?, remarks?}], the valid rows are inserted and the others reported by index
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    cleaned, error_rows = clean_batch(items, clean_customer)
+    inserted = bulk_insert(db.session.connection(), Customer.__table__,
+        [values for index, item, values in cleaned.values()])
+    db.session.commit()
+    counter_cache.incr('customer', inserted)
+    return api_response({'inserted': inserted, 'errors': error_rows})
+
+@api_v1.route('/customers', methods=['PATCH'])
+@api_login_required
+def api_update_customers():
+    # [{id, version_id?, fullname?, balance?, remarks?}], all the rows or none are saved
+    items, error_response = api_batch()
+    if error_response:
+        return error_response
+    cleaned, error_rows = clean_batch(items, lambda item: clean_customer(item, update=True), key='id')
+    versions = row_versions(Customer, cleaned)
+    missing, stale = check_batch_versions(cleaned, versions)
+    if error_rows or missing:
+        return api_error(422, 'Nothing has been saved', errors=sorted(error_rows + missing, key=lambda row: row['index']))
+    if stale:
+        return stale_batch_response(stale)
+    try:
+        new_versions = update_batch(Customer.__table__, cleaned, versions)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return stale_batch_response(sorted(cleaned))
+    return api_response({'updated': len(new_versions), 'versions': new_versions})
+
+@api_v1.route('/adjustments', methods=['GET'])
+@api_login_required
+def api_adjustments():
+    return api_response({'fields': DOCUMENT_API_FIELDS, 'rows': [list(row) for row in adjustment_documents()]})
+
+@api_v1.route('/adjustments/<int:id>/lines', methods=['GET', 'POST', 'PATCH'])
+@api_login_required
+def api_adjustment_lines(id):
+    if read_session.query(AdjustmentHeader.id).filter(AdjustmentHeader.id == id).first() is None:
+        return api_error(404, 'Adjustment not found')
+    if request.method == 'POST':
+        # [{product_id, quantity_adjust?}]
+        return add_lines(AdjustmentDetail, 'adjustment_header_id', id, ADJUSTMENT_LINE_FIELDS)
+    if request.method == 'PATCH':
+        # [{id, version_id?, quantity_adjust}]
+        return update_lines(ADJUSTMENT_LINE_FIELDS,
+            lambda line_ids: row_versions(AdjustmentDetail, line_ids, AdjustmentDetail.adjustment_header_id == id),
+            lambda lines, versions: save_adjustment(id,
+                {line_id: values['quantity_adjust'] for line_id, values in lines.items()}, versions))
+    return lines_response(AdjustmentDetail, 'adjustment_header_id', id, ADJUSTMENT_LINE_FIELDS)
+
+@api_v1.route('/purchases', methods=['GET'])
+@api_login_required
+def api_purchases():
+    return api_response({'fields': DOCUMENT_API_FIELDS, 'rows': [list(row) for row in purchase_documents()]})
+
+@api_v1.route('/purchases/<int:id>/lines', methods=['GET', 'POST', 'PATCH'])
+@api_login_required
+def api_purchase_lines(id):
+    if read_session.query(PurchaseHeader.id).filter(PurchaseHeader.id == id).first() is None:
+        return api_error(404, 'Purchase not found')
+    if request.method == 'POST':
+        # [{product_id, quantity_purchase?, quantity_receive?}]
+        return add_lines(PurchaseDetail, 'purchase_header_id', id, PURCHASE_LINE_FIELDS)
+    if request.method == 'PATCH':
+        # [{id, version_id?, quantity_purchase, quantity_receive}], lines whose product was deleted are not found
+        return update_lines(PURCHASE_LINE_FIELDS,
+            lambda line_ids: {line_id: version
+                for line_id, (prod_id, quantity_receive, version) in purchase_line_products(id, line_ids).items()},
+            lambda lines, versions: save_purchase(id,
+                {line_id: PurchaseLine(line_id, '', values['quantity_purchase'], values['quantity_receive'])
+                    for line_id, values in lines.items()}, versions))
+    return lines_response(PurchaseDetail, 'purchase_header_id', id, PURCHASE_LINE_FIELDS)
+
+app.register_blueprint(api_v1)
+
+def prepare_app():
+    # readies the module's app for gunicorn, through wsgi.py with gunicorn.conf.py. It is not a
+    # factory, the app and its routes are built once when this module is imported.
+    # Importing this module opens no connection and starts no thread, the engines, job workers
+    # and change feed start on first use in the worker, so the app is loaded once before the
+    # fork (preload_app) and its memory is shared by the workers. What every worker would build
+    # on its first requests, the mappers and the compiled templates, is built here instead
+    configure_mappers()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    return app
@@ -0,0 +1,174 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+
+import brotli
+import rcssmin
+import rjsmin
+from flask import request, send_from_directory, url_for
+from flask.helpers import safe_join
+
+logger = logging.getLogger(__name__)
+
+# the bundles served to the pages and their source files in static/, in page order
+# a file that is not in a bundle is minified and hashed on its own
+BUNDLES = {
+    'app.css': ['bootstrap.css', 'waves.css', 'animate.css', 'sweetalert.css', 'style.css'],
+    'themes.css': ['all-themes.css'],
+    'app.js': ['jquery.min.js', 'bootstrap.js', 'bootstrap-select.js', 'jquery.slimscroll.js', 'waves.js',
+        'sweetalert.min.js', 'admin.js', 'dialogs.js', 'demo.js', 'bootstrap-notify.js', 'notifications.js'],
+    'sign-in.js': ['jquery.min.js', 'bootstrap.js', 'waves.js', 'jquery.validate.js', 'admin.js', 'sign-in.js'],
+    'listing.js': ['listing.js'],
+    'worksheet.js': ['worksheet.js'],
+    'stock_stream.js': ['stock_stream.js'],
+}
+# the built files go in static/dist, their names change with their content
+BUILD_DIR = 'dist'
+MANIFEST = 'manifest.json'
+# a hashed file never changes, browsers keep it a year without asking again
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+CSS_IMPORT = re.compile(r'@import\s+[^;]+;')
+
+
+def rebase_css(style, source, build_dir):
+    # the relative urls of a stylesheet point from its new place in the build dir
+    def rebase(match):
+        url = match.group(2).strip()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(source), url))
+        return f"url('{posixpath.relpath(target, build_dir)}')"
+    return CSS_URL.sub(rebase, style)
+
+
+def bundle(static_folder, name, sources, build_dir=BUILD_DIR):
+    # the minified content of a bundle as bytes
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding='utf-8') as source_file:
+            parts.append(source_file.read())
+    if name.endswith('.css'):
+        parts = [rebase_css(part, source, build_dir) for part, source in zip(parts, sources)]
+        # @import is only allowed at the top of a stylesheet
+        imports = [found for part in parts for found in CSS_IMPORT.findall(part)]
+        content = '\n'.join(imports + [CSS_IMPORT.sub('', part) for part in parts])
+        content = rcssmin.cssmin(content, keep_bang_comments=True)
+    else:
+        # a file without a trailing semicolon must not run into the next one
+        content = rjsmin.jsmin(';\n'.join(parts), keep_bang_comments=True)
+    return content.encode('utf-8')
+
+
+def write_file(path, content):
+    # written aside then renamed so a worker never serves half a file
+    with open(path + '.tmp', 'wb') as output:
+        output.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def build_assets(static_folder, bundles=BUNDLES, build_dir=BUILD_DIR):
+    # bundle, minify and hash the assets into static/dist with their gzip and brotli variants,
+    # returns {bundle: (file name, size, gzip size, brotli size)}. The files of the previous
+    # build are kept for the pages still open on it, older ones are removed
+    output = os.path.join(static_folder, build_dir)
+    os.makedirs(output, exist_ok=True)
+    previous = read_manifest(static_folder, build_dir) or {}
+    manifest = {}
+    sizes = {}
+    for name, sources in bundles.items():
+        content = bundle(static_folder, name, sources, build_dir)
+        stem, extension = os.path.splitext(name)
+        filename = f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+        path = os.path.join(output, filename)
+        # the gzip header gets no timestamp so a build of the same content gives the same bytes
+        gzipped = gzip.compress(content, 9, mtime=0)
+        compressed = brotli.compress(content, quality=11)
+        if not os.path.exists(path + '.br'):
+            write_file(path, content)
+            write_file(path + '.gz', gzipped)
+            write_file(path + '.br', compressed)
+        manifest[name] = posixpath.join(build_dir, filename)
+        sizes[name] = (filename, len(content), len(gzipped), len(compressed))
+    write_file(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    keep = {posixpath.basename(path) for path in list(manifest.values()) + list(previous.values())}
+    for filename in os.listdir(output):
+        if filename != MANIFEST and re.sub(r'\.(gz|br)$', '', filename) not in keep:
+            os.remove(os.path.join(output, filename))
+    return sizes
+
+
+def read_manifest(static_folder, build_dir=BUILD_DIR):
+    # {bundle: path in static/} of the last build, None when there is none
+    try:
+        with open(os.path.join(static_folder, build_dir, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+class Assets:
+    # serves the built bundles: url_for('static', filename=...) gives the hashed file of a bundle
+    # and asset_urls(bundle) in the templates its <script> or <link> urls. A hashed file is sent
+    # brotli or gzip compressed when the browser takes it, with a year long immutable cache.
+    # Without an up to date build, or with ASSETS_DEBUG, the pages get the source files
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.static_folder = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        if not app.config.get('ASSETS_DEBUG'):
+            self.manifest = self.load()
+        app.url_defaults(self.hashed_url)
+        app.add_template_global(self.asset_urls)
+        self.send_source_file = app.send_static_file
+        app.view_functions['static'] = self.send_static_file
+
+    def load(self):
+        manifest = read_manifest(self.static_folder)
+        if manifest is None:
+            logger.warning('no built assets, run flask build-assets')
+            return {}
+        # a source edited after the build would not show, the sources are served until the next build
+        built_at = os.path.getmtime(os.path.join(self.static_folder, BUILD_DIR, MANIFEST))
+        sources = {source for name in manifest for source in BUNDLES.get(name, [])}
+        if any(os.path.getmtime(os.path.join(self.static_folder, source)) > built_at for source in sources):
+            logger.warning('assets changed since the last build, run flask build-assets')
+            return {}
+        return manifest
+
+    def hashed_url(self, endpoint, values):
+        # url_for('static', filename='app.js') -> /static/dist/app.<hash>.js
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def asset_urls(self, name):
+        if name in self.manifest:
+            return [url_for('static', filename=name)]
+        return [url_for('static', filename=source) for source in BUNDLES[name]]
+
+    def send_static_file(self, filename):
+        if not filename.startswith(BUILD_DIR + '/'):
+            return self.send_source_file(filename)
+        # raises NotFound outside of the static folder
+        path = safe_join(self.static_folder, filename)
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+                response = send_from_directory(self.static_folder, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.static_folder, filename, mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
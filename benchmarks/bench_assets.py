@@ -0,0 +1,69 @@
+# benchmark of the static files: the requests and bytes a browser needs for the sign in and
+# products pages with the source files (ASSETS_DEBUG=1, how they were served before the build
+# step) and with the built bundles, and the requests a reload still makes. The source files are
+# revalidated on reload, the hashed bundles are immutable
+# usage: python benchmarks/bench_assets.py
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+ASSET_URL = re.compile(r'(?:src|href)="(/static/[^"]+)"')
+# what a current browser sends
+ACCEPT_ENCODING = 'br, gzip, deflate'
+
+
+def page_assets(client, path):
+    # (requests, bytes on the wire, requests on reload) of the static files of a page
+    urls = ASSET_URL.findall(client.get(path).get_data(as_text=True))
+    size = 0
+    reload_requests = 0
+    for url in urls:
+        response = client.get(url, headers={'Accept-Encoding': ACCEPT_ENCODING})
+        assert response.status_code == 200, (url, response.status_code)
+        size += len(response.data)
+        if 'immutable' not in response.headers.get('Cache-Control', ''):
+            reload_requests += 1
+    return len(urls), size, reload_requests
+
+
+def measure(debug, database, results):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.environ['ASSETS_DEBUG'] = '1' if debug else ''
+    import app
+    with app.app.app_context():
+        app.db.create_all()
+        user = app.User(username='bench')
+        user.hash_password(password='bench')
+        app.db.session.add(user)
+        app.db.session.commit()
+    client = app.app.test_client()
+    sign_in = page_assets(client, '/')
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    results.put({'sign in': sign_in, 'products': page_assets(client, '/products')})
+
+
+def in_child(debug):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process = context.Process(target=measure, args=(debug, os.path.join(tmp_dir, 'bench.sqlite'), results))
+        process.start()
+        result = results.get()
+        process.join()
+    return result
+
+
+if __name__ == '__main__':
+    from app import app
+    from assets import build_assets
+    build_assets(app.static_folder)
+
+    print(f'{"page":<10} {"assets":<8} {"requests":>9} {"KB":>9} {"reload requests":>16}')
+    for debug, label in ((True, 'sources'), (False, 'bundles')):
+        for page, (requests, size, reload_requests) in in_child(debug).items():
+            print(f'{page:<10} {label:<8} {requests:>9} {size / 1024:>9.1f} {reload_requests:>16}')
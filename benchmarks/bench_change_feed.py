@@ -0,0 +1,221 @@
+# benchmark of the stock level push: N browsers hold /stream/products open on a gunicorn
+# started with each worker class while products are edited through /edit_product, for each
+# run it prints how many streams were served, how many of the edits were answered, the share of
+# the pushed quantities that reached the streams, the push latency and the RSS of the workers.
+# The gthread workers give a stream a thread each, past STREAM_MAX_OPEN per worker the streams are
+# turned away and the edits are still answered
+# usage: python benchmarks/bench_change_feed.py [--clients 100,1000] [--worker-classes gthread,gevent]
+#     [--workers 1] [--threads 16] [--writes 20]
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+PRODUCTS = 1000
+# seconds a stream or an edit may take to be answered
+TIMEOUT = 10
+
+
+def seed(database):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    import app
+    with app.app.app_context():
+        app.db.create_all()
+        user = app.User(username='bench')
+        user.hash_password(password='bench')
+        app.db.session.add(user)
+        app.db.session.bulk_insert_mappings(app.Product, [
+            {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': index % 500, 'price': 1.0}
+            for index in range(PRODUCTS)])
+        app.db.session.commit()
+
+
+def more_files():
+    # a socket per stream on both sides
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(database, port, worker_class, workers, threads, clients):
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + database, JOB_WORKER_THREADS='0',
+        SLOW_QUERY_SECONDS='60', STREAM_HEARTBEAT_SECONDS='5', GUNICORN_WORKER_CLASS=worker_class)
+    # the gunicorn entry point, its package has no __main__. The settings of gunicorn.conf.py
+    # with the worker class and counts of the run
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+        '--config', os.path.join(ROOT, 'gunicorn.conf.py'),
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--worker-class', worker_class,
+        '--threads', str(threads), '--worker-connections', str(clients + 100), '--backlog', str(clients + 100),
+        '--timeout', '120', '--log-level', 'warning', '--chdir', ROOT, 'wsgi:app']
+    server = subprocess.Popen(command, env=env, preexec_fn=more_files)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def sign_in(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=TIMEOUT)
+    connection.request('POST', '/signin', urllib.parse.urlencode({'username': 'bench', 'password': 'bench'}),
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.getheader('Set-Cookie').split(';')[0]
+
+
+def worker_rss(server):
+    # resident memory of the gunicorn workers in MB
+    total = 0
+    children = open(f'/proc/{server.pid}/task/{server.pid}/children').read().split()
+    for pid in children:
+        for line in open(f'/proc/{pid}/status'):
+            if line.startswith('VmRSS:'):
+                total += int(line.split()[1])
+    return total / 1024
+
+
+class Streams:
+    # the event streams of many browsers read by one thread
+    def __init__(self, port, cookie, count):
+        self.selector = selectors.DefaultSelector()
+        self.connected = 0
+        # (product id, quantity) -> time it was pushed to each stream
+        self.received = {}
+        self.lock = threading.Lock()
+        self.running = True
+        request = (f'GET /stream/products HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: {cookie}\r\n'
+            'Accept: text/event-stream\r\n\r\n').encode()
+        for _ in range(count):
+            client = socket.create_connection(('127.0.0.1', port))
+            client.sendall(request)
+            client.setblocking(False)
+            self.selector.register(client, selectors.EVENT_READ, {'buffer': b'', 'connected': False})
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                now = time.perf_counter()
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    continue
+                state = key.data
+                state['buffer'] += data
+                *events, state['buffer'] = state['buffer'].split(b'\n\n')
+                for event in events:
+                    # a busy feed only sends its longer retry and closes the stream
+                    if event.endswith(b'retry: 3000') and not state['connected']:
+                        state['connected'] = True
+                        with self.lock:
+                            self.connected += 1
+                    for line in event.split(b'\n'):
+                        if line.startswith(b'data: '):
+                            with self.lock:
+                                for product_id, quantity in json.loads(line[6:]).items():
+                                    self.received.setdefault((int(product_id), quantity), []).append(now)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+def run(worker_class, clients, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = os.path.join(tmp_dir, 'bench.sqlite')
+        process = multiprocessing.get_context('spawn').Process(target=seed, args=(database,))
+        process.start()
+        process.join()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = start_server(database, port, worker_class, args.workers, args.threads, clients)
+        try:
+            cookie = sign_in(port)
+            streams = Streams(port, cookie, clients)
+            deadline = time.monotonic() + TIMEOUT
+            while streams.connected < clients and time.monotonic() < deadline:
+                time.sleep(0.1)
+            # the pages are open, the feed has had its first poll
+            time.sleep(1)
+            connected = streams.connected
+            sent = {}
+            for index in range(args.writes):
+                product_id = index % PRODUCTS + 1
+                quantity = 10000 + index
+                form = urllib.parse.urlencode({'code': f'P{product_id - 1:07d}', 'name': f'Product {product_id - 1}',
+                    'quantity': quantity, 'price': 1.0})
+                start = time.perf_counter()
+                try:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=TIMEOUT)
+                    connection.request('POST', f'/edit_product/{product_id}', form,
+                        {'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie})
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                    if response.status in (200, 302):
+                        sent[(product_id, quantity)] = start
+                except OSError:
+                    # every worker thread is held by a stream, the next edits would wait as well
+                    break
+                time.sleep(0.1)
+            time.sleep(3 * float(os.environ.get('CHANGE_FEED_INTERVAL', 0.5)) + 1)
+            rss = worker_rss(server)
+            streams.close()
+            latencies = [(received - sent[key]) * 1000 for key in sent for received in streams.received.get(key, [])]
+        finally:
+            server.terminate()
+            server.wait()
+    expected = len(sent) * connected
+    return {
+        'connected': connected,
+        'writes': len(sent),
+        'delivered': len(latencies) / expected * 100 if expected else 0.0,
+        'p50': statistics.median(latencies) if latencies else float('nan'),
+        'p99': sorted(latencies)[int(len(latencies) * 0.99)] if latencies else float('nan'),
+        'rss': rss,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', default='100,1000')
+    parser.add_argument('--worker-classes', default='gthread,gevent')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=20)
+    args = parser.parse_args()
+    more_files()
+
+    print(f'{"worker class":<14} {"clients":>8} {"streams":>8} {"edits":>6} {"delivered":>10} '
+        f'{"p50 ms":>8} {"p99 ms":>8} {"rss MB":>8}')
+    for worker_class in args.worker_classes.split(','):
+        for clients in [int(count) for count in args.clients.split(',')]:
+            result = run(worker_class, clients, args)
+            print(f'{worker_class:<14} {clients:>8} {result["connected"]:>8} {result["writes"]:>6} '
+                f'{result["delivered"]:>9.1f}% {result["p50"]:>8.1f} {result["p99"]:>8.1f} {result["rss"]:>8.1f}')
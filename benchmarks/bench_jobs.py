@@ -0,0 +1,163 @@
+# benchmark of the background jobs
+# latency: the Load Products and Apply Adjustment requests against the size of the worksheet,
+# they only queue a job so they should stay flat while the job itself grows with the sheet.
+# The worksheet is viewed before each request, the way it is open in the browser when clicked
+# throughput: jobs per second drained from the job table by 1, 2 and 4 worker processes,
+# with empty jobs (the cost of claiming and finishing a job) and with load products jobs
+# usage: python benchmarks/bench_jobs.py [--sizes 1000,10000,100000] [--jobs 1000] [--workers 1,2,4]
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+REPEAT = 5
+# products put in every document of the load products throughput run
+DOCUMENT_PRODUCTS = 200
+
+
+def open_app(database):
+    # the app on its own database, in a child process so every run starts from a fresh module
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.environ['SLOW_QUERY_SECONDS'] = '60'
+    # nothing runs the jobs but the benchmark
+    os.environ['JOB_WORKER_THREADS'] = '0'
+    import logging
+    import app
+    logging.getLogger('app').disabled = True
+    logging.getLogger('jobs').disabled = True
+    app.job_queue.handler('empty')(empty_job)
+    return app
+
+
+def empty_job(job):
+    return {'message': 'done'}
+
+
+def seed(app, product_count, document_count=1):
+    db = app.db
+    db.create_all()
+    user = app.User(username='bench')
+    user.hash_password(password='bench')
+    db.session.add(user)
+    db.session.add_all([app.AdjustmentHeader(id=index + 1, description=f'Adjustment {index + 1}', status='New')
+        for index in range(document_count)])
+    db.session.commit()
+    db.session.bulk_insert_mappings(app.Product, [
+        {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': index % 500, 'price': 1.0}
+        for index in range(product_count)])
+    db.session.commit()
+
+
+def measure_latency(size, database, results):
+    app = open_app(database)
+    with app.app.app_context():
+        seed(app, size)
+        app.db.session.remove()
+    client = app.app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+
+    def timed(call):
+        start = time.perf_counter()
+        response = call()
+        assert response.status_code == 200, response.status_code
+        return (time.perf_counter() - start) * 1000
+
+    request_ms = {'load': [], 'apply': []}
+    job_ms = {'load': [], 'apply': []}
+    detail_table = app.AdjustmentDetail.__table__
+    for _ in range(REPEAT):
+        with app.app.app_context():
+            app.db.session.execute(detail_table.delete())
+            app.db.session.commit()
+            app.db.session.remove()
+        client.get('/adjustment/1')
+        request_ms['load'].append(timed(lambda: client.post('/adjustment/1', data={'submit_type': 'load_products'})))
+        with app.app.app_context():
+            start = time.perf_counter()
+            app.job_queue.run_pending()
+            job_ms['load'].append((time.perf_counter() - start) * 1000)
+            changed = [line_id for (line_id,) in app.db.session.query(app.AdjustmentDetail.id).limit(10)]
+            app.db.session.remove()
+        form = {str(line_id): '3' for line_id in changed}
+        client.get('/adjustment/1')
+        request_ms['apply'].append(timed(lambda: client.post('/adjustment/1', data=dict(form, submit_type='apply_adjustment'))))
+        with app.app.app_context():
+            start = time.perf_counter()
+            app.job_queue.run_pending()
+            job_ms['apply'].append((time.perf_counter() - start) * 1000)
+            app.db.session.remove()
+    results.put({name: (statistics.median(request_ms[name]), statistics.median(job_ms[name])) for name in request_ms})
+
+
+def drain(database, results):
+    # one worker process, runs jobs until the queue is empty
+    app = open_app(database)
+    with app.app.app_context():
+        results.put(app.job_queue.run_pending())
+        app.db.session.remove()
+
+
+def measure_throughput(kind, job_count, worker_count, database, results):
+    app = open_app(database)
+    with app.app.app_context():
+        if kind == 'empty':
+            seed(app, 0)
+            params = [('empty', {}) for _ in range(job_count)]
+        else:
+            seed(app, DOCUMENT_PRODUCTS, job_count)
+            params = [('load_products', {'document': 'adjustment', 'header_id': index + 1}) for index in range(job_count)]
+        for job_kind, job_params in params:
+            app.job_queue.submit(job_kind, job_params)
+        app.db.session.remove()
+        app.db.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    done = context.Queue()
+    start = time.perf_counter()
+    workers = [context.Process(target=drain, args=(database, done)) for _ in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    counts = [done.get() for _ in workers]
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    results.put((sum(counts), elapsed))
+
+
+def in_child(target, *args):
+    # every measure in a fresh process with its own database
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process = context.Process(target=target, args=args + (os.path.join(tmp_dir, 'bench.sqlite'), results))
+        process.start()
+        result = results.get()
+        process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--workers', default='1,2,4')
+    args = parser.parse_args()
+
+    print(f'{"products":>10} {"load request":>13} {"load job":>10} {"apply request":>14} {"apply job":>10}   (median ms)')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        latency = in_child(measure_latency, size)
+        print(f'{size:>10} {latency["load"][0]:>13.1f} {latency["load"][1]:>10.1f} '
+            f'{latency["apply"][0]:>14.1f} {latency["apply"][1]:>10.1f}')
+
+    print(f'\n{"jobs":<20} {"workers":>8} {"jobs/s":>10}')
+    for kind, job_count in (('empty', args.jobs), ('load_products', max(1, args.jobs // 10))):
+        for worker_count in [int(count) for count in args.workers.split(',')]:
+            count, elapsed = in_child(measure_throughput, kind, job_count, worker_count)
+            assert count == job_count, f'{count} of {job_count} jobs run'
+            print(f'{kind:<20} {worker_count:>8} {count / elapsed:>10.0f}')
@@ -0,0 +1,49 @@
+# rows per second of the streaming product import
+# usage: python benchmarks/bench_product_import.py [rows] [chunk size]
+import csv
+import os
+import resource
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import app, db, Product
+from product_import import import_products, read_rows, error_file_writer
+
+
+def write_catalog(path, row_count):
+    # every 100th row is invalid and every 250th row repeats an earlier code
+    with open(path, 'w', newline='') as stream:
+        writer = csv.writer(stream)
+        writer.writerow(['code', 'name', 'quantity', 'price'])
+        for index in range(row_count):
+            code = f'P{index - 1:07d}' if index % 250 == 249 else f'P{index:07d}'
+            quantity = 'many' if index % 100 == 99 else index % 500
+            writer.writerow([code, f'Product {index}', quantity, f'{index % 1000 / 10:.2f}'])
+
+
+if __name__ == '__main__':
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        catalog_path = os.path.join(tmp_dir, 'catalog.csv')
+        write_catalog(catalog_path, row_count)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite')
+
+        with app.app_context():
+            db.create_all()
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            with open(catalog_path, newline='') as stream, \
+                    open(os.path.join(tmp_dir, 'errors.csv'), 'w', newline='') as errors_file, \
+                    db.engine.connect() as connection:
+                result = import_products(connection, Product.__table__, read_rows(stream, 'csv'),
+                    chunk_size=chunk_size, on_error=error_file_writer(errors_file))
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            assert Product.query.count() == result.inserted
+            db.session.remove()
+            db.engine.dispose()
+
+    print(f'{result.read} rows read, {result.inserted} imported, {result.errors} rejected')
+    print(f'{result.elapsed:.2f}s, {result.read / result.elapsed:.0f} rows/s, '
+        f'peak rss grew by {(rss_after - rss_before) / 1024:.1f}MB')
@@ -0,0 +1,86 @@
+# time of every report against a synthetic database, each must answer within the budget
+# usage: python benchmarks/bench_reports.py [rows] [budget ms]
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import app, db, read_session, instrumentation, Product, Customer, PurchaseHeader, PurchaseDetail
+from reports import stock_valuation, low_stock, purchase_variance, balance_brackets
+
+BATCH_SIZE = 50000
+# lines per purchase document
+DOCUMENT_LINES = 100000
+
+
+def seed(row_count):
+    # row_count products, customers and purchase lines, one purchase document in ten is received
+    rng = random.Random(1)
+    connection = db.session.connection()
+    document_count = max(1, row_count // DOCUMENT_LINES)
+    connection.execute(PurchaseHeader.__table__.insert(), [
+        {'id': index + 1, 'description': f'Purchase {index + 1}', 'status': 'Received' if index % 10 == 0 else 'New'}
+        for index in range(document_count)])
+    for start in range(0, row_count, BATCH_SIZE):
+        batch = range(start, min(start + BATCH_SIZE, row_count))
+        connection.execute(Product.__table__.insert(), [
+            {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': rng.randrange(-5, 500),
+                'price': round(rng.uniform(1, 100), 2)}
+            for index in batch])
+        connection.execute(Customer.__table__.insert(), [
+            {'fullname': f'Customer {index}', 'balance': round(rng.uniform(-100, 20000), 2), 'remarks': ''}
+            for index in batch])
+        lines = []
+        for index in batch:
+            ordered = rng.randrange(0, 50)
+            lines.append({'purchase_header_id': 1 + index // DOCUMENT_LINES % document_count, 'product_id': index + 1,
+                'quantity_purchase': ordered, 'quantity_receive': ordered if rng.random() < 0.9 else rng.randrange(0, 50)})
+        connection.execute(PurchaseDetail.__table__.insert(), lines)
+    db.session.commit()
+
+
+def time_report(name, run, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return name, statistics.median(timings), max(timings)
+
+
+if __name__ == '__main__':
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite')
+        # only the statements over the budget go to the slow query log
+        instrumentation.slow_query_seconds = budget_ms / 1000
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            seed(row_count)
+            print(f'seeded {row_count} products, customers and purchase lines in {time.perf_counter() - start:.1f}s')
+
+            connection = read_session().connection()
+            results = [
+                time_report('stock valuation', lambda: stock_valuation(connection, Product.__table__), 5),
+                time_report('low and zero stock', lambda: low_stock(connection, Product.__table__), 5),
+                time_report('purchase variance', lambda: purchase_variance(connection,
+                    PurchaseHeader.__table__, PurchaseDetail.__table__, Product.__table__), 5),
+                time_report('customer balances', lambda: balance_brackets(connection, Customer.__table__), 5),
+            ]
+            read_session.remove()
+            db.session.remove()
+            db.engine.dispose()
+
+    print(f'{"report":<20} {"median ms":>10} {"max ms":>10}')
+    for name, median, worst in results:
+        print(f'{name:<20} {median:>10.1f} {worst:>10.1f}')
+    slow = [name for name, median, worst in results if median > budget_ms]
+    if slow:
+        print(f'over the {budget_ms:.0f}ms budget: {", ".join(slow)}')
+        sys.exit(1)
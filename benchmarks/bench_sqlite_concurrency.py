@@ -0,0 +1,107 @@
+# concurrent read/write load test of the sqlite storage profile
+# runs reader and writer processes against the real routes, once with sqlite's
+# default settings and once with the SQLITE_PRAGMAS profile and connection pool
+# usage: python benchmarks/bench_sqlite_concurrency.py [seconds] [readers] [writers]
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+PRODUCT_COUNT = 200
+
+
+def configure(profile, database):
+    from app import app
+    from storage import SQLITE_PRAGMAS, sqlite_engine_options
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    if profile == 'default':
+        app.config['SQLITE_PRAGMAS'] = {}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+    else:
+        app.config['SQLITE_PRAGMAS'] = SQLITE_PRAGMAS
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_engine_options()
+    logging.getLogger('app').disabled = True
+    return app
+
+
+def seed(database):
+    from app import app, db, User, Product, AdjustmentHeader, PurchaseHeader, load_products, AdjustmentDetail
+    configure('default', database)
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench')
+        user.hash_password(password='bench')
+        db.session.add(user)
+        db.session.add(AdjustmentHeader(id=1, description='Stock Adjustment', status='New'))
+        db.session.add(PurchaseHeader(id=1, description='Stock Purchase', status='New'))
+        db.session.bulk_insert_mappings(Product, [
+            {'code': f'P{index:06d}', 'name': f'Product {index}', 'quantity': index, 'price': 1.0}
+            for index in range(PRODUCT_COUNT)
+        ])
+        db.session.commit()
+        load_products(AdjustmentDetail, 'adjustment_header_id', 1, quantity_adjust=0)
+        db.session.remove()
+        db.engine.dispose()
+
+
+def run_client(profile, database, role, seconds, results):
+    app = configure(profile, database)
+    client = app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    save_form = {str(line_id): str(line_id % 7) for line_id in range(1, PRODUCT_COUNT + 1)}
+    save_form['submit_type'] = 'save_adjustment'
+
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if role == 'writer':
+            response = client.post('/adjustment/1', data=save_form)
+        else:
+            response = client.get('/products')
+        if response.status_code == 200:
+            done += 1
+        else:
+            errors += 1
+    results.put((role, done, errors))
+
+
+def run_profile(profile, seed_database, seconds, readers, writers):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = os.path.join(tmp_dir, 'bench.sqlite')
+        shutil.copy(seed_database, database)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=run_client, args=(profile, database, role, seconds, results))
+            for role in ['reader'] * readers + ['writer'] * writers
+        ]
+        for client in clients:
+            client.start()
+        totals = {'reader': [0, 0], 'writer': [0, 0]}
+        for _ in clients:
+            role, done, errors = results.get()
+            totals[role][0] += done
+            totals[role][1] += errors
+        for client in clients:
+            client.join()
+    return totals
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+    with tempfile.TemporaryDirectory() as seed_dir:
+        seed_database = os.path.join(seed_dir, 'seed.sqlite')
+        seed(seed_database)
+        print(f'{readers} readers, {writers} writers, {seconds:.0f}s per profile')
+        print(f'{"profile":>8} {"reads/s":>9} {"writes/s":>9} {"errors":>7}')
+        for profile in ('default', 'tuned'):
+            totals = run_profile(profile, seed_database, seconds, readers, writers)
+            print(f'{profile:>8} {totals["reader"][0] / seconds:>9.1f} {totals["writer"][0] / seconds:>9.1f} '
+                f'{totals["reader"][1] + totals["writer"][1]:>7}')
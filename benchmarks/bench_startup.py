@@ -0,0 +1,139 @@
+# benchmark of the web process start: gunicorn as the Procfile used to start it (sync workers,
+# every worker imports the app), with gunicorn.conf.py and sync workers, with gunicorn.conf.py
+# as it is (gthread) and with gevent workers. For each it prints the seconds until the first response, until every
+# worker answered a products page, and the memory of the master and workers once warm: the
+# proportional set size (shared pages split between the processes) and the private memory
+# usage: python benchmarks/bench_startup.py [--workers 4] [--repeat 3]
+import argparse
+import http.client
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+PRODUCTS = 1000
+TIMEOUT = 60
+
+
+def seed(database):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    import app
+    with app.app.app_context():
+        app.db.create_all()
+        user = app.User(username='bench')
+        user.hash_password(password='bench')
+        app.db.session.add(user)
+        app.db.session.bulk_insert_mappings(app.Product, [
+            {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': index % 500, 'price': 1.0}
+            for index in range(PRODUCTS)])
+        app.db.session.commit()
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=TIMEOUT)
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response
+
+
+def memory(pid):
+    # (pss, private) in KB of a process
+    values = {}
+    for line in open(f'/proc/{pid}/smaps_rollup'):
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == 'kB':
+            values[parts[0].rstrip(':')] = int(parts[1])
+    return values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def start(setup, database, port, workers, empty_config):
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + database, JOB_WORKER_THREADS='0',
+        SLOW_QUERY_SECONDS='60', WEB_CONCURRENCY=str(workers), PORT=str(port))
+    # the gunicorn entry point, its package has no __main__
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '--log-level', 'warning']
+    if setup == 'before':
+        command += ['--config', empty_config, '--bind', f'127.0.0.1:{port}', '--workers', str(workers), 'app:app']
+    else:
+        env['GUNICORN_WORKER_CLASS'] = setup
+        command += ['--config', os.path.join(ROOT, 'gunicorn.conf.py'), 'wsgi:app']
+    return subprocess.Popen(command, env=env, cwd=ROOT)
+
+
+def measure(setup, workers):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = os.path.join(tmp_dir, 'bench.sqlite')
+        process = multiprocessing.get_context('spawn').Process(target=seed, args=(database,))
+        process.start()
+        process.join()
+        empty_config = os.path.join(tmp_dir, 'empty.conf.py')
+        open(empty_config, 'w').close()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+
+        started = time.perf_counter()
+        server = start(setup, database, port, workers, empty_config)
+        try:
+            while True:
+                try:
+                    if request(port, 'GET', '/').status == 200:
+                        break
+                except OSError:
+                    pass
+                if time.perf_counter() - started > TIMEOUT:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.01)
+            ready = time.perf_counter() - started
+            # signing in is a password check, not part of the start
+            sign_in_start = time.perf_counter()
+            response = request(port, 'POST', '/signin', urllib.parse.urlencode({'username': 'bench', 'password': 'bench'}),
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+            sign_in = time.perf_counter() - sign_in_start
+            cookie = response.getheader('Set-Cookie').split(';')[0]
+            statuses = []
+            pages = [threading.Thread(target=lambda: statuses.append(
+                request(port, 'GET', '/products', headers={'Cookie': cookie}).status)) for _ in range(workers * 4)]
+            for page in pages:
+                page.start()
+            for page in pages:
+                page.join()
+            assert statuses == [200] * len(pages), statuses
+            warm = time.perf_counter() - started - sign_in
+            children = open(f'/proc/{server.pid}/task/{server.pid}/children').read().split()
+            master_pss, _ = memory(server.pid)
+            worker_memory = [memory(pid) for pid in children]
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        'ready': ready,
+        'warm': warm,
+        'pss': (master_pss + sum(pss for pss, _ in worker_memory)) / 1024,
+        'private': sum(private for _, private in worker_memory) / 1024,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"setup":<28} {"first response s":>17} {"all workers s":>14} {"pss MB":>8} {"worker private MB":>18}')
+    for setup, label in (('before', 'sync, app:app'), ('sync', 'sync, gunicorn.conf.py'),
+            ('gthread', 'gthread, gunicorn.conf.py'), ('gevent', 'gevent, gunicorn.conf.py')):
+        runs = [measure(setup, args.workers) for _ in range(args.repeat)]
+        print(f'{label:<28} {statistics.median(run["ready"] for run in runs):>17.2f} '
+            f'{statistics.median(run["warm"] for run in runs):>14.2f} {statistics.median(run["pss"] for run in runs):>8.1f} '
+            f'{statistics.median(run["private"] for run in runs):>18.1f}')
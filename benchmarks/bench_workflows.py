@@ -0,0 +1,369 @@
+# benchmark suite of the inventory workflows
+# seeds a synthetic database per scale (products, customers and worksheet lines), drives the real
+# routes through the flask test client, then through a multi-process http load generator against
+# gunicorn. Records p50/p99 latency, sql statements per request and peak RSS, and compares them
+# with a baseline file so a regression in the hot paths fails the run
+# usage: python benchmarks/bench_workflows.py [--scales 1000,10000,100000] [--save-baseline]
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# a p99 may grow this much over the baseline before it counts as a regression,
+# latencies below NOISE_MS are never compared
+LATENCY_TOLERANCE = 0.5
+NOISE_MS = 5.0
+RSS_TOLERANCE = 0.25
+# lines posted by one save of the http load generator
+HTTP_SAVE_LINES = 50
+
+
+def percentile(values, percent):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies, queries=None):
+    summary = {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+    if queries:
+        summary['queries'] = max(queries)
+    return summary
+
+
+def peak_rss_mb(pid='self'):
+    # VmHWM is the peak resident set of the process
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid == 'self':
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return None
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    # the command may contain spaces, the parent pid is the 2nd field after it
+                    if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return children
+
+
+def seed(scale):
+    # products, customers, one adjustment and one purchase with a line per product
+    from app import db, User, Product, Customer, AdjustmentHeader, AdjustmentDetail, \
+        PurchaseHeader, PurchaseDetail, load_products
+    db.create_all()
+    user = User(username='bench')
+    user.hash_password(password='bench')
+    db.session.add(user)
+    db.session.add(AdjustmentHeader(id=1, description='Stock Adjustment', status='New'))
+    db.session.add(PurchaseHeader(id=1, description='Stock Purchase', status='New'))
+    db.session.commit()
+    for start in range(0, scale, 10000):
+        batch = range(start, min(start + 10000, scale))
+        db.session.bulk_insert_mappings(Product, [
+            {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': index % 500, 'price': 1.0 + index % 97}
+            for index in batch])
+        db.session.bulk_insert_mappings(Customer, [
+            {'fullname': f'Customer {index}', 'balance': float(index % 1000), 'remarks': ''}
+            for index in batch])
+        db.session.commit()
+    load_products(AdjustmentDetail, 'adjustment_header_id', 1, quantity_adjust=0)
+    load_products(PurchaseDetail, 'purchase_header_id', 1, quantity_purchase=0, quantity_receive=0)
+    db.session.remove()
+
+
+def run_in_process(scale, database, iterations, results):
+    # every workflow through the flask test client, in a child process so the peak RSS is per scale
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.environ['SLOW_QUERY_SECONDS'] = '60'
+    # the load and apply jobs run inside the request, the timings stay those of the whole operation
+    os.environ['JOBS_EAGER'] = '1'
+    from app import app, db, instrumentation, AdjustmentDetail, PurchaseDetail, Product
+    from sqlalchemy import select
+    instrumentation.server_timing = True
+
+    with app.app_context():
+        start = time.perf_counter()
+        seed(scale)
+        seed_seconds = time.perf_counter() - start
+
+        adjustment_lines = [row[0] for row in db.session.execute(
+            select([AdjustmentDetail.id]).where(AdjustmentDetail.adjustment_header_id == 1))]
+        purchase_lines = db.session.execute(
+            select([PurchaseDetail.id, Product.code]).select_from(
+                PurchaseDetail.__table__.join(Product.__table__, PurchaseDetail.product_id == Product.id))
+            .where(PurchaseDetail.purchase_header_id == 1)).fetchall()
+        db.session.remove()
+
+    client = app.test_client()
+    measured = {}
+
+    def measure(name, call):
+        start = time.perf_counter()
+        response = call()
+        elapsed = time.perf_counter() - start
+        assert response.status_code in (200, 302), f'{name}: {response.status_code}'
+        timing = re.search(r'desc="(\d+) queries"', response.headers.get('Server-Timing', ''))
+        latencies, queries = measured.setdefault(name, ([], []))
+        latencies.append(elapsed)
+        queries.append(int(timing.group(1)) if timing else 0)
+        return response
+
+    credentials = {'username': 'bench', 'password': 'bench'}
+    for _ in range(iterations):
+        measure('signin', lambda: client.post('/signin', data=credentials))
+        measure('products', lambda: client.get('/products'))
+        measure('products_search', lambda: client.get('/products?q=P00012'))
+
+    # load products into a new document each time, the lines are deleted afterwards
+    for _ in range(max(1, iterations // 4)):
+        for kind, detail_model, header_column in (
+                ('adjustment', AdjustmentDetail, 'adjustment_header_id'),
+                ('purchase', PurchaseDetail, 'purchase_header_id')):
+            location = client.post(f'/{kind}s', data={'description': 'Benchmark'}).headers['Location']
+            path = urllib.parse.urlsplit(location).path
+            measure(f'{kind}_load', lambda: client.post(path, data={'submit_type': 'load_products'}))
+            with app.app_context():
+                header_id = int(path.rsplit('/', 1)[1])
+                db.session.execute(detail_model.__table__.delete().where(
+                    detail_model.__table__.c[header_column] == header_id))
+                db.session.commit()
+                db.session.remove()
+
+    for iteration in range(iterations):
+        adjustment_form = {str(line_id): str((line_id + iteration) % 500) for line_id in adjustment_lines}
+        measure('adjustment_view', lambda: client.get('/adjustment/1'))
+        measure('adjustment_save', lambda: client.post('/adjustment/1',
+            data=dict(adjustment_form, submit_type='save_adjustment')))
+        measure('adjustment_apply', lambda: client.post('/adjustment/1',
+            data=dict(adjustment_form, submit_type='apply_adjustment')))
+
+        purchase_form = {}
+        for line_id, code in purchase_lines:
+            purchase_form[f'PURCHASE-{line_id}-{code}'] = '2'
+            purchase_form[f'RECEIVE-{line_id}-{code}'] = '2'
+        measure('purchase_view', lambda: client.get('/purchase/1'))
+        for step in ('start', 'receive', 'apply'):
+            measure(f'purchase_{step}', lambda: client.post('/purchase/1',
+                data=dict(purchase_form, submit_type=f'{step}_purchase')))
+
+    with app.app_context():
+        db.engine.dispose()
+    results.put({
+        'seed_seconds': round(seed_seconds, 2),
+        'routes': {name: summarize(latencies, queries) for name, (latencies, queries) in sorted(measured.items())},
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database, port, workers):
+    # the web process of the Procfile with the settings of gunicorn.conf.py, only the bind
+    # address and the number of workers are set here
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + database, SLOW_QUERY_SECONDS='60', PYTHONPATH=ROOT,
+        JOB_WORKER_THREADS='0', COUNTER_CACHE_SHARED='1', WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+            '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'wsgi:app'],
+        cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def http_client(port, seconds, line_ids, seed_value, results):
+    # one keep-alive connection, signs in then hits a mix of pages for `seconds`
+    rng = random.Random(seed_value)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def call(method, path, form=None):
+        body = urllib.parse.urlencode(form) if form is not None else None
+        headers = {'Cookie': cookie} if cookie else {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        start = time.perf_counter()
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response, time.perf_counter() - start
+
+    cookie = None
+    response, elapsed = call('POST', '/signin', {'username': 'bench', 'password': 'bench'})
+    cookie = response.getheader('Set-Cookie', '').split(';', 1)[0]
+    measured = {'signin': [elapsed]}
+    errors = 0
+
+    mix = [('products', 'GET', '/products')] * 4 + [
+        ('products_page', 'GET', '/products/page?limit=50'),
+        ('adjustment_view', 'GET', '/adjustment/1'),
+        ('purchase_view', 'GET', '/purchase/1'),
+        ('adjustment_save', 'POST', '/adjustment/1'),
+    ]
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        name, method, path = rng.choice(mix)
+        form = None
+        if name == 'adjustment_save':
+            form = {str(line_id): str(rng.randrange(500)) for line_id in rng.sample(line_ids, min(HTTP_SAVE_LINES, len(line_ids)))}
+            form['submit_type'] = 'save_adjustment'
+        response, elapsed = call(method, path, form)
+        if response.status != 200:
+            errors += 1
+        measured.setdefault(name, []).append(elapsed)
+    connection.close()
+    results.put((measured, errors))
+
+
+def run_http(database, seconds, clients, workers):
+    import sqlite3
+    with sqlite3.connect(database) as connection:
+        line_ids = [row[0] for row in connection.execute('SELECT id FROM adjustment_detail WHERE adjustment_header_id = 1')]
+    port = free_port()
+    server = start_server(database, port, workers)
+    try:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=http_client, args=(port, seconds, line_ids, index, results))
+            for index in range(clients)]
+        for process in processes:
+            process.start()
+        measured = {}
+        errors = 0
+        for _ in processes:
+            client_measured, client_errors = results.get()
+            errors += client_errors
+            for name, latencies in client_measured.items():
+                measured.setdefault(name, []).extend(latencies)
+        for process in processes:
+            process.join()
+        worker_rss = [peak_rss_mb(pid) for pid in child_pids(server.pid)]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+    requests = sum(len(latencies) for latencies in measured.values())
+    return {
+        'requests_per_second': round(requests / seconds, 1),
+        'errors': errors,
+        'routes': {name: summarize(latencies) for name, latencies in sorted(measured.items())},
+        'peak_rss_mb': max((rss for rss in worker_rss if rss), default=None),
+    }
+
+
+def compare(results, baseline):
+    # regressions against the baseline, as readable lines
+    regressions = []
+    for scale, scale_results in results.items():
+        for mode in ('in_process', 'http'):
+            current = scale_results.get(mode)
+            previous = baseline.get(scale, {}).get(mode)
+            if not current or not previous:
+                continue
+            for name, summary in current['routes'].items():
+                before = previous['routes'].get(name)
+                if not before:
+                    continue
+                if 'queries' in summary and 'queries' in before and summary['queries'] > before['queries']:
+                    regressions.append(f'{scale} {mode} {name}: {summary["queries"]} queries, baseline {before["queries"]}')
+                if summary['p99_ms'] > NOISE_MS and summary['p99_ms'] > before['p99_ms'] * (1 + LATENCY_TOLERANCE):
+                    regressions.append(f'{scale} {mode} {name}: p99 {summary["p99_ms"]}ms, baseline {before["p99_ms"]}ms')
+            if current.get('peak_rss_mb') and previous.get('peak_rss_mb') and \
+                    current['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + RSS_TOLERANCE):
+                regressions.append(f'{scale} {mode}: peak RSS {current["peak_rss_mb"]}MB, baseline {previous["peak_rss_mb"]}MB')
+    return regressions
+
+
+def print_results(scale, mode, result):
+    print(f'\n{scale} rows, {mode}, peak RSS {result.get("peak_rss_mb")} MB'
+        + (f', {result["requests_per_second"]} requests/s, {result["errors"]} errors' if mode == 'http' else ''))
+    print(f'{"route":<18} {"count":>6} {"p50 ms":>9} {"p99 ms":>9} {"queries":>8}')
+    for name, summary in result['routes'].items():
+        print(f'{name:<18} {summary["count"]:>6} {summary["p50_ms"]:>9} {summary["p99_ms"]:>9} {summary.get("queries", ""):>8}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', default='1000', help='comma separated product counts, e.g. 1000,10000,100000')
+    parser.add_argument('--iterations', type=int, default=20, help='test client calls per route')
+    parser.add_argument('--http-seconds', type=float, default=10, help='0 skips the http load')
+    parser.add_argument('--http-clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args()
+
+    results = {}
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = os.path.join(tmp_dir, 'bench.sqlite')
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_in_process, args=(scale, database, args.iterations, queue))
+            process.start()
+            in_process = queue.get()
+            process.join()
+            results[str(scale)] = {'in_process': in_process}
+            print(f'\nseeded {scale} rows in {in_process["seed_seconds"]}s')
+            print_results(scale, 'test client', in_process)
+            if args.http_seconds > 0:
+                http_results = run_http(database, args.http_seconds, args.http_clients, args.workers)
+                results[str(scale)]['http'] = http_results
+                print_results(scale, 'http', http_results)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print(f'\nbaseline written to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        if regressions:
+            print('\nregressions against the baseline:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('\nno regression against the baseline')
@@ -0,0 +1,80 @@
+# micro-benchmark of the worksheet form parser against the old str()/ast.literal_eval parsing
+# usage: python benchmarks/bench_worksheet_form.py [number of lines]
+import ast
+import os
+import sys
+import timeit
+
+from werkzeug.datastructures import ImmutableMultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from worksheet_form import parse_adjustment_form, parse_purchase_form
+
+
+def legacy_parse(form):
+    # the form parsing purchase() and adjustment() used before worksheet_form
+    raw_datas = form.to_dict(flat=False)
+    raw_datas = str(raw_datas).replace("[", "")
+    raw_datas = str(raw_datas).replace("]", "")
+    return ast.literal_eval(raw_datas)
+
+
+def legacy_parse_purchase(form):
+    purch_lines = legacy_parse(form)
+    purch_lines.pop('submit_type')
+    temp_purch_list = []
+    purch_lines_new = []
+    for temp in purch_lines:
+        temp_char = temp.split('-')
+        temp_char.append(str(purch_lines[temp]))
+        if temp_char[0] == 'PURCHASE':
+            temp_purch_list.append({'id': temp_char[1], 'prod_code': temp_char[2],
+                'purch_qty': temp_char[3], 'receive_qty': '0'})
+    for temp in purch_lines:
+        temp_char = temp.split('-')
+        temp_char.append(str(purch_lines[temp]))
+        if temp_char[0] == 'RECEIVE':
+            for item in temp_purch_list:
+                if item['prod_code'] == temp_char[2]:
+                    item['receive_qty'] = str(purch_lines[temp])
+                    purch_lines_new.append(item)
+    return purch_lines_new
+
+
+def legacy_parse_adjustment(form):
+    adj_lines = legacy_parse(form)
+    adj_lines.pop('submit_type')
+    return {int(adj_id): int(adj_lines[adj_id]) for adj_id in adj_lines}
+
+
+def purchase_form(line_count):
+    fields = [('submit_type', 'save_purchase')]
+    for line_id in range(1, line_count + 1):
+        fields.append((f'PURCHASE-{line_id}-P{line_id:06d}', str(line_id % 50)))
+        fields.append((f'RECEIVE-{line_id}-P{line_id:06d}', str(line_id % 40)))
+    return ImmutableMultiDict(fields)
+
+
+def adjustment_form(line_count):
+    fields = [('submit_type', 'save_adjustment')]
+    fields.extend((str(line_id), str(line_id % 50)) for line_id in range(1, line_count + 1))
+    return ImmutableMultiDict(fields)
+
+
+def best_of(func, form, repeat=5):
+    return min(timeit.repeat(lambda: func(form), number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [100, 1000, 5000]
+    print(f'{"lines":>8} {"form":>12} {"legacy":>10} {"parser":>10} {"speedup":>8}')
+    for line_count in sizes:
+        for name, form, legacy, parser in (
+            ('adjustment', adjustment_form(line_count), legacy_parse_adjustment, parse_adjustment_form),
+            ('purchase', purchase_form(line_count), legacy_parse_purchase, parse_purchase_form),
+        ):
+            # the quadratic purchase loop gets slow quickly, run it once only on big forms
+            legacy_time = best_of(legacy, form, repeat=1 if line_count > 1000 else 5)
+            parser_time = best_of(parser, form)
+            print(f'{line_count:>8} {name:>12} {legacy_time * 1000:>8.1f}ms {parser_time * 1000:>8.1f}ms '
+                f'{legacy_time / parser_time:>7.1f}x')
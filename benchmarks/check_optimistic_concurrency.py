@@ -0,0 +1,133 @@
+# contention check of the optimistic locking: threads read a product, a customer and an
+# adjustment line through their forms, add one and post it back with the version they read,
+# starting over when the write is rejected as stale, while other threads receive purchases
+# of the same product. No increment and no received quantity may be lost
+# usage: python benchmarks/check_optimistic_concurrency.py [threads] [increments]
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import app, db, load_products, User, Product, Customer, StockMovement, \
+    AdjustmentHeader, AdjustmentDetail, PurchaseHeader, PurchaseDetail
+
+RECEIVERS = 2
+RECEIPTS = 10
+
+
+def seed():
+    db.create_all()
+    user = User(username='bench')
+    user.hash_password(password='bench')
+    db.session.add(user)
+    db.session.add(Product(code='P000001', name='Product 1', quantity=0, price=1.0))
+    db.session.add(Customer(fullname='Customer 1', balance=0, remarks=''))
+    db.session.add(AdjustmentHeader(id=1, description='Stock Adjustment', status='New'))
+    for receiver in range(RECEIVERS):
+        db.session.add(PurchaseHeader(id=receiver + 1, description=f'Stock Purchase {receiver}', status='New'))
+    db.session.commit()
+    load_products(AdjustmentDetail, 'adjustment_header_id', 1, quantity_adjust=0)
+    for receiver in range(RECEIVERS):
+        load_products(PurchaseDetail, 'purchase_header_id', receiver + 1, quantity_purchase=0, quantity_receive=0)
+
+
+def signed_in_client():
+    client = app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    return client
+
+
+def field_value(html, name):
+    return re.search(f'name="{re.escape(name)}"[^>]*value="([^"]*)"', html).group(1)
+
+
+def increment(client, url, field, fields, extra_form, saved_message):
+    # read, add one, post back with the version read. Returns the number of stale rejections
+    stale = 0
+    while True:
+        html = client.get(url).get_data(as_text=True)
+        form = {name: field_value(html, name) for name in fields}
+        form[field] = str(int(float(form[field])) + 1)
+        form.update(extra_form)
+        html = client.post(url, data=form).get_data(as_text=True)
+        if saved_message in html:
+            return stale
+        assert 'changed by another user' in html, html
+        stale += 1
+
+
+def run_editor(target, increments, results):
+    client = signed_in_client()
+    stale = 0
+    for _ in range(increments):
+        stale += increment(client, *target)
+    results.append(stale)
+
+
+def run_receiver(purchase_id, line_id, results):
+    # start, receive and apply a purchase of one unit, RECEIPTS times
+    client = signed_in_client()
+    url = f'/purchase/{purchase_id}'
+    for _ in range(RECEIPTS):
+        for submit_type in ('start_purchase', 'receive_purchase', 'apply_purchase'):
+            response = client.post(url, data={f'PURCHASE-{line_id}-P000001': '1',
+                f'RECEIVE-{line_id}-P000001': '1', 'submit_type': submit_type})
+            assert response.status_code == 200, response.status_code
+    results.append(RECEIPTS)
+
+
+if __name__ == '__main__':
+    thread_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    increments = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    logging.getLogger('app').disabled = True
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite')
+        # the load and apply jobs run inside the request that submits them
+        app.config['JOBS_EAGER'] = True
+        with app.app_context():
+            seed()
+            adj_line = AdjustmentDetail.query.one()
+            purch_lines = {line.purchase_header_id: line.id for line in PurchaseDetail.query}
+            targets = {
+                'product': ('/edit_product/1', 'quantity', ['code', 'name', 'price', 'quantity', 'version_id'],
+                    {}, 'updated'),
+                'customer': ('/edit_customer/1', 'balance', ['fullname', 'balance', 'remarks', 'version_id'],
+                    {}, 'updated'),
+                'adjustment line': ('/adjustment/1', str(adj_line.id), [str(adj_line.id), f'VERSION-{adj_line.id}'],
+                    {'submit_type': 'save_adjustment'}, 'Adjustment has been Saved!'),
+            }
+            db.session.remove()
+
+            results = {name: [] for name in targets}
+            receipts = []
+            threads = [threading.Thread(target=run_editor, args=(target, increments, results[name]))
+                for name, target in targets.items() for _ in range(thread_count)]
+            threads += [threading.Thread(target=run_receiver, args=(purchase_id, line_id, receipts))
+                for purchase_id, line_id in purch_lines.items()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            product = Product.query.get(1)
+            ledger_quantity = db.session.query(db.func.sum(StockMovement.quantity)).scalar()
+            expected = {
+                'product': (product.quantity, thread_count * increments + sum(receipts)),
+                'customer': (Customer.query.get(1).balance, thread_count * increments),
+                'adjustment line': (AdjustmentDetail.query.get(adj_line.id).quantity_adjust, thread_count * increments),
+            }
+            db.session.remove()
+            db.engine.dispose()
+
+    for name, (value, wanted) in expected.items():
+        print(f'{name}: {value} after {thread_count}x{increments} increments'
+            + (f' and {sum(receipts)} received units' if name == 'product' else '')
+            + f', {sum(results[name])} stale writes rejected and retried')
+        assert len(results[name]) == thread_count, f'{name}: an editor thread failed'
+        assert value == wanted, f'{name}: {wanted - value} updates lost'
+    assert len(receipts) == RECEIVERS, 'a receiver thread failed'
+    assert ledger_quantity == expected['product'][0], 'the stock ledger does not add up to the product quantity'
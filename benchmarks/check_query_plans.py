@@ -0,0 +1,142 @@
+# check that the hot queries use the indexes: every statement sent to the database while the
+# main routes are driven through the test client is run again with EXPLAIN QUERY PLAN, a full
+# scan of a table that is not in ALLOWED_SCANS fails the check
+# usage: python benchmarks/check_query_plans.py [products]
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import app, db, User, Product, Customer, AdjustmentHeader, AdjustmentDetail, PurchaseHeader, PurchaseDetail, \
+    product_changes
+from migrations import migrate
+
+# (statement pattern, table) of the scans that read the whole table on purpose
+ALLOWED_SCANS = [
+    # load products adds a line for every product not in the document yet
+    (r'^INSERT INTO (adjustment|purchase)_detail .* FROM product', 'product'),
+    # the opening balances of a full rebuild and of the products never moved
+    (r'^INSERT INTO stock_movement .* FROM product', 'product'),
+    # the first page of customers walks the primary key and stops at the limit
+    (r'FROM customer ORDER BY customer\.id LIMIT', 'customer'),
+    # the small document tables
+    (r'', 'adjustment_header'),
+    (r'', 'purchase_header'),
+    (r'', 'schema_migration'),
+]
+# SCAN <table> without an index, sqlite 3.36+ writes "SCAN product", older ones "SCAN TABLE product"
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def full_scans(connection, statement, parameters):
+    plan = connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [match.group(1) for match in (FULL_SCAN.match(row[-1]) for row in plan) if match]
+
+
+def drive(client, product_count):
+    # the requests of a working day, ids are those of the seeded database
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    client.get('/home')
+    client.get('/products')
+    page = client.get('/products/page?limit=10').get_json()
+    client.get(f'/products/page?limit=10&after={page["next"]}')
+    client.get('/products?q=P00001')
+    client.get('/products/1/history')
+    client.get('/edit_product/2')
+    client.post('/edit_product/2', data={'code': 'P0000001', 'name': 'Renamed', 'quantity': '7', 'price': '1',
+        'version_id': '1'})
+    # the poll of the stock level stream after the edit
+    product_changes(0)
+    client.get('/customers')
+    client.get('/customers/page?limit=10&after=10')
+
+    client.post('/adjustment/1', data={'submit_type': 'load_products'})
+    client.get('/adjustment/1')
+    lines = [row[0] for row in db.session.query(AdjustmentDetail.id).filter_by(adjustment_header_id=1).limit(20)]
+    client.post('/adjustment/1/lines', data={str(line_id): '5' for line_id in lines})
+    client.post('/adjustment/1', data=dict({str(line_id): '6' for line_id in lines}, submit_type='save_adjustment'))
+    client.delete(f'/adjustment/1/lines/{lines[-1]}')
+    client.post('/adjustment/1', data={'submit_type': f'DEL-{lines[-2]}'})
+    client.post('/adjustment/1', data=dict({str(line_id): '3' for line_id in lines[:5]}, submit_type='apply_adjustment'))
+
+    client.post('/purchase/1', data={'submit_type': 'load_products'})
+    purchase_lines = db.session.query(PurchaseDetail.id, Product.code).join(Product) \
+        .filter(PurchaseDetail.purchase_header_id == 1).limit(20).all()
+    form = {}
+    for line_id, code in purchase_lines:
+        form[f'PURCHASE-{line_id}-{code}'] = '4'
+        form[f'RECEIVE-{line_id}-{code}'] = '3'
+    client.post('/purchase/1/lines', data=form)
+    client.delete(f'/purchase/1/lines/{purchase_lines[-1][0]}')
+    for submit_type in ('save_purchase', 'start_purchase', 'receive_purchase'):
+        client.post('/purchase/1', data=dict(form, submit_type=submit_type))
+    client.get('/reports')
+    client.post('/purchase/1', data=dict(form, submit_type='apply_purchase'))
+    db.session.remove()
+
+    # both products are in the documents, the lookups guarding the delete run either way
+    client.post('/delete_product/3')
+    client.post(f'/delete_product/{product_count}')
+
+
+if __name__ == '__main__':
+    product_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = os.path.join(tmp_dir, 'plans.sqlite')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+        # the load and apply jobs run inside the request that submits them
+        app.config['JOBS_EAGER'] = True
+        with app.app_context():
+            with db.engine.connect() as connection:
+                migrate(connection, db.metadata)
+            user = User(username='bench')
+            user.hash_password(password='bench')
+            db.session.add(user)
+            db.session.add(AdjustmentHeader(id=1, description='Adjustment', status='New'))
+            db.session.add(PurchaseHeader(id=1, description='Purchase', status='New'))
+            db.session.commit()
+            db.session.execute(Product.__table__.insert(), [
+                {'code': f'P{index:07d}', 'name': f'Product {index}', 'quantity': index % 50, 'price': 1.5}
+                for index in range(product_count)])
+            db.session.execute(Customer.__table__.insert(), [
+                {'fullname': f'Customer {index}', 'balance': index * 10.0, 'remarks': ''}
+                for index in range(product_count)])
+            db.session.commit()
+
+            statements = {}
+
+            def capture(conn, cursor, statement, parameters, context, executemany):
+                if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT INTO')) \
+                        and ('SELECT' in statement.upper() or not statement.lstrip().upper().startswith('INSERT')):
+                    statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            # the read session has its own engine, created on first use
+            from app import read_session
+            event.listen(read_session.get_engine(), 'before_cursor_execute', capture)
+            client = app.test_client()
+            drive(client, product_count)
+            event.remove(db.engine, 'before_cursor_execute', capture)
+            db.session.remove()
+            db.engine.dispose()
+
+        failures = []
+        with sqlite3.connect(database) as connection:
+            for statement, parameters in statements.items():
+                one_line = ' '.join(statement.split())
+                for table in full_scans(connection, statement, parameters):
+                    if not any(table == allowed_table and re.search(pattern, one_line)
+                            for pattern, allowed_table in ALLOWED_SCANS):
+                        failures.append((table, one_line))
+
+    print(f'{len(statements)} distinct statements explained')
+    for table, statement in failures:
+        print(f'full scan of {table}: {statement[:200]}')
+    if failures:
+        sys.exit(1)
+    print('every hot query uses an index')
@@ -0,0 +1,75 @@
+# check that rendering the adjustment and purchase worksheets costs the same number of
+# SQL queries whatever the number of lines on the sheet, counted on every engine with the
+# rendered rows out of the fragment cache, and no more than MAX_QUERIES
+# usage: python benchmarks/check_worksheet_queries.py
+import os
+import sys
+import tempfile
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import app, db, fragment_cache, User, Product, AdjustmentHeader, PurchaseHeader
+
+# the table versions, the header and the lines with their products
+MAX_QUERIES = 3
+
+
+def seed(product_count):
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench')
+    user.hash_password(password='bench')
+    db.session.add(user)
+    db.session.add(AdjustmentHeader(id=1, description='Stock Adjustment', status='New'))
+    db.session.add(PurchaseHeader(id=1, description='Stock Purchase', status='New'))
+    db.session.bulk_insert_mappings(Product, [
+        {'code': f'P{index:06d}', 'name': f'Product {index}', 'quantity': index, 'price': 1.0}
+        for index in range(product_count)
+    ])
+    db.session.commit()
+
+
+def count_queries(client, url):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # a cached sheet makes no query for its lines, the check is on the rendering
+    fragment_cache.invalidate()
+    # the read only routes query on the read engine
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200, response.status_code
+    return len(statements)
+
+
+def worksheet_query_counts(product_count):
+    seed(product_count)
+    client = app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    client.post('/adjustment/1', data={'submit_type': 'load_products'})
+    client.post('/purchase/1', data={'submit_type': 'load_products'})
+    return {url: count_queries(client, url) for url in ('/adjustment/1', '/purchase/1')}
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite')
+        # the load and apply jobs run inside the request that submits them
+        app.config['JOBS_EAGER'] = True
+        with app.app_context():
+            small = worksheet_query_counts(10)
+            large = worksheet_query_counts(2000)
+            db.session.remove()
+            db.engine.dispose()
+
+    for url in small:
+        print(f'{url}: {small[url]} queries with 10 lines, {large[url]} queries with 2000 lines')
+        assert small[url] == large[url], f'{url} query count grows with the worksheet size'
+        assert large[url] <= MAX_QUERIES, f'{url} makes {large[url]} queries, more than {MAX_QUERIES}'
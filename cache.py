@@ -0,0 +1,321 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+# the table an INSERT, UPDATE or DELETE statement writes to
+WRITTEN_TABLE = re.compile(r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+["`\[]?(\w+)',
+    re.IGNORECASE)
+# names of the row counts and table versions in the counters
+ROWS = 'rows:'
+VERSION = 'version:'
+
+
+class CacheStats:
+    # hits and misses of a cache
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        # caller holds the lock
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class TTLCache(CacheStats):
+    # in-process cache, the least recently used entries are dropped above maxsize and entries
+    # older than ttl seconds are loaded again. sizeof(value) is the size of an entry, 1 by default
+    def __init__(self, maxsize=1024, ttl=300, sizeof=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        # key -> (value, tag, loaded at, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    def get(self, key, load, tag=None):
+        # cached value of the key, load() is called on a miss. An entry cached with another tag
+        # is a miss and is replaced, None is never cached
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == tag and time.monotonic() - entry[2] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = load()
+        if value is not None:
+            size = self.sizeof(value)
+            if size <= self.maxsize:
+                with self.lock:
+                    self.drop(key)
+                    self.entries[key] = (value, tag, time.monotonic(), size)
+                    self.size += size
+                    while self.size > self.maxsize:
+                        self.drop(next(iter(self.entries)))
+                        self.evictions += 1
+        return value
+
+    def drop(self, key):
+        # caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self.drop(key)
+
+    def stats(self):
+        with self.lock:
+            return dict(super().stats(), evictions=self.evictions, entries=len(self.entries),
+                size=self.size, maxsize=self.maxsize)
+
+
+class Counters:
+    # named integers with the time they were set, in memory so only this process sees them
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (value, set at)
+        self.values = {}
+
+    def get(self, names):
+        # {name: (value, set at)} of the names that have a value
+        with self.lock:
+            return {name: self.values[name] for name in names if name in self.values}
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = (value, time.time())
+
+    def incr(self, names, delta=1, create=False, connection=None):
+        # adds delta to the counters that have a value, create starts the others at delta
+        with self.lock:
+            for name in names:
+                if name in self.values:
+                    value, set_at = self.values[name]
+                    self.values[name] = (value + delta, set_at)
+                elif create:
+                    self.values[name] = (delta, time.time())
+
+    def delete(self, prefix=''):
+        # the counters whose name starts with prefix
+        with self.lock:
+            for name in [name for name in self.values if name.startswith(prefix)]:
+                del self.values[name]
+
+    def items(self, prefix=''):
+        with self.lock:
+            return {name: value for name, (value, set_at) in self.values.items() if name.startswith(prefix)}
+
+
+class SharedCounters:
+    # the counters in a table of the application database so the gunicorn workers, the job
+    # process and the flask commands all see the changes of the others.
+    # Written through get_engine(), read on get_read_connection(), the connection the request
+    # reads its rows on, when given
+    shared = True
+
+    def __init__(self, table, get_engine, get_read_connection=None):
+        self.table = table
+        self.get_engine = get_engine
+        self.get_read_connection = get_read_connection
+
+    def read(self, query):
+        if self.get_read_connection is None:
+            with self.get_engine().connect() as connection:
+                return connection.execute(query).fetchall()
+        return self.get_read_connection().execute(query).fetchall()
+
+    def get(self, names):
+        # {name: (value, set at)} of the names that have a value
+        table = self.table
+        rows = self.read(select([table.c.name, table.c.value, table.c.set_at]).where(table.c.name.in_(list(names))))
+        return {name: (value, set_at) for name, value, set_at in rows}
+
+    def set(self, name, value):
+        self.upsert(self.get_engine(), [name], value, 'excluded.value')
+
+    def incr(self, names, delta=1, create=False, connection=None):
+        # adds delta to the counters that have a value, create starts the others at delta
+        # in the transaction of connection when given
+        if not names:
+            return
+        if create:
+            self.upsert(connection or self.get_engine(), names, delta, f'{self.table.name}.value + excluded.value')
+        else:
+            table = self.table
+            (connection or self.get_engine()).execute(table.update().where(table.c.name.in_(list(names)))
+                .values(value=table.c.value + delta))
+
+    def upsert(self, connection, names, value, new_value):
+        # INSERT ... ON CONFLICT, on sqlite 3.24+ and postgresql. Sorted so two writers of the
+        # same counters lock them in the same order
+        connection.execute(text(f'INSERT INTO {self.table.name} (name, value, set_at) VALUES (:name, :value, :set_at) '
+            f'ON CONFLICT (name) DO UPDATE SET value = {new_value}, set_at = excluded.set_at'),
+            [{'name': name, 'value': value, 'set_at': time.time()} for name in sorted(names)])
+
+    def delete(self, prefix=''):
+        # the counters whose name starts with prefix
+        table = self.table
+        self.get_engine().execute(table.delete().where(table.c.name.startswith(prefix, autoescape=True)))
+
+    def items(self, prefix=''):
+        table = self.table
+        rows = self.read(select([table.c.name, table.c.value]).where(table.c.name.startswith(prefix, autoescape=True)))
+        return {name: value for name, value in rows}
+
+
+class CounterCache(CacheStats):
+    # row counts kept between requests
+    # the write paths adjust the counts with incr(), the ttl is a fallback for
+    # anything that changes the tables without going through them. A count read from shared
+    # counters is kept local_ttl seconds in the process, the counts of the other processes'
+    # writes show up after that
+    def __init__(self, counters, ttl=300, local_ttl=5):
+        super().__init__()
+        self.counters = counters
+        self.ttl = ttl
+        self.local_ttl = local_ttl if counters.shared else ttl
+        # name -> (value, read at)
+        self.local = {}
+
+    def get(self, name, count):
+        # cached value of the counter, count() is called on a miss or when expired
+        return self.get_many({name: count})[name]
+
+    def get_many(self, counts):
+        # {name: value} of the counters, counts is {name: count()}. The counters not kept in
+        # the process are read together, count() is called for the missing or expired ones
+        values = {}
+        now = time.monotonic()
+        with self.lock:
+            for name in counts:
+                entry = self.local.get(name)
+                if entry is not None and now - entry[1] < self.local_ttl:
+                    values[name] = entry[0]
+        missing = [name for name in counts if name not in values]
+        if missing:
+            stored = self.counters.get([ROWS + name for name in missing])
+            for name in missing:
+                entry = stored.get(ROWS + name)
+                # time.time() as the set time is compared between processes
+                if entry is not None and time.time() - entry[1] < self.ttl:
+                    values[name] = entry[0]
+        counted = [name for name in missing if name not in values]
+        for name in counted:
+            values[name] = counts[name]()
+            self.counters.set(ROWS + name, values[name])
+        with self.lock:
+            self.hits += len(counts) - len(counted)
+            self.misses += len(counted)
+            for name in missing:
+                self.local[name] = (values[name], now)
+        return values
+
+    def incr(self, name, delta=1):
+        self.counters.incr([ROWS + name], delta)
+        with self.lock:
+            entry = self.local.get(name)
+            if entry is not None:
+                self.local[name] = (entry[0] + delta, entry[1])
+
+    def invalidate(self, name=None):
+        self.counters.delete(ROWS + (name or ''))
+        with self.lock:
+            if name is None:
+                self.local.clear()
+            else:
+                self.local.pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            stats = super().stats()
+        stats['counters'] = {name[len(ROWS):]: value for name, value in self.counters.items(ROWS).items()}
+        return stats
+
+
+class TableVersions:
+    # change counter per table, bumped by the transaction that wrote to the table
+    # the write statements of every engine are seen by an event. Shared counters are updated
+    # in the same transaction right before its commit, so a process that reads the new counter,
+    # any process, always sees the committed rows. Counters of the process are bumped once the
+    # connection is back in the pool, after the commit. The untracked tables, never cached,
+    # are left out
+    def __init__(self, counters, untracked=()):
+        self.counters = counters
+        self.untracked = {*untracked}
+        if counters.shared:
+            self.untracked.add(counters.table.name)
+
+    def track(self):
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'commit', self.commit)
+        event.listen(Engine, 'rollback', self.rollback)
+        event.listen(Pool, 'checkin', self.checkin)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # a statement that changed no row, like a poll of the job queue, leaves the caches valid
+        written = WRITTEN_TABLE.match(statement)
+        if written and cursor.rowcount != 0 and written.group(1).lower() not in self.untracked:
+            conn.info.setdefault('written_tables', set()).add(written.group(1).lower())
+
+    def commit(self, conn):
+        written = conn.info.pop('written_tables', None)
+        if not written:
+            return
+        if self.counters.shared:
+            self.incr(written, connection=conn)
+        else:
+            conn.info.setdefault('committed_tables', set()).update(written)
+
+    def rollback(self, conn):
+        conn.info.pop('written_tables', None)
+
+    def checkin(self, dbapi_connection, connection_record):
+        # the connection's info is its pool record's
+        committed = connection_record.info.pop('committed_tables', None)
+        if committed:
+            self.incr(committed)
+
+    def incr(self, tables, connection=None):
+        self.counters.incr([VERSION + table for table in tables], create=True, connection=connection)
+
+    def get(self, tables):
+        # the counters of the tables, in the order given
+        versions = self.counters.get([VERSION + table for table in tables])
+        return tuple(versions.get(VERSION + table, (0, None))[0] for table in tables)
+
+
+class FragmentCache(TTLCache):
+    # rendered html kept between requests along with the versions of the tables it was rendered
+    # from, any write to them makes the entry stale. The least recently used fragments are
+    # dropped above max_size characters, entries older than ttl seconds are rendered again
+    # in case a table was changed outside of the engines, by hand or by another program
+    def __init__(self, table_versions, max_size=64 * 1024 * 1024, ttl=300):
+        super().__init__(maxsize=max_size, ttl=ttl, sizeof=len)
+        self.table_versions = table_versions
+
+    def get(self, name, tables, params, render):
+        # the fragment rendered from the tables with params, render() is called on a miss
+        # the versions are read before render() reads the rows. One entry per name and params,
+        # a fragment rendered from newer versions replaces the old one
+        return super().get((name, params), render, tag=self.table_versions.get(tables))
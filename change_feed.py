@@ -0,0 +1,144 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# milliseconds a browser turned away by a full feed waits before it tries again
+BUSY_RETRY_MS = 30000
+
+
+class ChangeFeed:
+    # fans the product quantity changes out to every event stream of the process
+    # one thread asks read_changes(after) for the changes since the last one it saw and keeps
+    # the recent batches, the streams wait on a condition and send the batches after their own
+    # event id. The database sees one query per interval whatever the number of open streams,
+    # the thread only queries while a stream is open. Past max_streams open streams a new one
+    # is told to come back later, so the streams never hold every thread of the worker
+    def __init__(self, read_changes, interval=0.5, history=1000, max_streams=None):
+        # read_changes(after) returns (last event id, {product id: quantity}) of the changes after
+        # the event id `after`, after None only returns the last event id
+        self.read_changes = read_changes
+        self.interval = interval
+        self.condition = threading.Condition()
+        # (event id, {product id: quantity}), complete after base_id
+        self.batches = deque()
+        self.history = history
+        self.max_streams = max_streams
+        self.base_id = None
+        self.last_id = None
+        self.streams = 0
+        self.polls = 0
+        self.events = 0
+        self.refused = 0
+        self.thread = None
+
+    def start(self, app):
+        # started on first use so no thread is started before gunicorn forks its workers
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(app,), name='change-feed', daemon=True)
+                self.thread.start()
+
+    def run(self, app):
+        with app.app_context():
+            while True:
+                with self.condition:
+                    while not self.streams:
+                        # nothing is kept while no one listens, the next stream starts from the
+                        # current last event id
+                        self.base_id = self.last_id = None
+                        self.batches.clear()
+                        self.condition.wait()
+                try:
+                    last_id, changes = self.read_changes(self.last_id)
+                except Exception:
+                    logger.exception('change feed')
+                    time.sleep(self.interval)
+                    continue
+                with self.condition:
+                    self.polls += 1
+                    if self.last_id is None:
+                        self.base_id = last_id
+                    elif changes:
+                        self.batches.append((last_id, changes))
+                        if len(self.batches) > self.history:
+                            self.base_id = self.batches.popleft()[0]
+                    self.last_id = last_id
+                    self.condition.notify_all()
+                time.sleep(self.interval)
+
+    def changes_after(self, after):
+        # batches after the event id, [] while the feed is not started, None when they are older
+        # than the history, caller holds the condition
+        if self.base_id is None:
+            return []
+        if after < self.base_id:
+            return None
+        return [(event_id, changes) for event_id, changes in self.batches if event_id > after]
+
+    def stream(self, after=None, heartbeat=15, max_seconds=600, batch_size=1000):
+        # server-sent events of the changes after the event id `after`, from now on when None.
+        # A comment every heartbeat seconds keeps proxies from closing an idle stream, after
+        # max_seconds the stream ends and the browser reconnects with its last event id
+        with self.condition:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.refused += 1
+                busy = True
+            else:
+                self.streams += 1
+                self.condition.notify_all()
+                busy = False
+        if busy:
+            yield f'retry: {BUSY_RETRY_MS}\n\n'
+            return
+        try:
+            yield 'retry: 3000\n\n'
+            started = last_sent = time.monotonic()
+            while time.monotonic() - started < max_seconds:
+                with self.condition:
+                    if after is None:
+                        # from the first poll of the feed on
+                        if self.condition.wait_for(lambda: self.base_id is not None, heartbeat):
+                            after = self.last_id
+                        recent = []
+                    else:
+                        recent = self.changes_after(after)
+                        if recent == []:
+                            self.condition.wait(heartbeat)
+                            recent = self.changes_after(after)
+                if recent is None:
+                    # older than the history kept in memory, the changes since are read once for this stream
+                    last_id, changes = self.read_changes(after)
+                    recent = [(last_id, changes)] if changes else []
+                    after = max(after, last_id)
+                for event_id, changes in recent:
+                    yield from self.format(event_id, changes, batch_size)
+                    after = event_id
+                    last_sent = time.monotonic()
+                if time.monotonic() - last_sent >= heartbeat:
+                    yield ': ping\n\n'
+                    last_sent = time.monotonic()
+        finally:
+            with self.condition:
+                self.streams -= 1
+
+    def format(self, event_id, changes, batch_size):
+        # one event per batch_size products, the event id goes on the last one so a
+        # reconnecting browser gets the whole batch again
+        items = list(changes.items())
+        with self.condition:
+            self.events += 1
+        for start in range(0, len(items), batch_size):
+            data = json.dumps(dict(items[start:start + batch_size]), separators=(',', ':'))
+            if start + batch_size >= len(items):
+                yield f'id: {event_id}\nevent: quantities\ndata: {data}\n\n'
+            else:
+                yield f'event: quantities\ndata: {data}\n\n'
+
+    def stats(self):
+        with self.condition:
+            return {'streams': self.streams, 'refused': self.refused, 'polls': self.polls, 'events': self.events,
+                'last_id': self.last_id, 'batches': len(self.batches)}
@@ -0,0 +1,43 @@
+# gunicorn settings of the web process, read from the working directory by `gunicorn wsgi:app`
+# WEB_CONCURRENCY, GUNICORN_WORKER_CLASS, GUNICORN_THREADS and GUNICORN_WORKER_CONNECTIONS
+# override the values worked out from the cpu count
+import gc
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+# the cpus this process may run on, fewer than the machine's in a container
+cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+# threads by default, sqlite and the password hashes block the thread that calls them and
+# nothing else. An open event stream holds a thread, app.py caps them with STREAM_MAX_OPEN
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gthread':
+    workers = cpu_count * 2
+    threads = int(os.environ.get('GUNICORN_THREADS', 16))
+elif worker_class == 'gevent':
+    # one event loop per cpu, for many more open streams. Every sqlite query still blocks the
+    # loop and all the requests of the worker while it runs, the password checks go to os threads
+    workers = cpu_count
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+    # a stream is a greenlet here, half the connections may be streams
+    os.environ.setdefault('STREAM_MAX_OPEN', str(worker_connections // 2))
+    # patched before the app is preloaded so the locks and threads it makes are gevent's
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    # the usual (2 x cpus) + 1 sync workers
+    workers = cpu_count * 2 + 1
+workers = int(os.environ.get('WEB_CONCURRENCY', workers))
+
+# the app is loaded once in the master and the workers are forked from it, they start
+# without importing anything and share the loaded modules copy-on-write
+preload_app = True
+# a request or heartbeat slower than this restarts the worker, the jobs run in their own process
+timeout = 30
+graceful_timeout = 30
+
+
+def pre_fork(server, worker):
+    # the objects loaded so far are left out of the garbage collection, a collection in the
+    # worker would write to their pages and copy them out of the memory shared with the master
+    gc.freeze()
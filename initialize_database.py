@@ -1,29 +1,37 @@
 from app import db, User, Product, AdjustmentHeader, AdjustmentDetail, PurchaseHeader
-
-db.create_all()
-
-dev_user = User(username='dev', password='dev')
-# print(dev_user.password)    
-dev_user.hash_password(password=dev_user.password)
-# print(dev_user.password, dev_user.check_password(password='devx'))
-db.session.add(dev_user)
-db.session.commit()
+from migrations import migrate
+
+# creates the tables of a new database and upgrades an existing one in place,
+# safe to run again
+with db.engine.connect() as connection:
+    for version, name in migrate(connection, db.metadata):
+        print(f'Applied migration {version}: {name}')
+
+if User.query.filter_by(username='dev').first() is None:
+    dev_user = User(username='dev', password='dev')
+    # print(dev_user.password)
+    dev_user.hash_password(password=dev_user.password)
+    # print(dev_user.password, dev_user.check_password(password='devx'))
+    db.session.add(dev_user)
+    db.session.commit()
 
 # kopiko = Product(code='KPKB',name='Kopiko Black', quantity=0)
 # db.session.add(kopiko)
 # db.session.commit()
 
-adjustment = AdjustmentHeader(description='Stock Adjustment')
-db.session.add(adjustment)
-db.session.commit()
+if AdjustmentHeader.query.first() is None:
+    adjustment = AdjustmentHeader(description='Stock Adjustment', status='New')
+    db.session.add(adjustment)
+    db.session.commit()
 
 # adjustment_detail = AdjustmentDetail(quantity_adjust=10, adjustment_reference=adjustment, adjustment_detail=kopiko)
 # db.session.add(adjustment_detail)
 # db.session.commit()
 
-purchase = PurchaseHeader(description='Stock Adjustment')
-db.session.add(purchase)
-db.session.commit()
+if PurchaseHeader.query.first() is None:
+    purchase = PurchaseHeader(description='Stock Adjustment', status='New')
+    db.session.add(purchase)
+    db.session.commit()
 
 # # get the values
 # get_adjustment = AdjustmentHeader.query.filter_by(id=1).first()
@@ -31,4 +39,4 @@ db.session.commit()
 # print(get_adjustment.description)
 # print(get_adjustment.adjustment_details[0].quantity_adjust)
 # print(get_adjustment.adjustment_details[0].adjustment_detail.code)
-# print(get_adjustment.adjustment_details[0].adjustment_detail.name)
\ No newline at end of file
+# print(get_adjustment.adjustment_details[0].adjustment_detail.name)
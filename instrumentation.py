@@ -0,0 +1,183 @@
+import hmac
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the histogram buckets, prometheus adds +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+slow_query_logger = logging.getLogger('app.slow_query')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # a value equal to a bound goes in that bucket, prometheus buckets are "less or equal"
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Instrumentation:
+    # per request timing of the flask app: latency, number of sql statements, time spent in the
+    # database and in the templates. Kept in memory per process and served at /metrics in the
+    # prometheus text format to the scrapers sending METRICS_TOKEN, optionally sent back as a
+    # Server-Timing header. Statements slower than SLOW_QUERY_SECONDS are logged without their
+    # parameters, they hold password hashes and customer data
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.histograms = {}
+        self.slow_queries = 0
+        self.query_durations = Histogram(LATENCY_BUCKETS)
+        self.slow_query_seconds = 0.1
+        self.server_timing = False
+        self.metrics_token = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS', 0.1)
+        self.server_timing = app.config.get('SERVER_TIMING', False)
+        self.metrics_token = app.config.get('METRICS_TOKEN')
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        # every engine, including the read session's that is created later
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+        self.time_templates(app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+    def time_templates(self, app):
+        # only the top level render() of a template is timed, includes render inside it
+        instrumentation = self
+
+        class TimedTemplate(app.jinja_env.template_class):
+            def render(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return super().render(*args, **kwargs)
+                finally:
+                    instrumentation.add_to_request('render_time', time.perf_counter() - start)
+
+        app.jinja_env.template_class = TimedTemplate
+
+    def add_to_request(self, name, value):
+        if has_request_context() and 'request_timing' in g:
+            g.request_timing[name] += value
+
+    def start_request(self):
+        g.request_timing = {'start': time.perf_counter(), 'queries': 0, 'db_time': 0.0, 'render_time': 0.0}
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        self.add_to_request('queries', 1)
+        self.add_to_request('db_time', elapsed)
+        with self.lock:
+            self.query_durations.observe(elapsed)
+            if elapsed >= self.slow_query_seconds:
+                self.slow_queries += 1
+        if elapsed >= self.slow_query_seconds:
+            # the number of rows of an executemany, never the values
+            slow_query_logger.warning('slow query %.3fs%s: %s%s', elapsed,
+                f' ({request.endpoint})' if has_request_context() else '', statement,
+                f' [{len(parameters)} rows]' if executemany else '')
+
+    def handle_error(self, exception_context):
+        # a failed statement never reaches after_cursor_execute
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_start'):
+            connection.info['query_start'].pop()
+
+    def histogram(self, name, endpoint, buckets):
+        key = (name, endpoint)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        return self.histograms[key]
+
+    def finish_request(self, response):
+        timing = g.pop('request_timing', None)
+        if timing is None:
+            return response
+        # a streamed response is timed until its first byte is ready
+        elapsed = time.perf_counter() - timing['start']
+        endpoint = request.endpoint or 'unmatched'
+        with self.lock:
+            key = (endpoint, request.method, response.status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.histogram('http_request_duration_seconds', endpoint, LATENCY_BUCKETS).observe(elapsed)
+            self.histogram('http_request_sql_queries', endpoint, QUERY_COUNT_BUCKETS).observe(timing['queries'])
+            self.histogram('http_request_db_duration_seconds', endpoint, LATENCY_BUCKETS).observe(timing['db_time'])
+            self.histogram('http_request_render_duration_seconds', endpoint, LATENCY_BUCKETS).observe(timing['render_time'])
+        if self.server_timing:
+            response.headers.add('Server-Timing', ', '.join([
+                f'db;dur={timing["db_time"] * 1000:.1f};desc="{timing["queries"]} queries"',
+                f'render;dur={timing["render_time"] * 1000:.1f}',
+                f'total;dur={elapsed * 1000:.1f}',
+            ]))
+        return response
+
+    def samples(self):
+        # (metric name, type, help, [(sample name, labels, value)])
+        with self.lock:
+            yield 'http_requests_total', 'counter', 'Requests by endpoint, method and status', [
+                ('http_requests_total', {'endpoint': endpoint, 'method': method, 'status': status}, count)
+                for (endpoint, method, status), count in sorted(self.requests.items())]
+            for name, help_text in (
+                    ('http_request_duration_seconds', 'Request latency'),
+                    ('http_request_sql_queries', 'SQL statements per request'),
+                    ('http_request_db_duration_seconds', 'Time spent in SQL statements per request'),
+                    ('http_request_render_duration_seconds', 'Time spent rendering templates per request')):
+                yield name, 'histogram', help_text, [sample
+                    for (histogram_name, endpoint), histogram in sorted(self.histograms.items())
+                    if histogram_name == name
+                    for sample in histogram.samples(name, {'endpoint': endpoint})]
+            yield 'sql_query_duration_seconds', 'histogram', 'SQL statement latency', \
+                list(self.query_durations.samples('sql_query_duration_seconds', {}))
+            yield 'sql_slow_queries_total', 'counter', 'SQL statements slower than the slow query threshold', \
+                [('sql_slow_queries_total', {}, self.slow_queries)]
+
+    def metrics(self):
+        # prometheus text exposition format, the numbers of this worker process only
+        # the scraper sends "Authorization: Bearer <METRICS_TOKEN>", without a token set there is no /metrics
+        if not self.metrics_token:
+            abort(404)
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {self.metrics_token}'.encode()):
+            return Response('', 401, {'WWW-Authenticate': 'Bearer'})
+        lines = []
+        for name, metric_type, help_text, samples in self.samples():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(f'{sample_name}{format_labels(labels)} {value}' for sample_name, labels, value in samples)
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,306 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# queued -> running -> done, failed or cancelled, a running job whose worker died is queued again
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+class JobFailed(Exception):
+    # the job can't succeed, its transaction is rolled back and it is not retried
+    pass
+
+
+class JobCancelled(Exception):
+    # raised by JobContext.progress() once the job is cancelled, its open transaction is rolled back
+    pass
+
+
+class LeaseLost(Exception):
+    # the lease ran out and another worker took the job over, this worker drops its work
+    pass
+
+
+class JobContext:
+    # what a handler sees of its job
+    def __init__(self, queue, job_id, worker, attempts, done):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.attempts = attempts
+        # progress committed by an earlier attempt, a retried handler can resume from there
+        self.done = done
+
+    def progress(self, done, total=None, message=None, connection=None):
+        # record the progress in the same transaction as the work it counts, so a retry resumes
+        # from the last progress written. Without connection it goes in the session's open
+        # transaction and both are committed here, with connection it is written in that
+        # connection's transaction and the caller commits it with its own writes.
+        # Renews the lease, raises JobCancelled when a cancel was asked for
+        table = self.queue.table
+        values = {'progress_done': done, 'lease_until': self.queue.lease_end()}
+        if total is not None:
+            values['progress_total'] = total
+        if message is not None:
+            values['message'] = message[:200]
+        result = (connection or self.queue.session).execute(table.update()
+            .where(table.c.id == self.job_id).where(table.c.worker == self.worker)
+            .where(table.c.status == 'running').values(**values))
+        if result.rowcount != 1:
+            raise LeaseLost()
+        if connection is None:
+            self.queue.session.commit()
+        self.done = done
+        self.check_cancelled(connection)
+
+    def check_cancelled(self, connection=None):
+        table = self.queue.table
+        if (connection or self.queue.session).execute(
+                select([table.c.cancel_requested]).where(table.c.id == self.job_id)).scalar():
+            raise JobCancelled()
+
+
+class JobQueue:
+    # jobs kept in a table of the application database and run by worker threads or processes
+    # a job is claimed with a conditional UPDATE so two workers never run it together, the
+    # worker holds a lease renewed by every progress update, once it runs out the job is
+    # queued again for another worker. A handler's last writes are committed together with
+    # the job's done status, a retried job never applies its work twice
+    def __init__(self, session, table, lease_seconds=600, max_attempts=3, retry_delay=5):
+        self.session = session
+        self.table = table
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        # wakes up the worker threads of this process when a job is submitted
+        self.wakeup = threading.Event()
+
+    def handler(self, kind):
+        # @job_queue.handler('kind') def run(job, **params), returns a json result
+        def register(function):
+            self.handlers[kind] = function
+            return function
+        return register
+
+    def lease_end(self):
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def submit(self, kind, params, key=None, total=None):
+        # queue a job and commit, returns its id. While a job with the same key is queued or
+        # running submitting it again returns that job instead of a new one
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job: {kind}')
+        now = datetime.utcnow()
+        try:
+            result = self.session.execute(self.table.insert().values(kind=kind, params=json.dumps(params),
+                status='queued', active_key=key, attempts=0, progress_done=0, progress_total=total,
+                cancel_requested=False, run_after=now, created_at=now))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            job_id = self.session.execute(select([self.table.c.id]).where(self.table.c.active_key == key)).scalar()
+            if job_id is None:
+                # finished in between
+                return self.submit(kind, params, key, total)
+            return job_id
+        self.wakeup.set()
+        return result.inserted_primary_key[0]
+
+    def get(self, job_id):
+        # the job as a dict, None when it doesn't exist
+        table = self.table
+        row = self.session.execute(select([table.c.id, table.c.kind, table.c.status, table.c.attempts,
+                table.c.progress_done, table.c.progress_total, table.c.message, table.c.result, table.c.error,
+                table.c.cancel_requested, table.c.created_at, table.c.started_at, table.c.finished_at])
+            .where(table.c.id == job_id)).first()
+        if row is None:
+            return None
+        job = dict(row)
+        job['finished'] = job['status'] in FINISHED
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        for name in ('created_at', 'started_at', 'finished_at'):
+            job[name] = job[name].isoformat() if job[name] else None
+        return job
+
+    def cancel(self, job_id):
+        # a queued job is cancelled at once, a running one at its next progress update
+        # returns the status of the job, None when it doesn't exist
+        table = self.table
+        self.session.execute(table.update().where(table.c.id == job_id).where(table.c.status == 'queued')
+            .values(status='cancelled', active_key=None, cancel_requested=True, finished_at=datetime.utcnow()))
+        self.session.execute(table.update().where(table.c.id == job_id).where(table.c.status == 'running')
+            .values(cancel_requested=True))
+        self.session.commit()
+        return self.session.execute(select([table.c.status]).where(table.c.id == job_id)).scalar()
+
+    def recover(self):
+        # queue again the running jobs whose lease ran out, their worker died or hangs
+        # the ones that used all their attempts fail
+        table = self.table
+        now = datetime.utcnow()
+        expired = (table.c.status == 'running') & (table.c.lease_until < now)
+        self.session.execute(table.update().where(expired).where(table.c.attempts >= self.max_attempts)
+            .values(status='failed', active_key=None, error='The worker stopped responding', finished_at=now))
+        self.session.execute(table.update().where(expired)
+            .values(status='queued', worker=None, run_after=now))
+        self.session.commit()
+
+    def claim(self, worker, job_id=None):
+        # mark the next queued job, or job_id, as running for this worker, returns its id or None
+        # the job is picked and taken in one UPDATE so workers polling together don't all go
+        # for the same one, the status check makes it safe where the subquery isn't locked
+        table = self.table
+        while True:
+            now = datetime.utcnow()
+            candidate = job_id
+            if candidate is None:
+                queued = select([table.c.id]).where(table.c.status == 'queued').where(table.c.run_after <= now) \
+                    .order_by(table.c.run_after, table.c.id).limit(1)
+                # an idle worker only reads
+                if self.session.execute(queued).first() is None:
+                    self.session.commit()
+                    return None
+                candidate = queued.as_scalar()
+            result = self.session.execute(table.update()
+                .where(table.c.id == candidate).where(table.c.status == 'queued')
+                .values(status='running', worker=worker, attempts=table.c.attempts + 1,
+                    started_at=now, lease_until=self.lease_end()))
+            self.session.commit()
+            if result.rowcount == 1:
+                # a worker runs one job at a time, the start time tells the claimed job apart
+                return self.session.execute(select([table.c.id]).where(table.c.status == 'running')
+                    .where(table.c.worker == worker).where(table.c.started_at == now)).scalar()
+            if job_id is not None:
+                return None
+
+    def finish(self, job_id, worker, **values):
+        # only the worker holding the job may finish it
+        table = self.table
+        result = self.session.execute(table.update()
+            .where(table.c.id == job_id).where(table.c.worker == worker).where(table.c.status == 'running')
+            .values(finished_at=datetime.utcnow(), **values))
+        return result.rowcount == 1
+
+    def run(self, job_id, worker):
+        # run a claimed job, returns its final status
+        table = self.table
+        job = self.session.execute(select([table.c.kind, table.c.params, table.c.attempts, table.c.progress_done,
+            table.c.cancel_requested]).where(table.c.id == job_id)).first()
+        context = JobContext(self, job_id, worker, job.attempts, job.progress_done)
+        try:
+            if job.cancel_requested:
+                raise JobCancelled()
+            result = self.handlers[job.kind](context, **json.loads(job.params))
+            # the handler's last writes are committed with the done status, or not at all
+            if not self.finish(job_id, worker, status='done', active_key=None, result=json.dumps(result),
+                    progress_done=func.coalesce(table.c.progress_total, context.done)):
+                raise LeaseLost()
+            self.session.commit()
+            return 'done'
+        except LeaseLost:
+            self.session.rollback()
+            logger.warning('job %s: lease lost, left to the worker that took it over', job_id)
+            return None
+        except JobCancelled:
+            self.session.rollback()
+            self.finish(job_id, worker, status='cancelled', active_key=None, message='Cancelled')
+            self.session.commit()
+            return 'cancelled'
+        except JobFailed as error:
+            self.session.rollback()
+            self.finish(job_id, worker, status='failed', active_key=None, error=str(error))
+            self.session.commit()
+            return 'failed'
+        except Exception as error:
+            self.session.rollback()
+            logger.exception('job %s: attempt %s of %s failed', job_id, job.attempts, self.max_attempts)
+            if job.attempts >= self.max_attempts:
+                self.finish(job_id, worker, status='failed', active_key=None, error=repr(error)[:1000])
+                self.session.commit()
+                return 'failed'
+            # retried later, the delay doubles with every attempt
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            self.session.execute(table.update()
+                .where(table.c.id == job_id).where(table.c.worker == worker).where(table.c.status == 'running')
+                .values(status='queued', worker=None, error=repr(error)[:1000],
+                    run_after=datetime.utcnow() + timedelta(seconds=delay)))
+            self.session.commit()
+            return 'queued'
+
+    def run_pending(self, worker=None, limit=None):
+        # run the queued jobs in this thread until none is left, returns the number of jobs run
+        worker = worker or worker_name()
+        count = 0
+        self.recover()
+        while limit is None or count < limit:
+            job_id = self.claim(worker)
+            if job_id is None:
+                break
+            self.run(job_id, worker)
+            count += 1
+        return count
+
+    def run_now(self, job_id):
+        # run a job in the calling thread right after it was submitted, for tests and scripts
+        worker = worker_name()
+        if self.claim(worker, job_id) is not None:
+            self.run(job_id, worker)
+
+    def work(self, app, poll_interval=1.0, stop=None):
+        # worker loop, runs until stop is set
+        worker = worker_name()
+        stop = stop or threading.Event()
+        recovered_at = 0
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    # the expired leases are looked for once a minute, an idle worker only reads
+                    if time.monotonic() - recovered_at > min(60, self.lease_seconds):
+                        self.recover()
+                        recovered_at = time.monotonic()
+                    while not stop.is_set():
+                        job_id = self.claim(worker)
+                        if job_id is None:
+                            break
+                        self.run(job_id, worker)
+                except Exception:
+                    self.session.rollback()
+                    logger.exception('job worker %s', worker)
+                finally:
+                    self.session.remove()
+                self.wakeup.wait(poll_interval)
+                self.wakeup.clear()
+
+    def start_workers(self, app, count, poll_interval=1.0):
+        # daemon worker threads in this process, started on first use so no thread is
+        # started before gunicorn forks its workers
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(count):
+                thread = threading.Thread(target=self.work, args=(app, poll_interval),
+                    name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stats(self):
+        table = self.table
+        counts = {status: count for status, count in
+            self.session.execute(select([table.c.status, func.count()]).group_by(table.c.status))}
+        return {'jobs': counts, 'worker_threads': len(self.threads)}
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
@@ -0,0 +1,118 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+
+# versions applied to the database
+migration_metadata = MetaData()
+schema_migration = Table('schema_migration', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100)),
+    Column('applied_at', DateTime))
+
+
+def column_names(connection, table_name):
+    return {column['name'] for column in inspect(connection).get_columns(table_name)}
+
+
+def index_names(connection, table_name):
+    # sqlalchemy doesn't reflect indexes on expressions, they are read from the catalog
+    if connection.dialect.name == 'sqlite':
+        rows = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+            table=table_name)
+    elif connection.dialect.name == 'postgresql':
+        rows = connection.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :table'), table=table_name)
+    else:
+        return {index['name'] for index in inspect(connection).get_indexes(table_name)}
+    return {row[0] for row in rows}
+
+
+def add_columns(*columns):
+    # ALTER TABLE ... ADD COLUMN of the model columns that are missing
+    def upgrade(connection, metadata):
+        for table_name, column_name in columns:
+            table = metadata.tables[table_name]
+            if column_name not in column_names(connection, table_name):
+                connection.execute(f'ALTER TABLE {connection.dialect.identifier_preparer.format_table(table)} '
+                    f'ADD COLUMN {CreateColumn(table.c[column_name]).compile(dialect=connection.dialect)}')
+    return upgrade
+
+
+def create_indexes(*indexes):
+    # CREATE INDEX of the model indexes that are missing
+    def upgrade(connection, metadata):
+        for table_name, index_name in indexes:
+            if index_name not in index_names(connection, table_name):
+                index, = [index for index in metadata.tables[table_name].indexes if index.name == index_name]
+                index.create(bind=connection)
+    return upgrade
+
+
+def create_tables(*table_names):
+    # CREATE TABLE of the model tables that are missing, with their indexes
+    def upgrade(connection, metadata):
+        for table_name in table_names:
+            metadata.tables[table_name].create(bind=connection, checkfirst=True)
+    return upgrade
+
+
+def steps(*upgrades):
+    # several upgrades applied as one step
+    def upgrade(connection, metadata):
+        for step in upgrades:
+            step(connection, metadata)
+    return upgrade
+
+
+def set_document_status(connection, metadata):
+    add_columns(('adjustment_header', 'status'))(connection, metadata)
+    connection.execute(text("UPDATE adjustment_header SET status = 'New' WHERE status IS NULL"))
+
+
+# (version, name, upgrade(connection, metadata)), never change a released step, add a new one.
+# Every step checks what is there first so it can run on a database created by any earlier
+# version of initialize_database.py or upgraded by hand
+MIGRATIONS = (
+    (1, 'adjustment document status', set_document_status),
+    (2, 'optimistic locking versions', add_columns(
+        ('product', 'version_id'),
+        ('customer', 'version_id'),
+        ('adjustment_detail', 'version_id'),
+        ('purchase_detail', 'version_id'))),
+    (3, 'listing, worksheet and stock history indexes', create_indexes(
+        ('product', 'ix_product_updated_at_id'),
+        ('adjustment_detail', 'ix_adjustment_detail_header_id_product_id'),
+        ('purchase_detail', 'ix_purchase_detail_header_id_product_id'),
+        ('stock_movement', 'ix_stock_movement_product_id_id'))),
+    (4, 'report indexes', create_indexes(
+        ('product', 'ix_product_quantity_price'),
+        ('product', 'ix_product_value'),
+        ('purchase_detail', 'ix_purchase_detail_header_id_quantities'),
+        ('customer', 'ix_customer_balance'))),
+    (5, 'worksheet line product indexes', create_indexes(
+        ('adjustment_detail', 'ix_adjustment_detail_product_id'),
+        ('purchase_detail', 'ix_purchase_detail_product_id'))),
+    (6, 'job queue', steps(
+        create_tables('job'),
+        create_indexes(('job', 'ix_job_status_run_after_id')))),
+    (7, 'cache counters', create_tables('cache_counter')),
+)
+
+
+def migrate(connection, metadata):
+    # create the missing tables then apply the steps not applied yet, each in its own transaction
+    # returns the (version, name) applied, running it again applies nothing
+    with connection.begin():
+        migration_metadata.create_all(connection)
+        # new tables are created with their current columns and indexes, the steps skip them
+        metadata.create_all(connection)
+    applied_versions = {row[0] for row in connection.execute(select([schema_migration.c.version]))}
+    applied = []
+    for version, name, upgrade in MIGRATIONS:
+        if version in applied_versions:
+            continue
+        with connection.begin():
+            upgrade(connection, metadata)
+            connection.execute(schema_migration.insert(), version=version, name=name, applied_at=datetime.utcnow())
+        applied.append((version, name))
+    return applied
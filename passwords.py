@@ -0,0 +1,63 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordCheckBusy(Exception):
+    # more password checks are waiting than the pool accepts
+    pass
+
+
+class PasswordHasher:
+    # password hashes with a configurable method and cost
+    # hashes and checks run on a small thread pool so a burst of sign ins uses at most `workers` cores,
+    # hashlib releases the GIL while it hashes so the other requests keep running.
+    # Above max_pending waiting hashes and checks PasswordCheckBusy is raised instead of queueing
+    def __init__(self, method='pbkdf2:sha256', iterations=150000, workers=2, max_pending=32):
+        self.method = method
+        self.iterations = iterations
+        self.workers = workers
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def method_string(self):
+        # werkzeug takes the pbkdf2 iteration count as part of the method
+        if self.method.startswith('pbkdf2:'):
+            return f'{self.method}:{self.iterations}'
+        return self.method
+
+    def hash(self, password):
+        # runs on the pool, raises PasswordCheckBusy when it is full
+        return self.run(generate_password_hash, password, method=self.method_string())
+
+    def needs_rehash(self, pwhash):
+        # the hash was made with another method or iteration count
+        return pwhash.split('$', 1)[0] != self.method_string()
+
+    def get_executor(self):
+        # created on first use so no thread is started before gunicorn forks its workers
+        with self.lock:
+            if self.executor is None:
+                monkey = sys.modules.get('gevent.monkey')
+                if monkey is not None and monkey.is_module_patched('threading'):
+                    # the patched threads are greenlets, a hash would stop every other request of
+                    # the worker. gevent's pool runs it on an os thread and waits without blocking
+                    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+                    self.executor = GeventThreadPoolExecutor(max_workers=self.workers)
+                else:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+            return self.executor
+
+    def run(self, function, *args, **kwargs):
+        if not self.pending.acquire(blocking=False):
+            raise PasswordCheckBusy()
+        try:
+            return self.get_executor().submit(function, *args, **kwargs).result()
+        finally:
+            self.pending.release()
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
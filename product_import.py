@@ -0,0 +1,130 @@
+import csv
+import json
+import time
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import bindparam, select
+
+from storage import bulk_insert
+
+ImportResult = namedtuple('ImportResult', ['read', 'inserted', 'errors', 'elapsed'])
+ImportRowError = namedtuple('ImportRowError', ['line', 'code', 'error'])
+
+
+def read_rows(stream, file_format):
+    # yield (line number, row dict or None, error) one row at a time
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None, 'Invalid JSON'
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, 'Invalid JSON'
+                continue
+            yield line_number, row, None
+    else:
+        raise ValueError(f'Unknown import format: {file_format}')
+
+
+def clean_row(row):
+    # validate one row the same way Product.check_fields does,
+    # returns (values for the product table, list of errors)
+    code = str(row.get('code') or '').strip()
+    name = str(row.get('name') or '').strip()
+    quantity = str(row.get('quantity') if row.get('quantity') is not None else '').strip()
+    price = str(row.get('price') if row.get('price') is not None else '').strip()
+
+    error_list = []
+    if code == '':
+        error_list.append('Invalid Product code')
+    if name == '':
+        error_list.append('Invalid Product Name')
+    if not quantity.isdigit():
+        error_list.append('Invalid Product Quantity')
+    if price != '':
+        try:
+            price = float(price)
+        except ValueError:
+            error_list.append('Invalid Product Price')
+    else:
+        price = None
+
+    if error_list:
+        return None, error_list
+    return {'code': code, 'name': name, 'quantity': int(quantity), 'price': price}, []
+
+
+def import_products(connection, product_table, rows, chunk_size=500, on_error=None, on_progress=None,
+        clean_row=clean_row):
+    # insert the rows coming from read_rows() chunk by chunk, only one chunk is held in memory
+    # clean_row(row) returns (values, list of errors) of a row, the csv one by default
+    # codes are checked per chunk with one IN query, a code that is already in the table
+    # (including the chunks inserted before) or repeated inside the chunk is rejected
+    # on_error(ImportRowError) is called for every rejected row
+    # on_progress(ImportResult) is called after every chunk, inside the chunk's transaction so what
+    # it writes on connection is committed together with the chunk
+    start = time.perf_counter()
+    read = inserted = errors = 0
+    find_codes = select([product_table.c.code]).where(
+        product_table.c.code.in_(bindparam('codes', expanding=True)))
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        read += len(chunk)
+
+        candidates = []
+        for line_number, row, error in chunk:
+            if error is None:
+                values, error_list = clean_row(row)
+                error = ', '.join(error_list)
+            if error:
+                errors += 1
+                if on_error:
+                    on_error(ImportRowError(line_number, (row or {}).get('code', ''), error))
+                continue
+            candidates.append((line_number, values))
+
+        existing_codes = set()
+        if candidates:
+            existing_codes = {code for (code,) in connection.execute(
+                find_codes, codes=[values['code'] for line_number, values in candidates])}
+
+        now = datetime.utcnow()
+        new_products = []
+        for line_number, values in candidates:
+            if values['code'] in existing_codes:
+                errors += 1
+                if on_error:
+                    on_error(ImportRowError(line_number, values['code'],
+                        f'Product code: {values["code"]} already exist'))
+                continue
+            existing_codes.add(values['code'])
+            values['created_at'] = values['updated_at'] = now
+            new_products.append(values)
+
+        with connection.begin():
+            inserted += bulk_insert(connection, product_table, new_products)
+            if on_progress:
+                on_progress(ImportResult(read, inserted, errors, time.perf_counter() - start))
+
+    return ImportResult(read, inserted, errors, time.perf_counter() - start)
+
+
+def error_file_writer(stream):
+    # on_error callback writing the rejected rows to a csv file
+    writer = csv.writer(stream)
+    writer.writerow(['line', 'code', 'error'])
+    return lambda row_error: writer.writerow(row_error)
@@ -0,0 +1,120 @@
+from sqlalchemy import and_, case, func, literal, or_, select, union_all
+
+# rows listed by each report
+REPORT_ROWS = 50
+# products at or below this quantity are low on stock
+LOW_STOCK_QUANTITY = 10
+# (label, lower bound, upper bound) of the customer balance brackets, None is unbounded
+BALANCE_BRACKETS = (
+    ('Zero or less', None, 0),
+    ('Up to 1,000', 0, 1000),
+    ('1,000 to 5,000', 1000, 5000),
+    ('5,000 to 10,000', 5000, 10000),
+    ('Over 10,000', 10000, None),
+)
+
+# every report is a few aggregate queries, the rows never go through python one by one.
+# They are answered from covering indexes: product (quantity, price) and (quantity * price),
+# customer (balance) and purchase_detail (purchase_header_id, quantity_purchase, quantity_receive)
+
+
+def total(column):
+    # sum that is 0 instead of NULL without rows
+    return func.coalesce(func.sum(column), 0)
+
+
+def product_value(product_table):
+    return product_table.c.quantity * product_table.c.price
+
+
+def stock_valuation(connection, product_table, limit=REPORT_ROWS):
+    # total quantity and value (price * quantity) of the stock and the products worth the most
+    totals = connection.execute(select([
+            func.count().label('product_count'),
+            total(product_table.c.quantity).label('quantity'),
+            total(product_value(product_table)).label('value')
+        ])).first()
+    products = connection.execute(select([
+            product_table.c.id,
+            product_table.c.code,
+            product_table.c.name,
+            product_table.c.quantity,
+            product_table.c.price,
+            product_value(product_table).label('value')
+        ]).order_by(product_value(product_table).desc()).limit(limit)).fetchall()
+    return totals, products
+
+
+def low_stock(connection, product_table, threshold=LOW_STOCK_QUANTITY, limit=REPORT_ROWS):
+    # products without stock and products at or below the threshold, lowest first
+    quantity = product_table.c.quantity
+    no_stock = or_(quantity <= 0, quantity == None)
+    low = and_(quantity > 0, quantity <= threshold)
+    columns = [product_table.c.id, product_table.c.code, product_table.c.name, quantity, product_table.c.price]
+    counts = connection.execute(select([
+            select([func.count()]).where(no_stock).as_scalar().label('zero_count'),
+            select([func.count()]).where(low).as_scalar().label('low_count')
+        ])).first()
+    zero_products = connection.execute(
+        select(columns).where(no_stock).order_by(product_table.c.code).limit(limit)).fetchall()
+    low_products = connection.execute(
+        select(columns).where(low).order_by(quantity, product_table.c.code).limit(limit)).fetchall()
+    return counts, zero_products, low_products
+
+
+def purchase_variance(connection, header_table, detail_table, product_table, limit=REPORT_ROWS):
+    # received against ordered quantities of the received purchases, per document and the
+    # lines with the largest difference. Applied purchases are reset to zero so they drop out
+    received = select([header_table.c.id]).where(header_table.c.status == 'Received')
+    difference = detail_table.c.quantity_receive - detail_table.c.quantity_purchase
+    documents = connection.execute(select([
+            header_table.c.id,
+            header_table.c.description,
+            func.count(detail_table.c.id).label('line_count'),
+            total(detail_table.c.quantity_purchase).label('quantity_purchase'),
+            total(detail_table.c.quantity_receive).label('quantity_receive'),
+            total(difference).label('difference'),
+            func.sum(case([(difference != 0, 1)], else_=0)).label('variance_count')
+        ]).select_from(header_table.join(detail_table, detail_table.c.purchase_header_id == header_table.c.id))
+        .where(header_table.c.id.in_(received))
+        .group_by(header_table.c.id, header_table.c.description)
+        .order_by(header_table.c.id)).fetchall()
+    lines = connection.execute(select([
+            detail_table.c.purchase_header_id,
+            product_table.c.code,
+            product_table.c.name,
+            detail_table.c.quantity_purchase,
+            detail_table.c.quantity_receive,
+            difference.label('difference'),
+            (difference * product_table.c.price).label('value')
+        ]).select_from(detail_table.join(product_table, detail_table.c.product_id == product_table.c.id))
+        .where(detail_table.c.purchase_header_id.in_(received))
+        .where(detail_table.c.quantity_receive != detail_table.c.quantity_purchase)
+        .order_by(func.abs(difference).desc(), detail_table.c.id).limit(limit)).fetchall()
+    return documents, lines
+
+
+def balance_brackets(connection, customer_table, limit=REPORT_ROWS):
+    # number of customers and total balance per balance bracket, one index range each,
+    # and the customers with the highest balance
+    balance = customer_table.c.balance
+    brackets = []
+    for position, (label, lower, upper) in enumerate(BALANCE_BRACKETS):
+        bracket = select([
+                literal(position).label('position'),
+                literal(label).label('label'),
+                func.count().label('customer_count'),
+                total(balance).label('balance')
+            ])
+        if lower is not None:
+            bracket = bracket.where(balance > lower)
+        if upper is not None:
+            bracket = bracket.where(balance <= upper)
+        brackets.append(bracket)
+    rows = connection.execute(union_all(*brackets).order_by('position')).fetchall()
+    customers = connection.execute(select([
+            customer_table.c.id,
+            customer_table.c.fullname,
+            balance
+        ]).where(balance > 0).order_by(balance.desc()).limit(limit)).fetchall()
+    return rows, customers
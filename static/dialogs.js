@@ -1,5 +1,6 @@
 $(function () {
-    $('.js-sweetalert button').on('click', function () {
+    // delegated so the rows added by Load More get the handler too
+    $(document).on('click', '.js-sweetalert button', function () {
         var type = $(this).data('type');
         var id = $(this).val();
         var record = $(this).data('record');
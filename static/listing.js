@@ -0,0 +1,49 @@
+// Load More button of the product and customer listings
+// fetches the next page from the JSON endpoint and appends the rows to the table
+$(function () {
+    $('.js-load-more').on('click', function () {
+        var button = $(this);
+        var params = { after: button.data('next') };
+        if (button.data('search')) {
+            params.q = button.data('search');
+        }
+        $.getJSON(button.data('url'), params, function (page) {
+            var table = $(button.data('table'));
+            $.each(page.items, function (index, item) {
+                table.append(listingRow(button.data('record'), item));
+            });
+            if (page.next) {
+                button.data('next', page.next);
+            } else {
+                button.remove();
+            }
+        });
+    });
+});
+
+function listingRow(record, item) {
+    var row = $('<tr>');
+    var actions = $('<div class="js-sweetalert">');
+    if (record == 'customer') {
+        row.append($('<th scope="row">').text(item.id));
+        row.append($('<td>').text(item.fullname));
+        row.append($('<td>').text(item.balance));
+        row.append($('<td>').text(item.remarks));
+        actions.append($('<a class="btn btn-primary waves-effect">').attr('href', '/edit_customer/' + item.id).text('Edit'));
+        actions.append(' ');
+        actions.append($('<button class="btn btn-danger waves-effect" data-type="confirm" data-record="customer">').val(item.id).text('Delete'));
+    }
+    else {
+        row.attr('data-product-id', item.id);
+        row.append($('<th scope="row">').text(item.code));
+        row.append($('<td>').text(item.name));
+        row.append($('<td class="js-quantity">').text(item.quantity));
+        row.append($('<td>').text(item.price));
+        row.append($('<td>').text(item.created_at));
+        actions.append($('<a class="btn btn-primary waves-effect">').attr('href', '/edit_product/' + item.id).text('Edit'));
+        actions.append(' ');
+        actions.append($('<button class="btn btn-danger waves-effect" data-type="confirm">').val(item.id).text('Delete'));
+    }
+    row.append($('<td>').append(actions));
+    return row;
+}
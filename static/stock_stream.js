@@ -0,0 +1,19 @@
+// Live stock levels
+// the quantity cell of every row with a data-product-id follows the quantities pushed by
+// /stream/products, the browser reconnects on its own and resumes after the last event it got
+$(function () {
+    var page = $('.js-stock-stream');
+    if (page.length === 0 || !window.EventSource) {
+        return;
+    }
+    var source = new EventSource(page.data('stream-url'));
+    source.addEventListener('quantities', function (event) {
+        var quantities = JSON.parse(event.data);
+        page.find('tr[data-product-id]').each(function () {
+            var quantity = quantities[this.getAttribute('data-product-id')];
+            if (quantity !== undefined) {
+                $(this).find('.js-quantity').text(quantity === null ? '' : quantity);
+            }
+        });
+    });
+});
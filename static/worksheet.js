@@ -0,0 +1,113 @@
+// Adjustment and purchase worksheets
+// Save sends only the lines changed since the page was loaded and Remove deletes a single line,
+// both without reloading the page. The other buttons post the form with the changed lines only,
+// the lines that are not posted keep their saved quantities.
+// Load Products and Apply run as background jobs, their progress is shown until they finish
+$(function () {
+    var form = $('.js-worksheet');
+    var submitType = null;
+
+    if (form.data('job-url')) {
+        watchJob(form);
+        form.on('click', '.js-job-cancel', function () {
+            $.post(form.data('job-url') + '/cancel');
+        });
+    }
+
+    form.on('click', 'button[type=submit]', function () {
+        submitType = $(this).val();
+    });
+
+    form.on('submit', function (event) {
+        var clicked = submitType;
+        submitType = null;
+        if (clicked && clicked.indexOf('DEL-') === 0) {
+            event.preventDefault();
+            removeLine(form, clicked.substring('DEL-'.length));
+        }
+        else if (clicked === form.data('save')) {
+            event.preventDefault();
+            saveLines(form);
+        }
+        else {
+            changedRows(form, false).find('input').prop('disabled', true);
+        }
+    });
+});
+
+function isChanged(row) {
+    return $(row).find('input[type=number]').filter(function () {
+        return this.value !== this.defaultValue;
+    }).length > 0;
+}
+
+function changedRows(form, changed) {
+    return form.find('tbody tr').filter(function () {
+        return isChanged(this) === changed;
+    });
+}
+
+function worksheetMessage(css_class, message) {
+    showNotification(css_class, '', 'bottom', 'center', '', '', message);
+}
+
+function saveLines(form) {
+    var rows = changedRows(form, true);
+    if (rows.length === 0) {
+        worksheetMessage('alert-success', 'Nothing to save');
+        return;
+    }
+    $.ajax({ url: form.data('lines-url'), method: 'POST', data: rows.find('input').serialize(), dataType: 'json' })
+        .done(function (result) {
+            // the saved values are the new starting point, the next save needs the new versions
+            rows.each(function () {
+                var row = $(this);
+                row.find('input[type=number]').each(function () {
+                    this.defaultValue = this.value;
+                });
+                var version = row.find('input[name^="VERSION-"]');
+                version.val(result.versions[version.attr('name').substring('VERSION-'.length)]);
+            });
+            worksheetMessage('alert-success', result.message);
+        })
+        .fail(function (xhr) {
+            worksheetMessage('alert-danger', xhr.responseJSON ? xhr.responseJSON.message : 'The lines could not be saved');
+        });
+}
+
+function removeLine(form, lineId) {
+    $.ajax({ url: form.data('lines-url') + '/' + lineId, method: 'DELETE', dataType: 'json' })
+        .done(function (result) {
+            form.find('button[value="DEL-' + lineId + '"]').closest('tr').remove();
+            worksheetMessage('alert-success', result.message);
+        })
+        .fail(function (xhr) {
+            worksheetMessage('alert-danger', xhr.responseJSON ? xhr.responseJSON.message : 'The line could not be removed');
+        });
+}
+
+function watchJob(form) {
+    $.getJSON(form.data('job-url'))
+        .done(function (job) {
+            if (job.finished) {
+                if (job.status === 'done') {
+                    worksheetMessage('alert-success', job.result.message);
+                }
+                else {
+                    worksheetMessage('alert-danger', job.error || job.message || 'The job did not finish');
+                }
+                // the worksheet is loaded again with what the job wrote
+                setTimeout(function () { window.location = window.location.pathname; }, 1500);
+                return;
+            }
+            var progress = job.status === 'queued' ? 'waiting' : 'running';
+            if (job.progress_total) {
+                progress = Math.floor(100 * job.progress_done / job.progress_total) + '%';
+            }
+            form.find('.js-job-status').text(progress + (job.cancel_requested ? ', cancelling' : ''));
+            setTimeout(function () { watchJob(form); }, 1000);
+        })
+        .fail(function () {
+            setTimeout(function () { watchJob(form); }, 5000);
+        });
+}
@@ -0,0 +1,171 @@
+import csv
+import io
+import os
+import threading
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+# pragmas applied on every new sqlite connection
+SQLITE_PRAGMAS = {
+    # readers don't block the writer and the writer doesn't block readers
+    'journal_mode': 'WAL',
+    # with WAL a commit only fsyncs at checkpoints, still safe after a crash
+    'synchronous': 'NORMAL',
+    # wait for the write lock instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    # negative is in KiB, 64MB page cache per connection
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_engine_options(pool_size=5, max_overflow=10):
+    # keep connections open so the page cache and mmap survive between requests,
+    # flask-sqlalchemy uses a NullPool for sqlite files when no pool_size is given
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'connect_args': {'check_same_thread': False},
+    }
+
+
+def database_uri(uri):
+    # heroku hands out postgres:// urls, sqlalchemy names the dialect postgresql
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def engine_options(uri, pool_size=5, max_overflow=10, **extra_options):
+    # engine options for the configured database, extra_options are passed as is
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            # flask-sqlalchemy puts in memory databases on a single connection
+            options = {}
+        else:
+            options = sqlite_engine_options(pool_size, max_overflow)
+    else:
+        options = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            # drop connections the server or a proxy closed while they were idle
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        }
+    options.update(extra_options)
+    return options
+
+
+def bulk_insert(connection, table, rows):
+    # insert a list of dicts with the same keys in as few round trips as possible,
+    # COPY on postgresql and one executemany of a single compiled INSERT elsewhere
+    # (sqlalchemy compiles a multi-row INSERT ... VALUES bind by bind, that is slower)
+    if not rows:
+        return 0
+    if connection.dialect.name == 'postgresql':
+        columns = list(rows[0])
+        preparer = connection.dialect.identifier_preparer
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f'COPY {preparer.format_table(table)} ({", ".join(preparer.quote(column) for column in columns)}) '
+            "FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer
+        )
+        cursor.close()
+        # COPY is not seen by the engine events, the write is recorded for the table change counters
+        connection.info.setdefault('written_tables', set()).add(table.name)
+    else:
+        connection.execute(table.insert(), rows)
+    return len(rows)
+
+
+def apply_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def protect_after_fork(engine):
+    # a pooled connection opened before a fork is never used by the child, the child drops it
+    # and opens its own, the parent keeps using it. The engines are created on first use so
+    # nothing is pooled when gunicorn forks its workers, this covers a script that queried first
+    @event.listens_for(engine, 'connect')
+    def record_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            # not closed, the socket or file still belongs to the parent
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('connection opened in another process')
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    # applies the SQLITE_PRAGMAS config to every connection of a sqlite engine
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            apply_pragmas(engine, self.get_app().config['SQLITE_PRAGMAS'])
+        protect_after_fork(engine)
+        return engine
+
+
+class ReadSession:
+    # session on a separate connection pool for the read only routes, so listings never
+    # queue behind a connection holding the write lock. query_only connections on
+    # sqlite, a replica when DATABASE_READ_URL is set, else the main engine
+    def __init__(self, db):
+        self.db = db
+        self.engine = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_engine(self):
+        with self.lock:
+            if self.engine is None:
+                engine = self.db.engine
+                app = self.db.get_app()
+                if app.config.get('DATABASE_READ_URL'):
+                    # a read replica
+                    read_uri = database_uri(app.config['DATABASE_READ_URL'])
+                    engine = create_engine(read_uri, **engine_options(read_uri,
+                        app.config['DATABASE_READ_POOL_SIZE'], app.config['DATABASE_MAX_OVERFLOW']))
+                elif engine.dialect.name == 'sqlite':
+                    options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                    if 'pool_size' in options:
+                        options['pool_size'] = app.config['DATABASE_READ_POOL_SIZE']
+                    engine = create_engine(engine.url, **options)
+                    apply_pragmas(engine, dict(app.config['SQLITE_PRAGMAS'], query_only='ON'))
+                if engine is not self.db.engine:
+                    protect_after_fork(engine)
+                self.engine = engine
+            return self.engine
+
+    def __call__(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = Session(bind=self.get_engine(), autoflush=False)
+        return session
+
+    def query(self, *entities):
+        return self().query(*entities)
+
+    def remove(self):
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            session.close()
+            self.local.session = None
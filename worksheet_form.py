@@ -0,0 +1,90 @@
+from collections import namedtuple
+
+# one line of the purchase worksheet as posted by purchase.html
+PurchaseLine = namedtuple('PurchaseLine', ['id', 'prod_code', 'purch_qty', 'receive_qty'])
+
+
+def parse_int(value):
+    # the posted number, None when it is not a whole number
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_adjustment_form(form):
+    # adjustment lines are posted as <adjustment detail id>=<new quantity>
+    # returns ({ adjustment detail id: new quantity }, list of errors), a line whose id
+    # or quantity is not a number is left out and reported in the errors
+    adj_quantities = {}
+    error_list = []
+    for field, value in form.items():
+        if field == 'submit_type' or field.startswith('VERSION-'):
+            continue
+        line_id = parse_int(field)
+        quantity = parse_int(value)
+        if line_id is None:
+            error_list.append(f'Invalid line "{field}"')
+        elif quantity is None:
+            error_list.append(f'Invalid quantity "{value}"')
+        else:
+            adj_quantities[line_id] = quantity
+    return adj_quantities, error_list
+
+
+def parse_line_versions(form, lines):
+    # both worksheets post the version of every line they rendered as VERSION-<id>
+    # returns ({ detail id: version id }, list of errors). A line of `lines` (the dict of the
+    # parsed lines) with an invalid version is removed from it, so it is never saved unchecked
+    line_versions = {}
+    error_list = []
+    for field, value in form.items():
+        if not field.startswith('VERSION-'):
+            continue
+        line_id = parse_int(field[len('VERSION-'):])
+        version = parse_int(value)
+        if line_id is None or version is None:
+            error_list.append(f'Invalid version "{value}" of {field[len("VERSION-"):]}')
+            lines.pop(line_id, None)
+        else:
+            line_versions[line_id] = version
+    return line_versions, error_list
+
+
+def parse_purchase_form(form):
+    # purchase lines are posted as PURCHASE-<id>-<code> and RECEIVE-<id>-<code>
+    # returns ({ purchase detail id: PurchaseLine }, list of errors) in a single pass over the form,
+    # a line with a quantity that is not a number is left out and reported in the errors
+    purch_qtys = {}
+    receive_qtys = {}
+    prod_codes = {}
+    invalid_lines = set()
+    error_list = []
+    for field, value in form.items():
+        field_type, _, line_key = field.partition('-')
+        if field_type == 'PURCHASE':
+            quantities = purch_qtys
+        elif field_type == 'RECEIVE':
+            quantities = receive_qtys
+        else:
+            continue
+        # the product code may contain dashes, only split off the line id
+        line_id, _, prod_code = line_key.partition('-')
+        line_id = parse_int(line_id)
+        quantity = parse_int(value)
+        if line_id is None:
+            error_list.append(f'Invalid line "{field}"')
+            continue
+        if quantity is None:
+            error_list.append(f'Invalid {field_type.lower()} quantity "{value}" for {prod_code}')
+            invalid_lines.add(line_id)
+            continue
+        quantities[line_id] = quantity
+        prod_codes[line_id] = prod_code
+
+    # a line is only complete when both the purchase and receive quantity were posted
+    return {
+        line_id: PurchaseLine(line_id, prod_codes[line_id], purch_qty, receive_qtys[line_id])
+        for line_id, purch_qty in purch_qtys.items()
+        if line_id in receive_qtys and line_id not in invalid_lines
+    }, error_list
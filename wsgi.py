@@ -0,0 +1,4 @@
+# the web process, `gunicorn wsgi:app` with the settings of gunicorn.conf.py
+from app import prepare_app
+
+app = prepare_app()